@@ -3,4 +3,6 @@ Collection of utitilities to work with networks that are represented as
 csr_matrix (sparse matrices from scipy)
 """
 from __future__ import absolute_import
-from .jaccard import jaccard_distance
+from .jaccard import jaccard_distance, jaccard_similarity
+from .similarity import similarity
+from .minhash import MinHashIndex
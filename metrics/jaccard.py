@@ -8,6 +8,8 @@ import scipy.sparse as sparse
 import scipy.spatial.distance as distance
 from sklearn.metrics.pairwise import pairwise_distances
 
+from .similarity import similarity
+
 def jaccard_distance(X, Y=None, n_jobs=-1, **kwds):
     """ Computes the Jaccard distance between all the pairs of vectors in X.
     If X is not sparse the function defaults to sklearn.metrics.pairwise.pairwise_distances
@@ -16,6 +18,10 @@ def jaccard_distance(X, Y=None, n_jobs=-1, **kwds):
     The Jaccard index is defined as the intersection / union of items in the vector (that is 
     non-sparse indices, regardless of their magnitude)
 
+    For sparse input only the intersections are computed with a sparse product,
+    the unions are derived from the number of items in each vector. The result
+    is dense, see jaccard_similarity for thresholded (sparse) output.
+
     Parameters:
     -----------
     X: an array (dims: samples X features)
@@ -50,13 +56,42 @@ def jaccard_distance(X, Y=None, n_jobs=-1, **kwds):
             my = mx
         else:
             my = sparse.csr_matrix((np.ones_like(mmy.data, dtype=np.double), mmy.indices, mmy.indptr), shape=mmy.shape)
-        m_int = mx * my.T
-        m_uni = pairwise_distances(mx, my, metric='manhattan', n_jobs=n_jobs, **kwds)
-        m_uni += m_int
+        m_int = (mx * my.T).todense()
+        m_uni = np.diff(mx.indptr)[:, None] + np.diff(my.indptr)[None, :] - m_int
         return 1.0 - (m_int / m_uni)
     else:
         return pairwise_distances(X, metric='jaccard', n_jobs=n_jobs, **kwds)
 
+def jaccard_similarity(X, min_similarity=None, k=None, output='sparse', block_size=1000, n_jobs=1, include_self=False):
+    """ The Jaccard index between pairs of rows of a sparse matrix X, keeping
+    only those that are at least min_similarity (and/or the k largest of
+    each row). Computed in blocks of rows, memory is proportional to the output.
+
+    Parameters:
+    -----------
+    X:              a sparse matrix (samples X features)
+    min_similarity: the smallest index to keep
+    k:              keep the k largest indices in each row (output='topk')
+    output:         'sparse' (the default) or 'topk'
+    block_size:     the number of rows processed at a time
+    n_jobs:         the number of threads (all cpus if not positive)
+    include_self:   keep the index of each row with itself (1)
+
+    Returns a csr_matrix, see metrics.similarity
+
+    Examples:
+        >>> from scipy.sparse import csr_matrix
+        >>> from numpy import matrix
+        >>> s = csr_matrix(matrix([[1, 1, 1, 0, 0], [0, 1, 1, 0, 1], [0, 0, 0, 1, 1]]))
+        >>> jaccard_similarity(s, min_similarity=0.2).toarray()
+        array([[ 0.  ,  0.5 ,  0.  ],
+               [ 0.5 ,  0.  ,  0.25],
+               [ 0.  ,  0.25,  0.  ]])
+        >>> jaccard_similarity(s, k=1, output='topk').nonzero()
+        (array([0, 1, 2], dtype=int32), array([1, 0, 1], dtype=int32))
+    """
+    return similarity(X, 'jaccard', output, min_similarity=min_similarity, k=k, block_size=block_size,
+                      n_jobs=n_jobs, include_self=include_self)
 
 if __name__ == '__main__':
     import doctest
@@ -0,0 +1,268 @@
+"""
+Approximate Jaccard similarity between the rows of very large sparse
+matrices (e.g., gene-to-annotation sets) with MinHash signatures and an
+LSH (banding) index for candidate pairs.
+"""
+import numpy as np
+import scipy.sparse as sparse
+
+from .jaccard import jaccard_distance
+
+EMPTY = np.iinfo(np.uint32).max # the signature of a row with no items
+
+class MinHashIndex(object):
+    """ MinHash signatures of the rows of a sparse matrix, indexed by LSH.
+
+    Each of n_hashes hash functions maps the items (columns) of a row to
+    32-bit values and the signature keeps the minimum. The fraction of equal
+    signature entries of two rows estimates their Jaccard index. Signatures
+    are split into `bands` bands, rows that agree on all the entries of
+    any band are candidate pairs: pairs with Jaccard index s become candidates
+    with probability 1 - (1 - s**r)**bands, where r = n_hashes / bands.
+
+    Parameters:
+    -----------
+    X:          a sparse matrix (rows X items), only the pattern is used
+    n_hashes:   the length of the signatures
+    bands:      the number of LSH bands (must divide n_hashes)
+    seed:       the seed of the hash functions. Indices that are compared
+                or queried must use the same seed (it is stored by save).
+                If None, a random seed is drawn (and stored as self.seed)
+    chunk_size: the number of hash functions computed at a time
+
+    Examples:
+    ---------
+    >>> X = sparse.csr_matrix(np.array([[1, 1, 1, 1, 0, 0], [1, 1, 1, 1, 1, 0], [0, 0, 0, 0, 1, 1]]))
+    >>> index = MinHashIndex(X, n_hashes=64, bands=32)
+    >>> index.query(X[0])
+    array([0, 1])
+    >>> rows, cols, sim = sparse.find(index.all_pairs(0.5, exact=True))
+    >>> list(rows), list(cols), list(sim)
+    ([1, 0], [0, 1], [0.80000000000000004, 0.80000000000000004])
+    >>> isinstance(MinHashIndex(X, seed=None).seed, int)
+    True
+    """
+
+    def __init__(self, X=None, n_hashes=128, bands=32, seed=0, chunk_size=16):
+        if n_hashes % bands != 0:
+            raise ValueError("bands (%d) must divide n_hashes (%d)" % (bands, n_hashes))
+
+        self.n_hashes = n_hashes
+        self.bands = bands
+        if seed is None: # a concrete seed, so the index can be saved and rebuilt
+            seed = int(np.random.RandomState().randint(np.iinfo(np.int32).max))
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+        rs = np.random.RandomState(seed)
+        # multiply-shift hashing: h(x) = ((a*x + b) mod 2**64) >> 32, a odd
+        self._a = rs.randint(0, 2**62, size=n_hashes).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rs.randint(0, 2**62, size=n_hashes).astype(np.uint64)
+        # combines the entries of a band into a single key
+        self._band_weights = (rs.randint(0, 2**62, size=n_hashes // bands).astype(np.uint64) * np.uint64(2) +
+                              np.uint64(1))
+
+        self.X = None
+        self.signatures = np.empty((0, n_hashes), dtype=np.uint32)
+        self._keys = self._order = None
+        if X is not None:
+            self.fit(X)
+
+    @property
+    def rows_per_band(self):
+        return self.n_hashes // self.bands
+
+    def __len__(self):
+        return self.signatures.shape[0]
+
+    def fit(self, X):
+        """ Compute the signatures of the rows of X and build the index """
+        self.X = sparse.csr_matrix(X)
+        self.signatures = self.signature(self.X)
+        self._build()
+        return self
+
+    def signature(self, X):
+        """ The MinHash signatures (rows X n_hashes, uint32) of the rows of a sparse matrix """
+        X = sparse.csr_matrix(X)
+        X.eliminate_zeros()
+        n = X.shape[0]
+        signatures = np.empty((n, self.n_hashes), dtype=np.uint32)
+        signatures[:] = EMPTY
+
+        counts = np.diff(X.indptr)
+        nonempty = np.flatnonzero(counts)
+        if len(nonempty) == 0:
+            return signatures
+
+        items = X.indices.astype(np.uint64)
+        starts = X.indptr[nonempty]
+        for begin in range(0, self.n_hashes, self.chunk_size):
+            end = min(begin + self.chunk_size, self.n_hashes)
+            with np.errstate(over='ignore'):
+                hashes = (items[:, None] * self._a[begin:end] + self._b[begin:end]) >> np.uint64(32)
+            signatures[nonempty, begin:end] = np.minimum.reduceat(hashes.astype(np.uint32), starts, axis=0)
+
+        return signatures
+
+    def _band_keys(self, signatures):
+        """ One uint64 key per row and band (rows X bands) """
+        r = self.rows_per_band
+        bands = signatures.reshape(signatures.shape[0], self.bands, r).astype(np.uint64)
+        with np.errstate(over='ignore'):
+            return (bands * self._band_weights).sum(axis=2, dtype=np.uint64)
+
+    def _build(self):
+        """ Sort the rows by their key in every band """
+        keys = self._band_keys(self.signatures)
+        self._order = np.argsort(keys, axis=0, kind='mergesort')
+        self._keys = keys[self._order, np.arange(self.bands)]
+        self._empty = (self.signatures == EMPTY).all(axis=1) # never candidates
+
+    def candidates(self, signature):
+        """ The (sorted) rows that share at least one band with a signature """
+        if (signature == EMPTY).all():
+            return np.empty(0, dtype=np.int64)
+
+        keys = self._band_keys(signature[None, :])[0]
+        found = []
+        for band in range(self.bands):
+            column = self._keys[:, band]
+            lo = np.searchsorted(column, keys[band], side='left')
+            hi = np.searchsorted(column, keys[band], side='right')
+            found.append(self._order[lo:hi, band])
+
+        found = np.unique(np.concatenate(found))
+        return found[~self._empty[found]]
+
+    def query(self, row, threshold=None, exact=False, return_similarity=False):
+        """ The rows that are similar to `row`.
+
+        Parameters:
+        -----------
+        row:               a sparse (or dense) vector of items, or the index
+                           of a row of the index
+        threshold:         keep only candidates with an (estimated or exact)
+                           Jaccard index of at least threshold
+        exact:             compute the exact Jaccard index of the candidates
+                           (with jaccard_distance, requires the matrix)
+        return_similarity: also return the similarities
+
+        Returns the (sorted) indices of the rows
+        """
+        if np.isscalar(row):
+            signature = self.signatures[row]
+            if exact:
+                row = self._require_matrix()[row]
+        else:
+            row = sparse.csr_matrix(row)
+            signature = self.signature(row)[0]
+
+        found = self.candidates(signature)
+
+        if exact:
+            similarity = 1.0 - np.asarray(jaccard_distance(self._require_matrix()[found], row)).ravel()
+        else:
+            similarity = (self.signatures[found] == signature).mean(axis=1)
+
+        if threshold is not None:
+            keep = similarity >= threshold
+            found, similarity = found[keep], similarity[keep]
+
+        if return_similarity:
+            return found, similarity
+        return found
+
+    def candidate_pairs(self, max_bucket=None):
+        """ All pairs of rows (i < j) that share a band, as two arrays.
+            Buckets with more than max_bucket rows are skipped """
+        n = len(self)
+        pairs = []
+        for band in range(self.bands):
+            keys, order = self._keys[:, band], self._order[:, band]
+
+            valid = ~self._empty[order]
+            keys, order = keys[valid], order[valid]
+            if len(keys) < 2:
+                continue
+
+            starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+            sizes = np.diff(np.append(starts, len(keys)))
+            for size in np.unique(sizes[sizes > 1]):
+                if max_bucket is not None and size > max_bucket:
+                    continue
+                first = starts[sizes == size]
+                ii, jj = np.triu_indices(size, 1)
+                a, b = order[first[:, None] + ii].ravel(), order[first[:, None] + jj].ravel()
+                pairs.append(np.minimum(a, b).astype(np.int64) * n + np.maximum(a, b))
+
+        if not pairs:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        pairs = np.unique(np.concatenate(pairs))
+        return pairs // n, pairs % n
+
+    def all_pairs(self, threshold=0.5, exact=False, max_bucket=None, chunk_size=1000000):
+        """ All pairs of rows with a Jaccard index of at least threshold
+        (estimated from the signatures, or exact).
+
+        Parameters:
+        -----------
+        threshold:  the minimal (estimated or exact) Jaccard index
+        exact:      re-check the candidates exactly (requires the matrix)
+        max_bucket: skip LSH buckets with more rows than this
+        chunk_size: the number of candidate pairs evaluated at a time
+
+        Returns a symmetric csr_matrix of similarities (as jaccard_similarity)
+        """
+        rows, cols = self.candidate_pairs(max_bucket)
+
+        if exact:
+            B = self._require_matrix().copy()
+            B.eliminate_zeros()
+            B.data = np.ones_like(B.data, dtype=np.double)
+            counts = np.diff(B.indptr)
+
+        similarity = np.empty(len(rows))
+        for start in range(0, len(rows), chunk_size):
+            i, j = rows[start:start+chunk_size], cols[start:start+chunk_size]
+            if exact:
+                intersection = np.asarray(B[i].multiply(B[j]).sum(1)).ravel()
+                similarity[start:start+chunk_size] = intersection / (counts[i] + counts[j] - intersection)
+            else:
+                similarity[start:start+chunk_size] = (self.signatures[i] == self.signatures[j]).mean(axis=1)
+
+        keep = similarity >= threshold
+        rows, cols, similarity = rows[keep], cols[keep], similarity[keep]
+
+        n = len(self)
+        return sparse.csr_matrix((np.concatenate((similarity, similarity)),
+                                  (np.concatenate((rows, cols)), np.concatenate((cols, rows)))), shape=(n, n))
+
+    def _require_matrix(self):
+        if self.X is None:
+            raise ValueError("Exact similarities require the matrix (pass X to fit or load)")
+        return self.X
+
+    def save(self, path):
+        """ Store the signatures and the hashing parameters (not the matrix)
+            in a .npz file """
+        np.savez(path, signatures=self.signatures,
+                 params=np.array([self.n_hashes, self.bands, self.seed, self.chunk_size], dtype=np.int64))
+
+    @staticmethod
+    def load(path, X=None):
+        """ Load an index stored with save. X (the matrix the signatures were
+            computed from) is only needed for exact similarities """
+        with np.load(path) as f:
+            n_hashes, bands, seed, chunk_size = [int(x) for x in f['params']]
+            signatures = f['signatures']
+
+        index = MinHashIndex(n_hashes=n_hashes, bands=bands, seed=seed, chunk_size=chunk_size)
+        if X is not None:
+            index.X = sparse.csr_matrix(X)
+            if index.X.shape[0] != signatures.shape[0]:
+                raise ValueError("The matrix does not match the stored signatures")
+        index.signatures = signatures
+        index._build()
+        return index
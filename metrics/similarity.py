@@ -0,0 +1,233 @@
+"""
+Pairwise similarities between the rows of a sparse matrix (e.g., the
+neighbourhoods of the nodes of a network), computed in blocks of rows so
+that neither the input nor the output has to be dense.
+"""
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import scipy.sparse as sparse
+
+METRICS = ('cosine', 'correlation', 'pearson_neighbours', 'jaccard')
+OUTPUTS = ('dense', 'sparse', 'topk')
+
+def similarity(X, metric='cosine', output='dense', min_similarity=None, k=None, block_size=1000, n_jobs=1,
+               include_self=False):
+    """ Similarities between all pairs of rows of X.
+
+    Parameters:
+    -----------
+    X:              a matrix (samples X features), converted to csr_matrix
+    metric:         'cosine':      x.y / (|x| |y|)
+                    'correlation': Pearson's correlation over all features
+                                   (1 - scipy's 'correlation' distance)
+                    'pearson_neighbours': Pearson's correlation over the
+                                   features that are nonzero in both rows
+                                   (e.g., the weights of shared neighbours).
+                                   Pairs with fewer than two such features
+                                   have no (zero) similarity
+                    'jaccard':     |x & y| / |x | y| of the nonzero features.
+                                   Only intersections are computed (a sparse
+                                   product), unions are derived from the
+                                   number of nonzeros of each row
+    output:         'dense':  an n X n array
+                    'sparse': a csr_matrix with the similarities that are at
+                              least min_similarity
+                    'topk':   a csr_matrix with the k largest similarities
+                              in each row (at least min_similarity, if given)
+    min_similarity: the threshold for sparse (and topk) output
+    k:              the number of neighbours for topk output
+    block_size:     the number of rows computed at a time, memory is
+                    O(block_size * n) for correlation (unless the output is
+                    sparse with a positive threshold and X is non-negative)
+                    and proportional to the block's nonzero similarities
+                    otherwise
+    n_jobs:         the number of threads for the blocks (all cpus if not
+                    positive)
+    include_self:   keep the similarity of each row with itself in sparse
+                    and topk output
+
+    Examples:
+    ---------
+    >>> X = sparse.csr_matrix(np.array([[1., 1, 0, 0], [1, 1, 1, 0], [0, 0, 1, 1]]))
+    >>> np.round(similarity(X), 3)
+    array([[ 1.   ,  0.816,  0.   ],
+           [ 0.816,  1.   ,  0.408],
+           [ 0.   ,  0.408,  1.   ]])
+    >>> similarity(X, output='sparse', min_similarity=0.5).toarray().round(3)
+    array([[ 0.   ,  0.816,  0.   ],
+           [ 0.816,  0.   ,  0.   ],
+           [ 0.   ,  0.   ,  0.   ]])
+    >>> similarity(X, output='topk', k=1, block_size=2).nonzero()
+    (array([0, 1, 2], dtype=int32), array([1, 0, 1], dtype=int32))
+    >>> from scipy.spatial.distance import pdist, squareform
+    >>> np.allclose(similarity(X, 'correlation'), 1 - squareform(pdist(X.toarray(), 'correlation')))
+    True
+    >>> Z = sparse.csr_matrix(([1., 0, 1, 1], ([0, 0, 1, 1], [0, 1, 0, 1])), shape=(2, 2)) # a stored zero
+    >>> similarity(Z, 'jaccard')[0, 1], 1 - pdist(Z.toarray(), 'jaccard')[0]
+    (0.5, 0.5)
+    """
+    if metric not in METRICS:
+        raise ValueError("Unknown metric %r (expected one of %s)" % (metric, ', '.join(METRICS)))
+    if output not in OUTPUTS:
+        raise ValueError("Unknown output %r (expected one of %s)" % (output, ', '.join(OUTPUTS)))
+    if output == 'topk' and k is None:
+        raise ValueError("topk output requires k")
+
+    X = sparse.csr_matrix(X, dtype=np.double)
+    X.sum_duplicates()
+    n = X.shape[0]
+    prepared = _prepare(X, metric)
+
+    # with non-negative data, rows without common features have correlation
+    # <= 0, so a positive threshold only needs the pattern of X * X.T
+    pattern_only = (metric == 'correlation' and output == 'sparse' and min_similarity is not None and
+                    min_similarity > 0 and (X.nnz == 0 or X.data.min() >= 0))
+
+    def compute(start):
+        stop = min(start + block_size, n)
+        block = _block(prepared, metric, start, stop, pattern_only)
+        if output == 'dense':
+            return block.toarray() if sparse.issparse(block) else block
+        return _select(block, start, output, min_similarity, k, include_self)
+
+    starts = range(0, n, block_size)
+    if n_jobs is None or n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+
+    if n_jobs == 1 or len(starts) <= 1:
+        blocks = [compute(start) for start in starts]
+    else:
+        pool = ThreadPool(min(n_jobs, len(starts)))
+        try:
+            blocks = pool.map(compute, starts)
+        finally:
+            pool.close()
+
+    if output == 'dense':
+        return np.vstack(blocks) if blocks else np.empty((0, 0))
+    if not blocks:
+        return sparse.csr_matrix((0, 0))
+    return sparse.vstack(blocks, format='csr')
+
+def _prepare(X, metric):
+    """ The operands of the block products """
+    if metric == 'cosine':
+        norms = np.sqrt(np.asarray(X.multiply(X).sum(1)).ravel())
+        scale = np.zeros_like(norms)
+        scale[norms > 0] = 1.0 / norms[norms > 0]
+        Xn = sparse.diags(scale) * X
+        return {'left': Xn.tocsr(), 'right': Xn.T.tocsr()}
+
+    if metric == 'correlation':
+        m = float(X.shape[1])
+        mean = np.asarray(X.sum(1)).ravel() / m
+        squares = np.asarray(X.multiply(X).sum(1)).ravel()
+        with np.errstate(invalid='ignore'):
+            std = np.sqrt(np.maximum(squares - m * mean ** 2, 0))
+        return {'left': X, 'right': X.T.tocsr(), 'mean': mean, 'std': std, 'm': m}
+
+    B = X.copy()
+    B.eliminate_zeros() # explicitly stored zeros are not features of the row
+    B.data = np.ones_like(B.data)
+    if metric == 'jaccard':
+        return {'left': B, 'right': B.T.tocsr(), 'count': np.diff(B.indptr).astype(np.double)}
+
+    X2 = X.multiply(X).tocsr()
+    return {'X': X, 'B': B, 'X2': X2,
+            'BT': B.T.tocsr(), 'XT': X.T.tocsr(), 'X2T': X2.T.tocsr()}
+
+def _block(prepared, metric, start, stop, pattern_only=False):
+    """ The similarities of rows start:stop to all rows """
+    if metric == 'cosine':
+        return prepared['left'][start:stop] * prepared['right']
+
+    if metric == 'correlation':
+        dots = prepared['left'][start:stop] * prepared['right']
+        mean, std = prepared['mean'], prepared['std']
+        if pattern_only:
+            dots = dots.tocsr()
+            rows = np.repeat(np.arange(start, stop), np.diff(dots.indptr))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dots.data = (dots.data - prepared['m'] * mean[rows] * mean[dots.indices]) / (std[rows] * std[dots.indices])
+            return dots
+
+        dots = dots.toarray()
+        dots -= prepared['m'] * np.outer(mean[start:stop], mean)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dots /= np.outer(std[start:stop], std)
+        return dots
+
+    if metric == 'jaccard':
+        inter = (prepared['left'][start:stop] * prepared['right']).tocsr()
+        count = prepared['count']
+        rows = np.repeat(np.arange(start, stop), np.diff(inter.indptr))
+        inter.data /= count[rows] + count[inter.indices] - inter.data
+        return inter
+
+    # pearson over the common support: all the sums share the pattern of B*B.T
+    rows = slice(start, stop)
+    count = prepared['B'][rows] * prepared['BT']
+    sxy = _on_pattern(prepared['X'][rows] * prepared['XT'], count)
+    sx = _on_pattern(prepared['X'][rows] * prepared['BT'], count)
+    sy = _on_pattern(prepared['B'][rows] * prepared['XT'], count)
+    sx2 = _on_pattern(prepared['X2'][rows] * prepared['BT'], count)
+    sy2 = _on_pattern(prepared['B'][rows] * prepared['X2T'], count)
+
+    c = count.data
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (c * sxy - sx * sy) / np.sqrt((c * sx2 - sx ** 2) * (c * sy2 - sy ** 2))
+    r[~np.isfinite(r) | (c < 2)] = 0
+    result = sparse.csr_matrix((r, count.indices, count.indptr), shape=count.shape)
+    result.eliminate_zeros()
+    return result
+
+def _on_pattern(m, pattern):
+    """ The values of m at the (sorted) nonzero pattern of pattern """
+    m = m.tocsr()
+    m.sort_indices()
+    pattern.sort_indices()
+    if m.nnz == pattern.nnz and (m.indices == pattern.indices).all() and (m.indptr == pattern.indptr).all():
+        return m.data
+    return np.asarray(m[pattern.nonzero()]).ravel()
+
+def _select(block, start, output, min_similarity, k, include_self):
+    """ A csr_matrix with the selected entries of a block """
+    with np.errstate(invalid='ignore'): # nan for constant rows
+        if not sparse.issparse(block):
+            keep = np.isfinite(block) & (block != 0)
+            if min_similarity is not None:
+                keep &= block >= min_similarity
+            block = sparse.csr_matrix(np.where(keep, block, 0))
+        else:
+            block = sparse.csr_matrix(block)
+            drop = ~np.isfinite(block.data)
+            if min_similarity is not None:
+                drop |= block.data < min_similarity
+            block.data[drop] = 0
+
+    if not include_self:
+        rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+        block.data[block.indices == rows + start] = 0
+
+    block.eliminate_zeros()
+
+    if output == 'topk':
+        block = _top_k(block, k)
+
+    return block
+
+def _top_k(m, k):
+    """ Keep the k largest entries in each row of a csr_matrix """
+    counts = np.diff(m.indptr)
+    if m.nnz == 0 or counts.max() <= k:
+        return m
+
+    rows = np.repeat(np.arange(m.shape[0]), counts)
+    order = np.lexsort((-m.data, rows))
+    ranks = np.empty(m.nnz, dtype=np.int64)
+    ranks[order] = np.arange(m.nnz) - m.indptr[rows[order]]
+    m.data[ranks >= k] = 0
+    m.eliminate_zeros()
+    return m
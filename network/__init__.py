@@ -5,4 +5,6 @@ csr_matrix (sparse matrices from scipy)
 from __future__ import absolute_import
 
 from .sparse_graph import SparseGraph, from_indices
+from .label_index import LabelIndex
+from .builder import GraphBuilder
 from .util import edge_id
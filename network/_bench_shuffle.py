@@ -0,0 +1,42 @@
+# Benchmark of the edge-swap kernels (see random.shuffle):
+#
+#   python -m mypy.network._bench_shuffle [n_nodes] [avg_degree] [iterations]
+#
+# All algorithms are run on copies of the same random graph with the same
+# seed; they must produce identical networks.
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+
+from .random import shuffle
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+degree = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+iterations = int(sys.argv[3]) if len(sys.argv) > 3 else 5000000
+
+rs = np.random.RandomState(0)
+i = rs.randint(n, size=n*degree/2)
+j = rs.randint(n, size=n*degree/2)
+i, j = i[i != j], j[i != j]
+g = sparse.csr_matrix((rs.rand(len(i)), (i, j)), shape=(n, n))
+g = g + g.T
+
+print "nodes: %d, edges: %d, iterations: %d" % (n, g.nnz, iterations)
+
+results = {}
+for algorithm in ('classic', 'rowmap', 'batched'):
+    h = g.copy()
+    start = time.time()
+    switches, stats = shuffle(h, max_iterations=iterations, seed=42, algorithm=algorithm, return_stats=True)
+    elapsed = time.time() - start
+    results[algorithm] = h
+
+    print "%-8s %6.2fs  %10.0f attempts/s  %10.0f swaps/s  (rejected: %d shared node, %d existing edge)" % (
+        algorithm, elapsed, iterations / elapsed, switches / elapsed,
+        stats['rejected_nodes'], stats['rejected_exists'])
+
+for algorithm in ('rowmap', 'batched'):
+    same = (results[algorithm] != results['classic']).nnz == 0
+    print "%s == classic:" % algorithm, same
@@ -0,0 +1,203 @@
+"""
+Incremental construction of a SparseGraph from (possibly very long) edge
+lists that arrive in chunks, e.g., from the readers in mypy.fileformat:
+
+    >> builder = GraphBuilder()
+    >> for chunk in fileformat.hippie(filename, chunksize=1000000):
+    >>     builder.add(chunk.uniprot_id_a, chunk.uniprot_id_b, chunk.confidence)
+    >> g = builder.build()
+"""
+import numpy as np
+import pandas as pd
+
+from .sparse_graph import SparseGraph
+from .util import coalesce, csr_from_sorted
+
+class GraphBuilder(object):
+    """ Accumulates edges chunk by chunk and builds a SparseGraph.
+
+    Node labels are assigned ids (in order of appearance) with a hash table
+    that grows as new labels are seen. Edges are kept as compact integer
+    buffers that are periodically sorted and de-duplicated, so memory stays
+    close to the size of the final graph even when the input has many
+    duplicate edges. `build` performs a single sort into csr format (and,
+    unlike from_indices, does not materialize `m + m.T` for symmetric graphs).
+
+    Parameters:
+    -----------
+    symmetric:     treat edges as undirected (the default). As in
+                   from_indices (m + m.T), a self loop gets twice its weight
+    duplicates:    how to combine weights of repeated edges: 'sum' (as
+                   from_indices does), 'first' or 'last'
+    dtype:         the dtype of the edge weights
+    compact_every: the number of buffered edges that triggers a de-duplication
+
+    Examples:
+    ---------
+    >>> builder = GraphBuilder()
+    >>> builder.add(['a', 'b'], ['b', 'c'])
+    >>> builder.add(['c', 'b'], ['d', 'a'], [2., 3.])
+    >>> g = builder.build()
+    >>> g.to_frame()
+         a    b    c    d
+    a  0.0  4.0  0.0  0.0
+    b  4.0  0.0  1.0  0.0
+    c  0.0  1.0  0.0  2.0
+    d  0.0  0.0  2.0  0.0
+    >>> builder = GraphBuilder()
+    >>> builder.add(['a', 'a'], ['a', 'b'], [1., 2.])
+    >>> builder.build().to_frame().equals(SparseGraph.from_indices(['a', 'a'], ['a', 'b'], [1., 2.]).to_frame())
+    True
+    >>> builder.add(['a', None], ['c', 'a'])
+    Traceback (most recent call last):
+        ...
+    ValueError: Missing (null) node labels
+    >>> len(builder) # nothing was added
+    2
+    >>> builder = GraphBuilder(symmetric=False, duplicates='last')
+    >>> builder.extend([(['b', 'a'], ['a', 'b'], [1., 2.]), (['b'], ['a'], [5.])])
+    >>> builder.build().to_frame()
+         b    a
+    b  0.0  5.0
+    a  2.0  0.0
+    """
+
+    def __init__(self, symmetric=True, duplicates='sum', dtype=np.double, compact_every=10000000):
+        if duplicates not in ('sum', 'first', 'last'):
+            raise ValueError("Unknown method for combining duplicates: %r" % (duplicates,))
+
+        self.symmetric = symmetric
+        self.duplicates = duplicates
+        self.dtype = dtype
+        self.compact_every = compact_every
+
+        self._ids = {}
+        self._labels = []
+        self._chunks = []
+        self._buffered = 0
+
+    def __len__(self):
+        """ The number of nodes seen so far """
+        return len(self._labels)
+
+    def _encode(self, labels):
+        """ Map labels to ids, assigning new ids to unseen labels """
+        codes, uniques = pd.factorize(np.asarray(labels))
+
+        # only the unique labels of the chunk go through the python dict
+        ids = np.empty(len(uniques), dtype=np.int64)
+        for k, label in enumerate(uniques):
+            id_ = self._ids.get(label)
+            if id_ is None:
+                id_ = self._ids[label] = len(self._labels)
+                self._labels.append(label)
+            ids[k] = id_
+
+        idx_dtype = np.int32 if len(self._labels) < np.iinfo(np.int32).max else np.int64
+        return ids.astype(idx_dtype)[codes]
+
+    def add(self, i, j, data=None):
+        """ Add a chunk of edges.
+
+        Parameters:
+        -----------
+        i: (array of) labels of source nodes
+        j: (array of) labels of destination nodes
+        data: edge weights (optional, default: 1)
+        """
+        if len(i) != len(j):
+            raise ValueError("i and j must have the same length")
+
+        if data is None or np.isscalar(data):
+            data = np.ones(len(i), dtype=self.dtype) * (1 if data is None else data)
+        else:
+            data = np.asarray(data, dtype=self.dtype)
+            if len(data) != len(i):
+                raise ValueError("data must have the same length as i and j")
+
+        # checked before any label is registered (factorize would give
+        # None/NaN the code -1)
+        i, j = np.asarray(i), np.asarray(j)
+        if pd.isnull(i).any() or pd.isnull(j).any():
+            raise ValueError("Missing (null) node labels")
+
+        rows = self._encode(i)
+        cols = self._encode(j)
+
+        if self.symmetric:
+            rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+
+        self._chunks.append((rows, cols, data))
+        self._buffered += len(rows)
+
+        if self._buffered >= self.compact_every:
+            self._compact()
+
+    def add_frame(self, df, i, j, data=None):
+        """ Add the edges in a DataFrame, `i`, `j` and `data` are column names """
+        self.add(df[i].values, df[j].values, None if data is None else df[data].values)
+
+    def extend(self, chunks, i=None, j=None, data=None):
+        """ Add all chunks from an iterable. Chunks are either DataFrames (in
+            which case `i`, `j` and `data` are column names, see add_frame) or
+            tuples (i, j) or (i, j, data) """
+        for chunk in chunks:
+            if isinstance(chunk, pd.DataFrame):
+                self.add_frame(chunk, i, j, data)
+            else:
+                self.add(*chunk)
+
+    def _compact(self):
+        """ Merge the buffered chunks into a single sorted, de-duplicated one """
+        if len(self._chunks) == 0:
+            return
+
+        rows, cols, data = [np.concatenate(x) for x in zip(*self._chunks)]
+        self._chunks = [coalesce(rows, cols, data, how=self.duplicates)]
+        self._buffered = 0
+
+    def build(self, sort_names=False):
+        """ Build the SparseGraph from the edges added so far.
+
+        Parameters:
+        -----------
+        sort_names: order the nodes by label (as from_indices does) rather
+                    than by order of appearance
+        """
+        self._compact()
+
+        n = len(self._labels)
+        labels = _as_label_array(self._labels)
+
+        if len(self._chunks) == 0:
+            rows = cols = np.empty(0, dtype=np.int32)
+            data = np.empty(0, dtype=self.dtype)
+        else:
+            rows, cols, data = self._chunks[0]
+
+        if sort_names and n > 0:
+            order = np.argsort(labels, kind='mergesort')
+            labels = labels[order]
+            relabel = np.empty(n, dtype=rows.dtype)
+            relabel[order] = np.arange(n, dtype=rows.dtype)
+            rows, cols = relabel[rows], relabel[cols]
+
+        if self.symmetric:
+            off_diagonal = rows != cols
+            rows, cols = np.concatenate((rows, cols[off_diagonal])), np.concatenate((cols, rows[off_diagonal]))
+            data = np.concatenate((np.where(off_diagonal, data, 2 * data), data[off_diagonal])) # loops as in m + m.T
+
+        if sort_names or self.symmetric:
+            # entries are unique, this only sorts them
+            rows, cols, data = coalesce(rows, cols, data, how='first')
+
+        names = pd.Series(np.arange(n, dtype=np.int), labels)
+        return SparseGraph(csr_from_sorted(rows, cols, data, n), names)
+
+def _as_label_array(labels):
+    result = np.asarray(labels)
+    if result.ndim != 1: # e.g., tuple labels
+        result = np.empty(len(labels), dtype=object)
+        for k, label in enumerate(labels):
+            result[k] = label
+    return result
@@ -0,0 +1,71 @@
+"""
+A small cache for matrices derived from a graph (e.g., the normalized
+propagation operator), with hit/miss counters.
+"""
+from collections import namedtuple, OrderedDict
+
+CacheInfo = namedtuple('CacheInfo', ('hits', 'misses', 'size'))
+
+class OperatorCache(object):
+    """ Maps keys to derived operators. The owner is responsible for calling
+        clear() whenever the underlying matrix changes. With maxsize, the
+        least recently used operators are dropped to keep at most maxsize.
+
+    Examples:
+    ---------
+    >>> cache = OperatorCache()
+    >>> cache.get('x', lambda: 1)
+    1
+    >>> cache.get('x', lambda: 2)
+    1
+    >>> cache.info()
+    CacheInfo(hits=1, misses=1, size=1)
+    >>> cache.clear()
+    >>> cache.get('x', lambda: 2)
+    2
+    >>> cache = OperatorCache(maxsize=2)
+    >>> [cache.get(k, lambda: k) for k in 'abac']
+    ['a', 'b', 'a', 'c']
+    >>> sorted(cache._operators), cache.info()
+    (['a', 'c'], CacheInfo(hits=1, misses=3, size=2))
+    """
+
+    def __init__(self, maxsize=None):
+        self._operators = OrderedDict()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, factory):
+        """ Returns the operator stored under key, calling factory() to build
+            it on a miss """
+        try:
+            value = self._operators.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = factory()
+            if self.maxsize is not None and len(self._operators) >= self.maxsize:
+                self._operators.popitem(last=False)
+        else:
+            self.hits += 1
+
+        self._operators[key] = value # the most recently used last
+        return value
+
+    def clear(self):
+        """ Drop all operators (the counters are kept) """
+        self._operators.clear()
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, len(self._operators))
+
+    def __len__(self):
+        return len(self._operators)
+
+def freeze(m):
+    """ Make the arrays of a sparse matrix read-only (so a cached operator
+        that is handed out cannot be modified in-place) """
+    m.sort_indices() # scipy may otherwise sort lazily, in-place
+    for array in (m.data, m.indices, m.indptr):
+        array.flags.writeable = False
+    return m
@@ -0,0 +1,164 @@
+"""
+Cytoscape.js (.cyjs) export.
+
+The JSON is written in chunks of nodes/edges to a file object. Every
+column of a chunk is encoded to JSON strings at once (numbers by numpy,
+strings once per unique value), so memory does not depend on the size of
+the graph and no per-element python dicts are created.
+"""
+import json
+from cStringIO import StringIO
+
+import numpy as np
+import pandas as pd
+
+from .util import row_blocks
+
+def write_cyjs(f, m, labels, node_attributes=None, symmetric=True, indent=None, chunk_size=100000):
+    """ Write a graph in Cytoscape.js JSON format.
+
+    Parameters:
+    -----------
+    f:               a file object
+    m:               the adjacency matrix (a csr_matrix)
+    labels:          the node labels (written as 'name', the ids are the
+                     positions in m)
+    node_attributes: a DataFrame indexed by label or a dict of dicts (label
+                     -> {attribute: value}). Missing values are written as
+                     null
+    symmetric:       write only the edges (i, j) with i < j
+    indent:          the indentation of the nested structure (one element per
+                     line) or None for compact output
+    chunk_size:      the number of nodes/edges encoded at once
+
+    Examples:
+    ---------
+    >>> from scipy.sparse import csr_matrix
+    >>> m = csr_matrix(([1., 2.5], ([0, 1], [1, 0])), shape=(3, 3))
+    >>> f = StringIO()
+    >>> write_cyjs(f, m, ['a', 'b', 'c'], {'a': {'size': 3}})
+    >>> print f.getvalue()
+    {"elements":{"nodes":[{"data":{"id":"0","name":"a","size":3.0}},{"data":{"id":"1","name":"b","size":null}},{"data":{"id":"2","name":"c","size":null}}],"edges":[{"data":{"source":"0","target":"1","value":1.0}}]},"data":{}}
+    >>> json.loads(f.getvalue())['elements']['edges']
+    [{u'data': {u'source': u'0', u'target': u'1', u'value': 1.0}}]
+    >>> f = StringIO()
+    >>> write_cyjs(f, csr_matrix(([1/3.], ([0], [1])), shape=(2, 2)), ['a', 'b'], symmetric=False)
+    >>> json.loads(f.getvalue())['elements']['edges'][0]['data']['value'] == 1/3.
+    True
+    """
+    if indent is None:
+        newline, pad, colon = '', '', ':'
+    else:
+        newline, pad, colon = '\n', ' ' * indent, ': '
+
+    def line(depth, text):
+        f.write(newline + pad * depth + text)
+
+    nodes = _node_frame(labels, node_attributes)
+
+    f.write('{')
+    line(1, '"elements"' + colon + '{')
+    line(2, '"nodes"' + colon + '[')
+    _write_elements(f, _node_chunks(nodes, chunk_size), colon, newline + pad * 3)
+    line(2, '],')
+    line(2, '"edges"' + colon + '[')
+    _write_elements(f, _edge_chunks(m, symmetric, chunk_size), colon, newline + pad * 3)
+    line(2, ']')
+    line(1, '},')
+    line(1, '"data"' + colon + '{}')
+    line(0, '}')
+
+def to_cyjs(m, labels, node_attributes=None, symmetric=True, indent=3, chunk_size=100000):
+    """ write_cyjs to a string """
+    f = StringIO()
+    write_cyjs(f, m, labels, node_attributes, symmetric, indent, chunk_size)
+    return f.getvalue()
+
+def _node_frame(labels, node_attributes):
+    """ The attributes aligned with the labels (by index, not per row) """
+    labels = pd.Index(labels)
+    if node_attributes is None:
+        return pd.DataFrame(index=labels)
+    if not isinstance(node_attributes, pd.DataFrame):
+        node_attributes = pd.DataFrame.from_dict(node_attributes, orient='index')
+    return node_attributes.reindex(labels)
+
+def _node_chunks(nodes, chunk_size):
+    for start in range(0, len(nodes), chunk_size):
+        chunk = nodes.iloc[start:start + chunk_size]
+        columns = [('id', _encode_ids(np.arange(start, start + len(chunk)))),
+                   ('name', _encode(chunk.index.values))]
+        columns.extend((str(k), _encode(chunk[k].values)) for k in chunk.columns)
+        yield columns
+
+def _edge_chunks(m, symmetric, chunk_size):
+    """ Encoded (source, target, value) columns of blocks of rows with about
+        chunk_size entries """
+    for source, target, value in row_blocks(m, chunk_size):
+        if symmetric:
+            mask = source < target
+            source, target, value = source[mask], target[mask], value[mask]
+
+        if len(source):
+            yield [('source', _encode_ids(source)), ('target', _encode_ids(target)), ('value', _encode(value))]
+
+def _write_elements(f, chunks, colon, separator):
+    """ Write the elements ({"data": {...}}) of the encoded chunks """
+    first = True
+    for columns in chunks:
+        text = None
+        for k, (name, values) in enumerate(columns):
+            key = ('{"data"%s{' % colon if k == 0 else ',') + json.dumps(name) + colon
+            text = key + values if text is None else text + key + values
+        text = text + '}}'
+
+        f.write(('' if first else ',') + separator)
+        f.write((',' + separator).join(text))
+        first = False
+
+def _encode_ids(ids):
+    """ Node ids as JSON strings """
+    return _as_objects(np.char.add(np.char.add('"', ids.astype(str)), '"'))
+
+def _encode(values):
+    """ JSON encoding of a column (an object array of strings) """
+    values = np.asarray(values)
+    if values.dtype.kind == 'b':
+        return _as_objects(np.where(values, 'true', 'false'))
+
+    if values.dtype.kind in 'iu':
+        return _as_objects(values.astype(str))
+
+    if values.dtype.kind == 'f':
+        return _as_objects(_encode_floats(values))
+
+    # strings and mixed columns, once per unique value
+    codes, uniques = pd.factorize(values)
+    encoded = np.array([json.dumps(_python(x)) for x in uniques] + ['null'], dtype=object)
+    return encoded[codes] # missing values have the code -1
+
+def _encode_floats(values):
+    """ Floats as strings that read back exactly (15 significant digits if
+        they suffice, otherwise 17) and keep a decimal point
+
+    >>> _encode_floats(np.array([1/3., 0.1, 2., 1e20, np.nan])).tolist()
+    ['0.33333333333333331', '0.1', '2.0', '1e+20', 'null']
+    """
+    values = values.astype(np.float64)
+    finite = np.isfinite(values)
+    result = np.char.mod('%.15g', np.where(finite, values, 0))
+    inexact = finite & (result.astype(np.float64) != values)
+    result = result.astype('S%d' % max(result.dtype.itemsize + 2, 4)) # room for the digits, '.0' or 'null'
+    result[inexact] = np.char.mod('%.17g', values[inexact])
+
+    integral = ((np.char.find(result, '.') < 0) & (np.char.find(result, 'e') < 0))
+    result[integral] = np.char.add(result[integral], '.0')
+    result[~finite] = 'null'
+    return result
+
+def _as_objects(strings):
+    return strings.astype(object)
+
+def _python(x):
+    """ numpy scalars to python values (json does not know them) """
+    return x.item() if isinstance(x, np.generic) else x
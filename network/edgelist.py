@@ -0,0 +1,279 @@
+"""
+Columnar edge lists (Parquet, Feather or NPZ).
+
+Edges are stored as integer codes (i, j) into the label table and the
+weights (data). The label table is written once:
+
+    parquet: in the file metadata ('mypy.labels', a json list); the edges
+             are written one row group per chunk
+    feather: i and j are categorical columns whose categories are the labels
+    npz:     a separate 'labels' array
+
+Whether the edges were stored symmetric (once, with i <= j) is recorded
+along with them ('mypy.symmetric' in the parquet and feather metadata, a
+'symmetric' array in npz), so read() restores the matrix as written.
+
+Parquet and Feather require pyarrow (feather metadata requires pyarrow >=
+0.17).
+"""
+import os
+import json
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from .util import row_blocks, index_dtype
+from .storage import _encode_names
+
+FORMATS = ('parquet', 'feather', 'npz')
+COLUMNS = ('i', 'j', 'data')
+OPERATORS = ('==', '!=', '<', '<=', '>', '>=', 'in', 'not in')
+
+LABELS_KEY = b'mypy.labels'
+SYMMETRIC_KEY = b'mypy.symmetric'
+
+def write(m, labels, path, format=None, symmetric=True, chunk_size=1000000):
+    """ Store the edges of a csr_matrix.
+
+    Parameters:
+    -----------
+    m:          a csr_matrix
+    labels:     the node labels (a pandas.Index or an array)
+    path:       the file name
+    format:     'parquet', 'feather' or 'npz' (default: by the extension of path)
+    symmetric:  store only the edges (i, j) with i <= j
+    chunk_size: the number of matrix entries converted at once (and the
+                size of the parquet row groups)
+    """
+    format = _format(path, format)
+    m = csr_matrix(m)
+    if len(labels) != m.shape[0]:
+        raise ValueError("Number of labels does not match the matrix")
+
+    if format == 'parquet':
+        _write_parquet(m, labels, path, symmetric, chunk_size)
+        return
+
+    i, j, data = _collect(m, symmetric, chunk_size)
+    if format == 'npz':
+        with open(path, 'wb') as f: # savez would append .npz to other names
+            np.savez(f, i=i, j=j, data=data, labels=_encode_names(labels), symmetric=symmetric)
+    else:
+        labels = pd.Index(labels)
+        _write_feather(pd.DataFrame({'i': pd.Categorical.from_codes(i, labels),
+                                     'j': pd.Categorical.from_codes(j, labels),
+                                     'data': data}, columns=COLUMNS), path, symmetric)
+
+def read(path, format=None, min_weight=None, filters=None, symmetric=None):
+    """ Load edges stored with `write`.
+
+    Parameters:
+    -----------
+    path:       the file name
+    format:     'parquet', 'feather' or 'npz' (default: by the extension of path)
+    min_weight: load only the edges with data >= min_weight
+    filters:    more predicates, a list of (column, operator, value) tuples
+                that must all hold. The columns are 'i', 'j' (compared to
+                labels, with '==', '!=', 'in' or 'not in') and 'data'
+    symmetric:  add the reverse of every edge (default: as written, files
+                without the flag are taken as symmetric). The label filters
+                apply to the edges after they are mirrored, so they match
+                either endpoint of a stored edge
+
+    Parquet row groups are read one at a time and those whose weight
+    statistics rule out all the rows are skipped.
+
+    Returns a tuple (csr_matrix, pandas.Index of labels). Nodes whose edges
+    were all filtered out are kept.
+    """
+    format = _format(path, format)
+    filters = list(filters or [])
+    if min_weight is not None:
+        filters.append(('data', '>=', min_weight))
+    for column, op, value in filters:
+        if column not in COLUMNS or op not in OPERATORS:
+            raise ValueError("Unsupported filter %r" % ((column, op, value),))
+
+    if format == 'parquet':
+        labels, stored_symmetric, chunks = _read_parquet(path, filters)
+    elif format == 'npz':
+        with np.load(path, allow_pickle=True) as f:
+            labels = pd.Index(f['labels'])
+            stored_symmetric = bool(f['symmetric']) if 'symmetric' in f.files else True
+            chunks = [(f['i'], f['j'], f['data'])]
+    else:
+        df, stored_symmetric = _read_feather(path)
+        labels = pd.Index(df.i.cat.categories)
+        chunks = [(df.i.cat.codes.values, df.j.cat.codes.values, df.data.values)]
+
+    if symmetric is None:
+        symmetric = stored_symmetric
+
+    selected = [_select(chunk, labels, filters, symmetric) for chunk in chunks]
+    i, j, data = [np.concatenate(x) for x in zip(*selected)] if selected else [np.empty(0, dtype=np.int64)] * 3
+
+    n = len(labels)
+    idx_dtype = index_dtype(n, len(i))
+    m = csr_matrix((data, (i.astype(idx_dtype), j.astype(idx_dtype))), shape=(n, n))
+    return m, labels
+
+def _format(path, format):
+    if format is None:
+        format = os.path.splitext(path)[1].lstrip('.').lower()
+    if format not in FORMATS:
+        raise ValueError("Unknown edge list format %r (expected one of %s)" % (format, ', '.join(FORMATS)))
+    return format
+
+def _edges(m, symmetric, chunk_size):
+    """ The (i, j, data) of blocks of entries """
+    for i, j, data in row_blocks(m, chunk_size):
+        if symmetric:
+            mask = i <= j
+            i, j, data = i[mask], j[mask], data[mask]
+        yield i.astype(j.dtype), j, data
+
+def _collect(m, symmetric, chunk_size):
+    """ All the edges, filled chunk by chunk into preallocated arrays """
+    count = sum(len(x) for x, y, z in _edges(m, symmetric, chunk_size)) if symmetric else m.nnz
+
+    i = np.empty(count, dtype=m.indices.dtype)
+    j = np.empty(count, dtype=m.indices.dtype)
+    data = np.empty(count, dtype=m.dtype)
+    k = 0
+    for x, y, z in _edges(m, symmetric, chunk_size):
+        i[k:k + len(x)], j[k:k + len(x)], data[k:k + len(x)] = x, y, z
+        k += len(x)
+    return i, j, data
+
+def _select(chunk, labels, filters, symmetric):
+    """ The edges of a chunk that pass the filters: the weights are
+        filtered first, then (if symmetric) the edges are mirrored and the
+        labels are filtered """
+    i, j, data = _filter(chunk, labels, [x for x in filters if x[0] == 'data'])
+    if symmetric:
+        off_diagonal = i != j
+        i, j = np.concatenate((i, j[off_diagonal])), np.concatenate((j, i[off_diagonal]))
+        data = np.concatenate((data, data[off_diagonal]))
+    return _filter((i, j, data), labels, [x for x in filters if x[0] != 'data'])
+
+def _filter(chunk, labels, filters):
+    if not filters:
+        return chunk
+
+    i, j, data = chunk
+    mask = np.ones(len(i), dtype=bool)
+    for column, op, value in filters:
+        values = {'i': i, 'j': j, 'data': data}[column]
+        if column != 'data':
+            if op not in ('==', '!=', 'in', 'not in'):
+                raise ValueError("Labels can only be compared with ==, !=, in and not in")
+            value = labels.get_indexer([value] if op in ('==', '!=') else list(value))
+            op = 'in' if op in ('==', 'in') else 'not in'
+        mask &= _compare(values, op, value)
+
+    return i[mask], j[mask], data[mask]
+
+def _compare(values, op, value):
+    if op == 'in':
+        return np.in1d(values, value)
+    if op == 'not in':
+        return ~np.in1d(values, value)
+    return {'==': np.equal, '!=': np.not_equal, '<': np.less, '<=': np.less_equal,
+            '>': np.greater, '>=': np.greater_equal}[op](values, value)
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet edge lists require pyarrow")
+    return pyarrow, pyarrow.parquet
+
+def _encode_flag(value):
+    return b'true' if value else b'false'
+
+def _decode_flag(metadata, key, default):
+    """ A flag stored with _encode_flag in the (possibly missing) metadata """
+    if not metadata or key not in metadata:
+        return default
+    return metadata[key] == b'true'
+
+def _write_feather(df, path, symmetric):
+    pa, pq = _pyarrow()
+    import pyarrow.feather
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[SYMMETRIC_KEY] = _encode_flag(symmetric)
+    pyarrow.feather.write_feather(table.replace_schema_metadata(metadata), path)
+
+def _read_feather(path):
+    """ The DataFrame and the stored symmetric flag """
+    _pyarrow()
+    import pyarrow.feather
+
+    table = pyarrow.feather.read_table(path)
+    return table.to_pandas(), _decode_flag(table.schema.metadata, SYMMETRIC_KEY, True)
+
+def _write_parquet(m, labels, path, symmetric, chunk_size):
+    pa, pq = _pyarrow()
+
+    labels = json.dumps(pd.Index(labels).tolist())
+    schema = pa.schema([pa.field('i', pa.from_numpy_dtype(m.indices.dtype)),
+                        pa.field('j', pa.from_numpy_dtype(m.indices.dtype)),
+                        pa.field('data', pa.from_numpy_dtype(m.dtype))],
+                       metadata={LABELS_KEY: labels.encode('utf-8'),
+                                 SYMMETRIC_KEY: _encode_flag(symmetric)})
+
+    writer = pq.ParquetWriter(path, schema)
+    try:
+        for chunk in _edges(m, symmetric, chunk_size):
+            if len(chunk[0]):
+                writer.write_table(pa.Table.from_arrays([pa.array(x) for x in chunk], schema=schema))
+    finally:
+        writer.close()
+
+def _read_parquet(path, filters):
+    """ The labels, the stored symmetric flag and a generator of the
+        (i, j, data) of the row groups that may hold rows that pass the
+        filters """
+    pa, pq = _pyarrow()
+
+    f = pq.ParquetFile(path)
+    labels = pd.Index(json.loads(f.metadata.metadata[LABELS_KEY].decode('utf-8')))
+    symmetric = _decode_flag(f.metadata.metadata, SYMMETRIC_KEY, True)
+    bounds = [(op, value) for column, op, value in filters if column == 'data']
+
+    def chunks():
+        for k in range(f.metadata.num_row_groups):
+            if _skip(f.metadata.row_group(k), bounds):
+                continue
+            table = f.read_row_group(k, columns=list(COLUMNS))
+            yield tuple(table.column(name).to_pandas().values for name in COLUMNS)
+
+    return labels, symmetric, chunks()
+
+def _skip(row_group, bounds):
+    """ True if the statistics of the data column show that no row passes """
+    if not bounds:
+        return False
+
+    for c in range(row_group.num_columns):
+        column = row_group.column(c)
+        if column.path_in_schema == 'data':
+            statistics = column.statistics
+            break
+    else:
+        return False
+
+    if statistics is None or not statistics.has_min_max:
+        return False
+
+    low, high = statistics.min, statistics.max
+    for op, value in bounds:
+        if ((op in ('>', '>=') and (high < value or (op == '>' and high == value))) or
+            (op in ('<', '<=') and (low > value or (op == '<' and low == value))) or
+            (op == '==' and not low <= value <= high)):
+            return True
+    return False
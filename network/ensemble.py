@@ -0,0 +1,154 @@
+"""
+Compact storage for many degree-preserving shuffles of the same network.
+
+Shuffling swaps edges within rows and never changes indptr, so an ensemble
+keeps a single indptr and one row of `indices` (and of `data`, for weighted
+networks) per copy. Large ensembles can be spilled to memory-mapped files.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .util import as_index_dtype
+
+try:
+    import pyximport
+    pyximport.install()
+
+    from .shuffle import shuffle_ensemble as _shuffle_ensemble
+except:
+    import warnings
+    warnings.warn('Compilation with cython failed. Randomization will not work')
+
+class ShuffledEnsemble(object):
+    """ n degree-preserving shuffles of a network.
+
+    Parameters:
+    -----------
+    network:        a square matrix (converted to csr_matrix if needed)
+    n:              the number of shuffled copies
+    directed:       treat the network as directed (default: undirected)
+    max_iterations: the number of swaps per copy (default: 100 * nnz)
+    seed:           a seed for drawing the per-copy seeds (or a sequence of
+                    n per-copy seeds)
+    weighted:       keep per-copy edge weights. If False only the indices
+                    are stored and all copies share the weight of the first
+                    edge. Default: True if the edge weights differ
+    n_jobs:         the number of threads (default: all available)
+    path:           a directory for memory-mapped storage
+    max_memory:     spill to memory-mapped files (in `path`, or a temporary
+                    directory that is removed by close()) when the ensemble
+                    needs more than max_memory bytes
+    names:          node labels (a pandas.Series as in SparseGraph), copies
+                    are then returned as SparseGraphs
+    label_index:    the LabelIndex to share with these SparseGraphs
+
+    Examples:
+    ---------
+    >>> from numpy import array
+    >>> row, col = array([0, 1, 2, 3]), array([1, 2, 3, 4])
+    >>> g = csr_matrix((np.ones(4), (row, col)), shape=(5, 5))
+    >>> g = g + g.T
+    >>> e = ShuffledEnsemble(g, 3, seed=1)
+    >>> len(e), e.weighted
+    (3, False)
+    >>> all((x.sum(0) == g.sum(0)).all() for x in e) # degrees are preserved
+    True
+    >>> e[0].indptr is e[1].indptr
+    True
+    """
+
+    def __init__(self, network, n, directed=False, max_iterations=None, seed=None, weighted=None,
+                 n_jobs=None, path=None, max_memory=None, names=None, label_index=None):
+        m = csr_matrix(network)
+        if not m.has_canonical_format: # the shuffling expects sorted indices
+            m = m.copy()
+            m.sum_duplicates()
+        as_index_dtype(m) # int32 unless the network is too large
+
+        if max_iterations is None:
+            max_iterations = 100 * m.nnz
+
+        if weighted is None:
+            weighted = m.nnz > 0 and not np.all(m.data == m.data[0])
+
+        if np.isscalar(seed) or seed is None:
+            seed = np.random.RandomState(seed).randint(1, np.iinfo(np.int32).max, size=n)
+        elif len(seed) != n:
+            raise ValueError("Expected %d seeds" % n)
+
+        self.shape = m.shape
+        self.names = names
+        self.label_index = label_index
+        self.weighted = weighted
+        self.indptr = np.array(m.indptr) # a copy, the caller's indptr stays writeable
+        self.indptr.flags.writeable = False
+        self._tempdir = None
+
+        nbytes = n * m.nnz * (m.indices.itemsize + (8 if weighted else 0))
+        if path is None and max_memory is not None and nbytes > max_memory:
+            path = self._tempdir = tempfile.mkdtemp(prefix='ensemble')
+
+        self.indices = self._allocate(path, 'indices', (n, m.nnz), m.indices.dtype)
+        self.indices[:] = m.indices
+        if weighted:
+            self.data = self._allocate(path, 'data', (n, m.nnz), np.double)
+            self.data[:] = m.data
+            self._weight = None
+        else:
+            self.data = None
+            self._weight = np.empty(m.nnz, dtype=m.dtype if m.nnz else np.double)
+            self._weight[:] = m.data[0] if m.nnz else 0
+            self._weight.flags.writeable = False
+
+        _shuffle_ensemble(np.array(self.indptr), self.indices, self.data, directed,
+                          max_iterations, [int(x) for x in seed], n_jobs or 0)
+
+    @staticmethod
+    def _allocate(path, name, shape, dtype):
+        if path is None:
+            return np.empty(shape, dtype=dtype)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __getitem__(self, k):
+        """ The k-th copy, a csr_matrix (or a SparseGraph when names were
+            given) that shares its arrays with the ensemble """
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("ensemble index out of range")
+
+        data = self.data[k] if self.weighted else self._weight
+        m = csr_matrix((data, self.indices[k], self.indptr), shape=self.shape, copy=False)
+        m.has_sorted_indices = True
+
+        if self.names is None:
+            return m
+
+        from .sparse_graph import SparseGraph
+        return SparseGraph(m, self.names, self.label_index)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    @property
+    def nbytes(self):
+        """ Memory (or disk) used by the ensemble """
+        return self.indptr.nbytes + self.indices.nbytes + (self.data.nbytes if self.weighted else self._weight.nbytes)
+
+    def close(self):
+        """ Release the arrays (and remove the temporary spill directory, if any) """
+        self.indices = self.data = None
+        if self._tempdir is not None:
+            shutil.rmtree(self._tempdir, ignore_errors=True)
+            self._tempdir = None
@@ -2,14 +2,18 @@ cimport cython
 cimport numpy as np 
 import numpy as np 
 
+ctypedef fused ITYPE_f:
+    np.int32_t
+    np.int64_t
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
-cdef void _bin_sort(long[::1] bin, 
-                    int[::1] deg, 
-                    int[::1] pos, 
-                    int[::1] vert) nogil:
-    cdef int v
+cdef void _bin_sort(np.int64_t[::1] bin, 
+                    ITYPE_f[::1] deg, 
+                    ITYPE_f[::1] pos, 
+                    ITYPE_f[::1] vert) nogil:
+    cdef ITYPE_f v
 
     for v in range(deg.shape[0]):
         pos[v] = bin[deg[v]]
@@ -19,13 +23,14 @@ cdef void _bin_sort(long[::1] bin,
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
-cdef void _cores(int[::1] indptr, 
-                 int[::1] indices,
-                 long[::1] bin,
-                 int[::1] deg,
-                 int[::1] pos,
-                 int[::1] vert) nogil:
-    cdef int d, v, j, u, du, pu, w, dw, pw
+cdef void _cores(ITYPE_f[::1] indptr, 
+                 ITYPE_f[::1] indices,
+                 np.int64_t[::1] bin,
+                 ITYPE_f[::1] deg,
+                 ITYPE_f[::1] pos,
+                 ITYPE_f[::1] vert) nogil:
+    cdef ITYPE_f v, j, u, du, pu, w, pw
+    cdef np.int64_t d, i
 
     # restore bin
     for d in range(bin.shape[0]-1, 0, -1):
@@ -50,23 +55,216 @@ cdef void _cores(int[::1] indptr,
                 bin[du] += 1
                 deg[u] -= 1
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef inline void _bucket_decrement(ITYPE_f f,
+                                   ITYPE_f[::1] value,
+                                   np.int64_t[::1] bin,
+                                   ITYPE_f[::1] pos,
+                                   ITYPE_f[::1] vert) nogil:
+    """ value[f] -= 1, keeping vert sorted by value (f moves to the front of its bin) """
+    cdef ITYPE_f df = value[f]
+    cdef ITYPE_f pf = pos[f]
+    cdef ITYPE_f pw = bin[df]
+    cdef ITYPE_f w = vert[pw]
+    if w != f:
+        pos[f] = pw
+        vert[pf] = w
+        pos[w] = pf
+        vert[pw] = f
+    bin[df] += 1
+    value[f] -= 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef void _support(ITYPE_f[::1] indptr,
+                   ITYPE_f[::1] indices,
+                   ITYPE_f[::1] eu,
+                   ITYPE_f[::1] ev,
+                   ITYPE_f[::1] sup) nogil:
+    """ The number of triangles of each edge (sorted-row intersections) """
+    cdef ITYPE_f e, a, b, a_end, b_end, count
+
+    for e in range(eu.shape[0]):
+        a, a_end = indptr[eu[e]], indptr[eu[e]+1]
+        b, b_end = indptr[ev[e]], indptr[ev[e]+1]
+        count = 0
+        while a < a_end and b < b_end:
+            if indices[a] < indices[b]:
+                a += 1
+            elif indices[a] > indices[b]:
+                b += 1
+            else:
+                count += 1
+                a += 1
+                b += 1
+        sup[e] = count
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef void _truss(ITYPE_f[::1] indptr,
+                 ITYPE_f[::1] indices,
+                 ITYPE_f[::1] edge,
+                 ITYPE_f[::1] eu,
+                 ITYPE_f[::1] ev,
+                 np.int64_t[::1] bin,
+                 ITYPE_f[::1] sup,
+                 ITYPE_f[::1] pos,
+                 ITYPE_f[::1] vert,
+                 np.uint8_t[::1] removed) nogil:
+    """ Peel edges by increasing support, sup ends as the truss number - 2 """
+    cdef ITYPE_f i, e, a, b, a_end, b_end, ea, eb
+    cdef np.int64_t d
+
+    # restore bin
+    for d in range(bin.shape[0]-1, 0, -1):
+        bin[d] = bin[d-1]
+    bin[0] = 0
+
+    for i in range(vert.shape[0]):
+        e = vert[i]
+        a, a_end = indptr[eu[e]], indptr[eu[e]+1]
+        b, b_end = indptr[ev[e]], indptr[ev[e]+1]
+        while a < a_end and b < b_end:
+            if indices[a] < indices[b]:
+                a += 1
+            elif indices[a] > indices[b]:
+                b += 1
+            else:
+                ea = edge[a]
+                eb = edge[b]
+                if not removed[ea] and not removed[eb]:
+                    if sup[ea] > sup[e]:
+                        _bucket_decrement(ea, sup, bin, pos, vert)
+                    if sup[eb] > sup[e]:
+                        _bucket_decrement(eb, sup, bin, pos, vert)
+                a += 1
+                b += 1
+        removed[e] = 1
+
+def _undirected(g):
+    """ A csr_matrix with sorted indices and no self loops, with index arrays
+        of the same dtype (int32 unless the graph is too large) """
+    from scipy.sparse import csr_matrix
+    from .util import as_index_dtype
+
+    g = csr_matrix(g)
+    rows = np.repeat(np.arange(g.shape[0]), np.diff(g.indptr))
+    loops = rows == g.indices
+    if not g.has_canonical_format or loops.any():
+        g = g.copy()
+        g.data[loops] = 0
+        g.eliminate_zeros()
+        g.sum_duplicates()
+    return as_index_dtype(csr_matrix((g.data, g.indices, g.indptr), shape=g.shape))
+
+def _first_positions(values):
+    """ Starting positions of the (bin) sort of non-negative integers """
+    counts = np.bincount(values)
+    bin = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=bin[1:])
+    return bin
+
 def k_cores(g):
     """ Find the k-core number of all vertices 
 
     Based on the paper:
     Vladimir Batagelj, Matjaz Zaversnik: An O(m) Algorithm for Cores Decomposition of Networks. 
 
+    The graph is treated as undirected (g should be symmetric), self loops
+    are ignored. Returns an array with the core number of each node (of the
+    index dtype of g, int32 unless the graph is very large).
+
+    >>> from scipy.sparse import csr_matrix
+    >>> g = csr_matrix((np.ones(8), ([0, 0, 1, 1, 2, 2, 3, 3], [1, 2, 0, 2, 0, 1, 3, 2])), shape=(5, 5))
+    >>> k_cores(g + g.T)
+    array([2, 2, 2, 1, 0], dtype=int32)
     """
+    g = _undirected(g)
     n = g.shape[0]
+    if n == 0:
+        return np.empty(0, dtype=g.indptr.dtype)
 
     deg = np.diff(g.indptr)
-    md = np.max(deg)
-    bin = np.cumsum(np.bincount(deg))
+    bin = _first_positions(deg)
     
-    pos = np.empty(n, dtype=np.int32)
-    vert = np.empty(n, dtype=np.int32)
+    pos = np.empty(n, dtype=deg.dtype)
+    vert = np.empty(n, dtype=deg.dtype)
 
-    _bin_sort(bin, deg, pos, vert)
-    _cores(g.indptr, g.indices, bin, deg, pos, vert)
+    _k_cores(g.indptr, g.indices, bin, deg, pos, vert)
 
     return deg
+
+def _k_cores(ITYPE_f[::1] indptr, ITYPE_f[::1] indices, np.int64_t[::1] bin,
+             ITYPE_f[::1] deg, ITYPE_f[::1] pos, ITYPE_f[::1] vert):
+    with nogil:
+        _bin_sort(bin, deg, pos, vert)
+        _cores(indptr, indices, bin, deg, pos, vert)
+
+def k_truss(g):
+    """ The truss number of every edge: the largest k such that the edge
+    belongs to the k-truss, the maximal subgraph in which every edge is in
+    at least k-2 triangles. Computed by peeling edges in order of support
+    (the number of triangles), as in the core decomposition.
+
+    g must be symmetric, self loops are ignored. Returns a csr_matrix with the
+    pattern of g (without self loops) and the truss numbers as data.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> i, j = [0, 0, 0, 1, 1, 2, 3], [1, 2, 3, 2, 3, 3, 4] # K4 and a pendant edge
+    >>> g = csr_matrix((np.ones(7), (i, j)), shape=(5, 5))
+    >>> k_truss(g + g.T).toarray()
+    array([[0, 4, 4, 4, 0],
+           [4, 0, 4, 4, 0],
+           [4, 4, 0, 4, 0],
+           [4, 4, 4, 0, 2],
+           [0, 0, 0, 2, 0]], dtype=int32)
+    """
+    from scipy.sparse import csr_matrix
+
+    g = _undirected(g)
+    n = g.shape[0]
+    idx_dtype = g.indptr.dtype
+
+    rows = np.repeat(np.arange(n, dtype=idx_dtype), np.diff(g.indptr))
+    upper = rows < g.indices
+    eu, ev = rows[upper], g.indices[upper]
+    m = len(eu)
+
+    # every entry (u, v) refers to the undirected edge min(u,v)-max(u,v)
+    edge = np.empty(g.nnz, dtype=idx_dtype)
+    edge[upper] = np.arange(m, dtype=idx_dtype)
+    keys = eu.astype(np.int64) * n + ev
+    mirror = g.indices[~upper].astype(np.int64) * n + rows[~upper]
+    found = np.searchsorted(keys, mirror)
+    if m * 2 != g.nnz or (len(mirror) and (found.max() >= m or (keys[found] != mirror).any())):
+        raise ValueError("k_truss expects a symmetric graph")
+    edge[~upper] = found
+
+    sup = np.empty(m, dtype=idx_dtype)
+    if m > 0:
+        _k_truss(g.indptr, g.indices, edge, eu, ev, sup)
+
+    return csr_matrix(((sup + 2)[edge], g.indices, g.indptr), shape=g.shape)
+
+def _k_truss(ITYPE_f[::1] indptr, ITYPE_f[::1] indices, ITYPE_f[::1] edge,
+             ITYPE_f[::1] eu, ITYPE_f[::1] ev, ITYPE_f[::1] sup):
+    with nogil:
+        _support(indptr, indices, eu, ev, sup)
+
+    bin = _first_positions(np.asarray(sup))
+    pos = np.empty(len(sup), dtype=np.asarray(sup).dtype)
+    vert = np.empty(len(sup), dtype=np.asarray(sup).dtype)
+    removed = np.zeros(len(sup), dtype=np.uint8)
+
+    cdef np.int64_t[::1] bin_view = bin
+    cdef ITYPE_f[::1] pos_view = pos
+    cdef ITYPE_f[::1] vert_view = vert
+    cdef np.uint8_t[::1] removed_view = removed
+
+    with nogil:
+        _bin_sort(bin_view, sup, pos_view, vert_view)
+        _truss(indptr, indices, edge, eu, ev, bin_view, sup, pos_view, vert_view, removed_view)
@@ -0,0 +1,188 @@
+"""
+A label-to-id index for SparseGraph. Resolves node labels to matrix
+rows/columns (and edge weights) in a single vectorized pass.
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse.sparsetools as spt
+
+class LabelIndex(object):
+    """ Maps node labels to their row/column id in the adjacency matrix.
+
+    The hash table is built once (lazily, on the first lookup) and the index
+    is immutable, so it can be shared by all graphs with the same labels.
+
+    Missing labels are handled according to the `missing` policy:
+
+        'raise': raise a KeyError (the default)
+        'mask':  return a numpy.ma.MaskedArray in which missing entries are masked
+        integer: replace the ids of missing labels with this value (e.g. -1).
+                 edge_weights and has_edges report such pairs as absent.
+
+    Examples:
+    ---------
+    >>> from scipy.sparse import csr_matrix
+    >>> index = LabelIndex(['a', 'b', 'c'])
+    >>> index.lookup(['c', 'a'])
+    array([2, 0])
+    >>> index.lookup(['c', 'x'], missing=-1)
+    array([ 2, -1])
+    >>> index.lookup(['c', 'x'], missing='mask')
+    masked_array(data = [2 --],
+                 mask = [False  True],
+           fill_value = 999999)
+    <BLANKLINE>
+    >>> m = csr_matrix(([1., 2.], ([0, 1], [1, 2])), shape=(3, 3))
+    >>> index.edge_weights(m, ['a', 'b', 'a'], ['b', 'c', 'c'])
+    array([ 1.,  2.,  0.])
+    >>> index.has_edges(m, ['a', 'x'], ['b', 'c'], missing=-1)
+    array([ True, False], dtype=bool)
+    """
+
+    def __init__(self, labels):
+        self.labels = labels if isinstance(labels, pd.Index) else pd.Index(labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self.labels
+
+    def positions(self, labels):
+        """ Returns the ids of labels, -1 for labels that are not indexed """
+        if np.isscalar(labels):
+            labels = [labels]
+        return self.labels.get_indexer(labels)
+
+    def lookup(self, labels, missing='raise'):
+        """ Returns the ids of labels (an array of ints) """
+        if np.isscalar(labels):
+            labels = [labels]
+        ids = self.positions(labels)
+        absent = ids < 0
+        if not absent.any():
+            return ids
+
+        if missing == 'raise':
+            raise KeyError('labels not in graph: %s' % _describe(labels, absent))
+        if missing == 'mask':
+            return np.ma.masked_array(ids, mask=absent)
+
+        ids[absent] = _fill_value(missing)
+        return ids
+
+    def edge_weights(self, m, i_labels, j_labels, missing='raise'):
+        """ Returns the weights m[i, j] for each pair of labels (0 for non-edges)
+
+        Parameters:
+        -----------
+        m: the csr_matrix holding the weights (rows/columns ordered as the index)
+        i_labels, j_labels: equal-length sequences of labels
+        missing: the policy for labels that are not in the index
+        """
+        i = self.positions(i_labels)
+        j = self.positions(j_labels)
+        if i.shape != j.shape:
+            raise ValueError('i_labels and j_labels must have the same length')
+
+        absent = (i < 0) | (j < 0)
+        if absent.any():
+            if missing == 'raise':
+                labels = np.concatenate((np.asarray(i_labels, dtype=object)[i < 0],
+                                         np.asarray(j_labels, dtype=object)[j < 0]))
+                raise KeyError('labels not in graph: %s' % _describe(labels, None))
+            if missing != 'mask':
+                _fill_value(missing)
+            i[absent] = 0
+            j[absent] = 0
+
+        weights = _sample_values(m, i, j)
+        weights[absent] = 0
+
+        if missing == 'mask':
+            return np.ma.masked_array(weights, mask=absent)
+        return weights
+
+    def has_edges(self, m, i_labels, j_labels, missing='raise'):
+        """ Returns a boolean array, True where m[i, j] is non-zero """
+        weights = self.edge_weights(m, i_labels, j_labels, missing=missing)
+        return weights != 0
+
+    def take(self, ids):
+        """ Returns the labels of ids """
+        return self.labels.values[ids]
+
+    def subset(self, ids):
+        """ An index of the labels of ids (which must be unique) that
+            resolves labels through this index rather than building a new
+            hash table
+
+        >>> index = LabelIndex(['a', 'b', 'c', 'd']).subset([3, 1])
+        >>> index.lookup(['b', 'd']), 'a' in index, len(index)
+        (array([1, 0]), False, 2)
+        """
+        return SubsetLabelIndex(self, ids)
+
+class SubsetLabelIndex(LabelIndex):
+    """ The labels of some of the ids of a parent LabelIndex (e.g., of the
+        nodes of a subgraph), numbered in the order of ids. The parent's
+        hash table is shared, the subset only keeps the sorted ids. """
+
+    def __init__(self, parent, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if isinstance(parent, SubsetLabelIndex): # an index of the root
+            parent, ids = parent.parent, parent.ids[ids]
+
+        self.parent = parent
+        self.ids = ids
+        self._order = np.argsort(ids, kind='mergesort')
+        self._sorted = ids[self._order]
+        self._labels = None
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = self.parent.labels[self.ids]
+        return self._labels
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, label):
+        return self.positions([label])[0] >= 0
+
+    def positions(self, labels):
+        ids = self.parent.positions(labels)
+        if len(self.ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+
+        k = np.minimum(np.searchsorted(self._sorted, ids), len(self.ids) - 1)
+        found = (ids >= 0) & (self._sorted[k] == ids)
+        return np.where(found, self._order[k], -1)
+
+    def take(self, ids):
+        return self.parent.take(self.ids[ids])
+
+def _sample_values(m, i, j):
+    """ Vectorized m[i, j] for a csr_matrix """
+    idx_dtype = m.indptr.dtype
+    i = np.asarray(i, dtype=idx_dtype)
+    j = np.asarray(j, dtype=idx_dtype)
+    result = np.zeros(len(i), dtype=m.dtype)
+    spt.csr_sample_values(m.shape[0], m.shape[1], m.indptr, m.indices, m.data,
+                          len(i), i, j, result)
+    return result
+
+def _fill_value(missing):
+    if isinstance(missing, (int, np.integer)) and not isinstance(missing, bool):
+        return missing
+    raise ValueError("missing must be 'raise', 'mask' or an integer, got %r" % (missing,))
+
+def _describe(labels, absent, limit=5):
+    labels = np.asarray(labels, dtype=object)
+    if absent is not None:
+        labels = labels[absent]
+    text = ', '.join(repr(x) for x in labels[:limit])
+    if len(labels) > limit:
+        text += ', ... (%d in total)' % len(labels)
+    return text
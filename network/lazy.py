@@ -0,0 +1,210 @@
+"""
+Lazy evaluation of elementwise SparseGraph arithmetic.
+
+A LazyGraph records the operations applied to a graph instead of running
+them. Operations that keep the sparsity pattern (ufuncs with f(0) == 0,
+products with scalars, comparisons that are False at 0, and elementwise
+operations between graphs with the same pattern) are fused: compute()
+evaluates the whole chain in a single pass over `data`, in chunks, so no
+intermediate matrices are allocated. Operations that change the pattern
+(e.g., the union in g + h for different patterns, or the matrix product
+g * h) materialize their operands and continue from the result.
+"""
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .sparse_graph import SparseGraph
+
+CHUNK_SIZE = 65536
+
+class LazyGraph(object):
+    """ A deferred SparseGraph expression, see SparseGraph.lazy()
+
+    Examples:
+    ---------
+    >>> g = SparseGraph.from_indices(['a', 'b', 'c'], ['b', 'c', 'd'], [0.2, 0.5, 1.])
+    >>> h = SparseGraph.from_indices(['a'], ['c'], [1.], names=g.names)
+    >>> fused = ((g.lazy() > 0.4).multiply(g)).log1p() * 2
+    >>> fused.pending # one pass over data
+    4
+    >>> result = (fused + h).compute() # the union materializes both sides
+    >>> eager = ((g > 0.4).multiply(g)).log1p() * 2 + h
+    >>> np.allclose(result.to_frame(), eager.to_frame())
+    True
+    >>> result.to_frame().round(3)
+         a      b      c      d
+    a  0.0  0.000  1.000  0.000
+    b  0.0  0.000  0.811  0.000
+    c  1.0  0.811  0.000  1.386
+    d  0.0  0.000  1.386  0.000
+    """
+    __array_priority__ = 10.1 # numpy scalars defer to our operators (as in scipy.sparse)
+
+    def __init__(self, graph, expr=None, pending=0, pattern=None):
+        """ graph: the SparseGraph that supplies the labels (and the pattern),
+            expr: the expression over data arrays aligned with the pattern,
+            pattern: the (indptr, indices, shape) the expression follows
+            (default: those of graph.data when the LazyGraph is created, so
+            later reassignments of graph.data do not change the result)
+
+        >>> g = SparseGraph.from_indices(['a', 'b'], ['b', 'c'], [1., 2.])
+        >>> l = g.lazy() * 2
+        >>> g.data = g.data[:, [2, 1, 0]] # another pattern
+        >>> l.compute().to_frame()
+             a    b    c
+        a  0.0  2.0  0.0
+        b  2.0  0.0  4.0
+        c  0.0  4.0  0.0
+        """
+        if expr is None:
+            m = graph.data
+            if not m.has_canonical_format: # as scipy, combine duplicates first
+                m = m.copy()
+                m.sum_duplicates()
+            expr = ('leaf', m.data)
+            pattern = (m.indptr, m.indices, m.shape)
+
+        self.graph = graph
+        self.pattern = pattern
+        self.expr = expr
+        self.pending = pending # the number of fused operations
+
+    def compute(self, chunk_size=CHUNK_SIZE):
+        """ Evaluate the expression. Explicit zeros (e.g., False entries of
+            comparisons) are removed from the result. """
+        indptr, indices, shape = self.pattern
+        nnz = indptr[-1]
+        first = _evaluate(self.expr, 0, min(chunk_size, nnz))
+        data = np.empty(nnz, dtype=first.dtype)
+        data[:len(first)] = first
+        for lo in range(chunk_size, nnz, chunk_size):
+            hi = min(lo + chunk_size, nnz)
+            data[lo:hi] = _evaluate(self.expr, lo, hi)
+
+        result = csr_matrix((data, indices.copy(), indptr.copy()), shape=shape)
+        result.eliminate_zeros()
+        return SparseGraph(result, self.graph.names, self.graph.label_index)
+
+    def _fused(self, expr):
+        return LazyGraph(self.graph, expr, self.pending + 1, self.pattern)
+
+    def _same_pattern(self, other):
+        (a_indptr, a_indices, a_shape), (b_indptr, b_indices, b_shape) = self.pattern, other.pattern
+        if a_indptr is b_indptr and a_indices is b_indices:
+            return True
+        return (a_shape == b_shape and len(a_indices) == len(b_indices) and
+                np.array_equal(a_indptr, b_indptr) and np.array_equal(a_indices, b_indices))
+
+    def _eager(self, name, *args):
+        """ Materialize the operands and run the SparseGraph operation """
+        args = [x.compute() if isinstance(x, LazyGraph) else x for x in args]
+        result = getattr(self.compute(), name)(*args)
+        return LazyGraph(result) if isinstance(result, SparseGraph) else result
+
+    def _binary(self, name, ufunc, other, zero_safe=True, scalar_zero_safe=None):
+        """ Fuse ufunc(self, other) if the result keeps the pattern of self:
+            for graphs, the same pattern (and ufunc(0, 0) == 0); for
+            scalars, scalar_zero_safe(other) (None: not fusable) """
+        if isinstance(other, SparseGraph):
+            other = LazyGraph(other)
+
+        if isinstance(other, LazyGraph):
+            if zero_safe and self._same_pattern(other):
+                return self._fused(('binary', ufunc, self.expr, other.expr))
+            return self._eager(name, other)
+
+        if np.isscalar(other) and scalar_zero_safe is not None and scalar_zero_safe(other):
+            return self._fused(('scalar', ufunc, self.expr, other))
+
+        return self._eager(name, other)
+
+    def _unary(self, ufunc):
+        return self._fused(('unary', ufunc, self.expr))
+
+    # the pattern of a sum (difference) of graphs is the union of theirs
+    def __add__(self, other):
+        return self._binary('__add__', np.add, other)
+
+    def __radd__(self, other):
+        return self._binary('__radd__', np.add, other)
+
+    def __sub__(self, other):
+        return self._binary('__sub__', np.subtract, other)
+
+    def __rsub__(self, other):
+        if isinstance(other, (SparseGraph, LazyGraph)):
+            return _lazy(other) - self
+        return self._eager('__rsub__', other)
+
+    # a product of graphs is a matrix product (as SparseGraph.__mul__)
+    def __mul__(self, other):
+        return self._binary('__mul__', np.multiply, other, zero_safe=False, scalar_zero_safe=_always)
+
+    def __rmul__(self, other):
+        if isinstance(other, (SparseGraph, LazyGraph)):
+            return _lazy(other) * self
+        return self._binary('__rmul__', np.multiply, other, zero_safe=False, scalar_zero_safe=_always)
+
+    def multiply(self, other):
+        """ Elementwise product (the intersection of the patterns) """
+        return self._binary('multiply', np.multiply, other, scalar_zero_safe=_always)
+
+    def maximum(self, other):
+        return self._binary('maximum', np.maximum, other, scalar_zero_safe=lambda x: x <= 0)
+
+    def minimum(self, other):
+        return self._binary('minimum', np.minimum, other, scalar_zero_safe=lambda x: x >= 0)
+
+    # comparisons are fused when they are False at 0
+    def __gt__(self, other):
+        return self._binary('__gt__', np.greater, other, scalar_zero_safe=lambda x: x >= 0)
+
+    def __lt__(self, other):
+        return self._binary('__lt__', np.less, other, scalar_zero_safe=lambda x: x <= 0)
+
+    def __ne__(self, other):
+        return self._binary('__ne__', np.not_equal, other, scalar_zero_safe=lambda x: x == 0)
+
+    def __ge__(self, other):
+        return self._binary('__ge__', np.greater_equal, other, zero_safe=False, scalar_zero_safe=lambda x: x > 0)
+
+    def __le__(self, other):
+        return self._binary('__le__', np.less_equal, other, zero_safe=False, scalar_zero_safe=lambda x: x < 0)
+
+    def __eq__(self, other):
+        return self._binary('__eq__', np.equal, other, zero_safe=False, scalar_zero_safe=lambda x: x != 0)
+
+    def __abs__(self):
+        return self._unary(np.absolute)
+
+def _always(x):
+    return True
+
+def _lazy(x):
+    return x if isinstance(x, LazyGraph) else LazyGraph(x)
+
+def _evaluate(expr, lo, hi):
+    """ The values of expr for the entries lo:hi of the pattern """
+    kind = expr[0]
+    if kind == 'leaf':
+        return expr[1][lo:hi]
+    if kind == 'unary':
+        return expr[1](_evaluate(expr[2], lo, hi))
+    if kind == 'scalar':
+        return expr[1](_evaluate(expr[2], lo, hi), expr[3])
+    return expr[1](_evaluate(expr[2], lo, hi), _evaluate(expr[3], lo, hi))
+
+def _add_unary_methods():
+    """ The zero-preserving ufuncs that SparseGraph applies to data """
+    for name, ufunc in [('arcsin', np.arcsin), ('arcsinh', np.arcsinh), ('arctan', np.arctan),
+                        ('arctanh', np.arctanh), ('ceil', np.ceil), ('conj', np.conjugate),
+                        ('conjugate', np.conjugate), ('expm1', np.expm1), ('floor', np.floor),
+                        ('log1p', np.log1p), ('rad2deg', np.rad2deg), ('rint', np.rint),
+                        ('sign', np.sign), ('sin', np.sin), ('sinh', np.sinh), ('sqrt', np.sqrt),
+                        ('tan', np.tan), ('tanh', np.tanh), ('trunc', np.trunc)]:
+        def method(self, ufunc=ufunc):
+            return self._unary(ufunc)
+        method.__name__ = name
+        setattr(LazyGraph, name, method)
+
+_add_unary_methods()
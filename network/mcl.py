@@ -1,6 +1,11 @@
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 import scipy.sparse as sparse
 import scipy.sparse.sparsetools as spt
+from scipy.sparse.csgraph import connected_components
 
 def _csr_scale_columns(m, scale):
     spt.csr_scale_columns(m.shape[0], m.shape[1], m.indptr, m.indices, m.data, scale)
@@ -14,6 +19,14 @@ def _csr_normalize_columns(m):
 
     return m
 
+def _csc_normalize_columns(m):
+    factor = np.asarray(m.sum(0), dtype=np.double).ravel()
+    nnzeros = factor > 0
+    factor[nnzeros] = 1.0 / factor[nnzeros]
+    m.data *= np.repeat(factor, np.diff(m.indptr))
+
+    return m
+
 def prepare(m, add_self_loops=True):
     if add_self_loops:
         entries = m.max(1).todense()
@@ -25,32 +38,365 @@ def prepare(m, add_self_loops=True):
     return _csr_normalize_columns(m + d)
 
 def interpret(M):
-    clusters = np.asarray(np.where(M.sum(1) > 0)[0]).squeeze(0)
+    clusters = np.flatnonzero(np.asarray(M.sum(1)).ravel() > 0)
     return [M.indices[M.indptr[c]:M.indptr[c+1]] for c in clusters]
 
-def mcl(m, expansion=2.0, inflation=2.0, threshold=1e-6, add_self_loops=True, cap=0.001, max_iterations=-1, should_interpret=True):
-    M = prepare(m, add_self_loops=add_self_loops)
+def _column_ranks(m):
+    """ The rank (0 for the largest) of every entry of a csc_matrix within its column """
+    cols = np.repeat(np.arange(m.shape[1]), np.diff(m.indptr))
+    order = np.lexsort((-m.data, cols))
+    ranks = np.empty(m.nnz, dtype=np.int64)
+    ranks[order] = np.arange(m.nnz) - m.indptr[cols[order]]
+    return cols, ranks
+
+def prune(m, cap=0.001, select=None, recover=None, recover_pct=0.9):
+    """ Column-wise pruning of a csc_matrix (in the style of the mcl tool).
+
+    Parameters:
+    -----------
+    m:           a csc_matrix (modified in-place)
+    cap:         remove entries smaller than cap (None to skip)
+    select:      keep at most the `select` largest entries of each column
+    recover:     for columns that lost more than 1-recover_pct of their mass
+                 to `cap`, recover the largest pruned entries until the
+                 column has `recover` entries
+    recover_pct: see recover
+
+    Returns m
+
+    Examples:
+    ---------
+    >>> m = sparse.csc_matrix(np.array([[.5, .0005], [.3, .0003], [.2, .0002]]))
+    >>> prune(m.copy(), cap=0.001).toarray()
+    array([[ 0.5,  0. ],
+           [ 0.3,  0. ],
+           [ 0.2,  0. ]])
+    >>> prune(m.copy(), cap=0.001, select=2, recover=1).toarray()
+    array([[ 0.5   ,  0.0005],
+           [ 0.3   ,  0.    ],
+           [ 0.    ,  0.    ]])
+    """
+    if m.nnz == 0 or (cap is None and select is None):
+        return m
+
+    keep = m.data >= cap if cap is not None else np.ones(m.nnz, dtype=bool)
+
+    if select is not None or (recover is not None and cap is not None):
+        cols, ranks = _column_ranks(m)
+
+        if recover is not None and cap is not None:
+            mass = np.bincount(cols, m.data, minlength=m.shape[1])
+            kept_mass = np.bincount(cols, m.data * keep, minlength=m.shape[1])
+            kept = np.bincount(cols, keep, minlength=m.shape[1])
+            recovering = (kept_mass < recover_pct * mass) & (kept < recover)
+            keep |= recovering[cols] & (ranks < recover)
+
+        if select is not None:
+            # pruning keeps the largest entries, so ranks are also ranks among those kept
+            keep &= ranks < select
+
+    if not keep.all():
+        m.data[~keep] = 0
+        m.eliminate_zeros()
+
+    return m
+
+def _stats(iteration, m, before):
+    return {'iteration': iteration,
+            'nnz': m.nnz,
+            'expanded_nnz': before,
+            'max_column_nnz': int(np.diff(m.indptr).max()) if m.shape[1] else 0,
+            'chaos': chaos(m),
+            'bytes': m.data.nbytes + m.indices.nbytes + m.indptr.nbytes}
+
+def expand(M, expansion=2, block_size=None, inflation=None, **kwargs):
+    """ M**expansion, computed block_size columns at a time. Each block is
+        inflated (entries raised to the power `inflation`, if given) and
+        pruned (see prune) before the next one is expanded, so only the
+        unpruned fill-in of one block is held in memory.
+
+    Returns the expanded csc_matrix and its nnz before pruning
+    """
+    if expansion != int(expansion) or expansion < 1:
+        raise ValueError("expansion must be a positive integer")
+
+    if block_size is None:
+        block_size = max(M.shape[1], 1)
+
+    blocks = []
+    expanded_nnz = 0
+    for start in range(0, M.shape[1], block_size):
+        B = M[:, start:start+block_size]
+        for _ in range(int(expansion) - 1):
+            B = (M * B).tocsc()
+        expanded_nnz += B.nnz
+        if inflation is not None:
+            B.data **= inflation
+        blocks.append(prune(B, **kwargs))
+
+    if len(blocks) == 1:
+        return blocks[0], expanded_nnz
+
+    return sparse.hstack(blocks, format='csc'), expanded_nnz
+
+def mcl(m, expansion=2.0, inflation=2.0, threshold=1e-6, add_self_loops=True, cap=0.001, max_iterations=-1,
+        should_interpret=True, select=None, recover=None, recover_pct=0.9, block_size=None, return_stats=False,
+        n_jobs=1, batch_nodes=2000, convergence='difference'):
+    """ Markov Cluster.
+
+    Parameters:
+    -----------
+    m:              the adjacency matrix
+    expansion:      the (integer) power of the expansion step
+    inflation:      the power of the inflation step
+    threshold:      stop when no entry changes by more than threshold
+    add_self_loops: add self loops (with the maximal weight of each node)
+    cap:            prune entries smaller than cap after each expansion
+    max_iterations: the maximum number of iterations (negative for no limit)
+    should_interpret: return the clusters rather than the final matrix
+    select:         keep at most `select` entries per column (the largest),
+                    which bounds the nnz of the matrix by select * n
+    recover:        recover pruned entries of columns that lost too much of
+                    their mass, see prune
+    recover_pct:    see prune
+    block_size:     expand this many columns at a time, bounding the memory of
+                    the intermediate (unpruned) product. Default: all columns
+    return_stats:   also return a list with the nnz and memory (bytes) of the
+                    matrix after each iteration (and its nnz before pruning)
+    n_jobs:         if not 1, cluster the connected components separately in
+                    a pool of n_jobs processes (all cpus if not positive).
+                    MCL never merges components, so the clusters are the same
+                    as those of a single run
+    batch_nodes:    components smaller than this are batched together (into
+                    batches of about batch_nodes nodes), larger ones are
+                    clustered on their own
+    convergence:    'difference' (the default) or 'chaos', see iterate
+
+    Examples:
+    ---------
+    >>> i, j = [0, 0, 1, 2, 3, 3, 4], [1, 2, 2, 3, 4, 5, 5] # two triangles
+    >>> m = sparse.csr_matrix((np.ones(7), (i, j)), shape=(6, 6))
+    >>> m = m + m.T
+    >>> [list(c) for c in mcl(m, select=3)]
+    [[0, 1, 2], [3, 4, 5]]
+    >>> clusters, stats = mcl(m, block_size=2, return_stats=True)
+    >>> sorted(stats[0].keys())
+    ['bytes', 'chaos', 'expanded_nnz', 'iteration', 'max_column_nnz', 'nnz']
+    >>> [list(c) for c in mcl(m, n_jobs=2, batch_nodes=2)]
+    [[0, 1, 2], [3, 4, 5]]
+    >>> [list(c) for c in mcl(m, convergence='chaos')]
+    [[0, 1, 2], [3, 4, 5]]
+    """
+    if n_jobs != 1 and m.shape[0] > 0:
+        params = {'expansion': expansion, 'inflation': inflation, 'threshold': threshold,
+                  'add_self_loops': add_self_loops, 'cap': cap, 'max_iterations': max_iterations,
+                  'select': select, 'recover': recover, 'recover_pct': recover_pct, 'block_size': block_size,
+                  'convergence': convergence}
+        M, stats = _mcl_components(m, n_jobs, batch_nodes, params)
+        result = interpret(M) if should_interpret else M
+        if return_stats:
+            return result, stats
+        return result
+
+    M = prepare(m, add_self_loops=add_self_loops).tocsc()
+    M, stats = iterate(M, expansion, inflation, threshold, max_iterations, block_size, convergence,
+                       cap=cap, select=select, recover=recover, recover_pct=recover_pct)
+
+    M = M.tocsr()
+    result = interpret(M) if should_interpret else M
+
+    if return_stats:
+        return result, stats
+    return result
+
+CONVERGENCE = ('difference', 'chaos')
+
+def chaos(M):
+    """ The chaos of a column-stochastic csc_matrix (as in the mcl tool): the
+        maximum over columns of max(c) / sum(c**2) - 1. It is 0 when every
+        column is homogeneous (all its entries are equal), as in the limit of
+        the MCL process, and takes O(nnz) to compute.
+
+    >>> chaos(sparse.csc_matrix(np.array([[.5, 1.], [.5, 0]])))
+    0.0
+    >>> chaos(sparse.csc_matrix(np.array([[.75, 1.], [.25, 0]])))
+    0.19999999999999996
+    """
+    counts = np.diff(M.indptr)
+    starts = M.indptr[:-1][counts > 0]
+    if len(starts) == 0:
+        return 0.0
+
+    top = np.maximum.reduceat(M.data, starts)
+    squares = np.add.reduceat(M.data ** 2, starts)
+    return float(np.max(top / squares - 1))
+
+def iterate(M, expansion=2, inflation=2.0, threshold=1e-6, max_iterations=-1, block_size=None,
+            convergence='difference', **pruning):
+    """ The MCL loop on a prepared (column-stochastic) csc_matrix, which is
+        not modified. Returns the final matrix and the per-iteration stats.
+
+    convergence: 'difference' - stop when no entry changes by more than
+                 threshold; 'chaos' - stop when the chaos (see chaos) is
+                 below threshold, which avoids a sparse subtraction per
+                 iteration
+    """
+    if convergence not in CONVERGENCE:
+        raise ValueError("Unknown convergence test %r (expected one of %s)" % (convergence, ', '.join(CONVERGENCE)))
+
+    stats = []
 
     # ugly, but will loop (almost) indefinitely when 
     # max_iterations is negative
     while max_iterations != 0:
-        Mp = (M**expansion)
-        #if np.all(abs(Mp - M).data < threshold).all():
-        #    break
-        Mp.data **= inflation
-        if cap is not None:
-            Mp.data[Mp.data < cap] = 0
-            Mp.eliminate_zeros()
-        _csr_normalize_columns(Mp)
-        if np.all(abs(Mp - M).data < threshold).all():
+        Mp, expanded_nnz = expand(M, expansion, block_size, inflation, **pruning)
+        _csc_normalize_columns(Mp)
+        stats.append(_stats(len(stats), Mp, expanded_nnz))
+        if convergence == 'chaos':
+            if stats[-1]['chaos'] < threshold:
+                M = Mp
+                break
+        elif np.all(abs(Mp - M).data < threshold).all():
             break
         M = Mp
         max_iterations -= 1
 
-    if should_interpret:
-        return interpret(M)
+    return M, stats
+
+def sweep(m, inflations, n_jobs=None, add_self_loops=True, convergence='chaos', **kwargs):
+    """ MCL at several inflation values. The matrix is prepared once and the
+    runs share it (it is not modified), running concurrently in n_jobs
+    threads (all cpus by default).
+
+    Parameters:
+    -----------
+    m:              the adjacency matrix
+    inflations:     the inflation values
+    n_jobs:         the number of threads
+    add_self_loops: see prepare
+    convergence:    see iterate (the cheaper 'chaos' test by default)
+    **kwargs:       passed to iterate (expansion, threshold, cap, select, ...)
+
+    Returns a list, in the order of inflations, of dicts with the
+    'inflation', the 'clusters', the number of 'iterations', the wall-clock
+    'seconds' and the per-iteration 'stats'
+
+    Examples:
+    ---------
+    >>> i, j = [0, 0, 1, 2, 3, 3, 4], [1, 2, 2, 3, 4, 5, 5]
+    >>> m = sparse.csr_matrix((np.ones(7), (i, j)), shape=(6, 6))
+    >>> runs = sweep(m + m.T, [1.2, 2.0])
+    >>> [(r['inflation'], len(r['clusters'])) for r in runs]
+    [(1.2, 2), (2.0, 2)]
+    """
+    M = prepare(m, add_self_loops=add_self_loops).tocsc()
+
+    def run(inflation):
+        start = time.time()
+        final, stats = iterate(M, inflation=inflation, convergence=convergence, **kwargs)
+        return {'inflation': inflation,
+                'clusters': interpret(final.tocsr()),
+                'iterations': len(stats),
+                'seconds': time.time() - start,
+                'stats': stats}
+
+    if n_jobs is None or n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+
+    pool = ThreadPool(min(n_jobs, max(len(inflations), 1)))
+    try:
+        return pool.map(run, inflations)
+    finally:
+        pool.close()
+
+def component_batches(m, batch_nodes=2000):
+    """ Groups the nodes of m by (weakly) connected component. Components with
+    at least batch_nodes nodes form a batch of their own, smaller ones are
+    packed together into batches of about batch_nodes nodes.
+
+    Returns a list of (sorted) node arrays, larger batches first
+
+    Examples:
+    ---------
+    >>> m = sparse.csr_matrix((np.ones(3), ([0, 2, 3], [1, 4, 5])), shape=(7, 7))
+    >>> component_batches(m, batch_nodes=3)
+    [array([0, 1, 2, 4]), array([3, 5]), array([6])]
+    """
+    n_components, labels = connected_components(m, directed=True, connection='weak')
+    sizes = np.bincount(labels, minlength=n_components)
+
+    # small components, largest first, are packed by their cumulative size
+    by_size = np.argsort(-sizes, kind='mergesort')
+    small = sizes[by_size] < batch_nodes
+    batch = np.arange(n_components)
+    offsets = np.cumsum(sizes[by_size][small]) - sizes[by_size][small]
+    batch[small] = (~small).sum() + offsets // batch_nodes
+    batch_of_component = np.empty(n_components, dtype=np.int64)
+    batch_of_component[by_size] = batch
+
+    node_batch = batch_of_component[labels]
+    order = np.argsort(node_batch, kind='mergesort')
+    bounds = np.cumsum(np.bincount(node_batch))
+    batches = np.split(order, bounds[:-1])
+
+    return sorted(batches, key=len, reverse=True)
+
+def _mcl_batch(args):
+    sub, params = args
+    return mcl(sub, should_interpret=False, return_stats=True, n_jobs=1, **params)
+
+def _merge_stats(stats):
+    """ Per-iteration totals over batches that ran concurrently """
+    merged = []
+    for batch in stats:
+        for entry in batch:
+            if entry['iteration'] == len(merged):
+                merged.append(dict(entry))
+            else:
+                total = merged[entry['iteration']]
+                for key in ('nnz', 'expanded_nnz', 'bytes'):
+                    total[key] += entry[key]
+                for key in ('max_column_nnz', 'chaos'):
+                    total[key] = max(total[key], entry[key])
+    return merged
+
+def _mcl_components(m, n_jobs, batch_nodes, params):
+    """ MCL on batches of connected components in a process pool. Returns
+        the final matrix (in the original node order) and merged stats """
+    m = sparse.csr_matrix(m)
+    batches = component_batches(m, batch_nodes)
+
+    # in this order every batch is a contiguous diagonal block
+    perm = np.concatenate(batches)
+    P = m[perm][:, perm]
+    bounds = np.concatenate(([0], np.cumsum([len(b) for b in batches])))
+    tasks = [(P[bounds[k]:bounds[k+1], bounds[k]:bounds[k+1]], params) for k in range(len(batches))]
+
+    if n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+
+    if n_jobs == 1 or len(tasks) == 1:
+        results = [_mcl_batch(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(min(n_jobs, len(tasks)))
+        try:
+            results = pool.map(_mcl_batch, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    rows, cols, data = [], [], []
+    for nodes, (M, _) in zip(batches, results):
+        M = M.tocoo()
+        rows.append(nodes[M.row])
+        cols.append(nodes[M.col])
+        data.append(M.data)
+
+    n = m.shape[0]
+    M = sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+    M.sort_indices()
 
-    return M
+    return M, _merge_stats([s for _, s in results])
 
 def main():
     mcl_demo = np.array([
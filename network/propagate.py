@@ -1,20 +1,288 @@
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 import scipy.sparse as sparse
 
-def normalize(m):
-    """ Normalization for propagation """
-    data = 1.0 / np.sqrt(m.sum(1))
-    d = sparse.dia_matrix((data.T,[0]), (len(data),len(data)))
-    return d * m * d
-
-def propagate(m, y, alpha=0.6, eps=1e-5, max_iterations=1000):
-    # TODO: Create nicer interface for y of type pd.Series 
-    #       (align to network and return value as Series with index)
-    f = (1-alpha)*y
-    g = alpha * m
+from .random import shuffled_copies
+
+NORMALIZATIONS = ('symmetric', 'row')
+
+def normalize(m, kind='symmetric'):
+    """ Normalization for propagation
+
+    Parameters:
+    -----------
+    m:    a csr_matrix
+    kind: 'symmetric' for D^-1/2 * m * D^-1/2 (the default) or 'row' for
+          D^-1 * m, where D holds the row sums of m
+
+    Returns a new matrix with the same sparsity pattern
+    """
+    if kind not in NORMALIZATIONS:
+        raise ValueError("Unknown normalization %r (expected one of %s)" % (kind, ', '.join(NORMALIZATIONS)))
+
+    m = sparse.csr_matrix(m)
+    degrees = np.asarray(m.sum(1), dtype=np.double).ravel()
+    rows = np.repeat(np.arange(m.shape[0]), np.diff(m.indptr))
+
+    if kind == 'symmetric':
+        d = 1.0 / np.sqrt(degrees)
+        data = m.data * d[rows] * d[m.indices]
+    else:
+        data = m.data / degrees[rows]
+
+    return sparse.csr_matrix((data, m.indices.copy(), m.indptr.copy()), shape=m.shape)
+
+METHODS = ('power', 'cg', 'chebyshev')
+
+def propagate(m, y, alpha=0.6, eps=1e-5, max_iterations=1000, method='power', x0=None, return_info=False, operator=None):
+    """ Network propagation: solves f = alpha * m * f + (1-alpha) * y, that is,
+    (I - alpha * m) f = (1-alpha) * y.
+
+    Parameters:
+    -----------
+    m:              the (normalized) adjacency matrix
+    y:              the prior. Either a vector (n) or a block of priors
+                    (n X k), one per column. All columns are propagated
+                    together with sparse-matrix X dense-block products
+    alpha:          the weight of the network
+    eps:            convergence threshold on the norm of the residual
+                    (1-alpha)*y + alpha*m*f - f, per column. For the power
+                    iteration this is the change between iterations.
+    max_iterations: the maximum number of iterations
+    method:         the solver:
+                    'power':     fixed-point iteration (the default)
+                    'cg':        conjugate gradient. Requires a symmetric m
+                                 (e.g., the symmetric normalization) and
+                                 converges much faster when alpha is close to 1
+                    'chebyshev': Chebyshev-accelerated fixed-point iteration.
+                                 Assumes the eigenvalues of m are in [-1, 1]
+                                 (true for the symmetric normalization)
+    x0:             an initial guess (e.g., a previous solution), same shape
+                    as y. Defaults to y
+    return_info:    also return a dict with the method, the number of
+                    iterations and whether each column converged
+    operator:       alpha * m, if already available (m is then not used)
+
+    Returns the propagated scores (same shape as y). Columns that converge
+    are removed from the active block, the others keep iterating.
+
+    Examples:
+    ---------
+    >>> from scipy.sparse import csr_matrix
+    >>> m = normalize(csr_matrix(np.array([[0., 1, 1], [1, 0, 0], [1, 0, 0]])))
+    >>> f = propagate(m, np.array([1., 0, 0]))
+    >>> np.round(f, 3)
+    array([ 0.625,  0.265,  0.265])
+    >>> F = propagate(m, np.array([[1., 0], [0, 0], [0, 1]]))
+    >>> np.allclose(F[:, 0], f)
+    True
+    >>> f2, info = propagate(m, np.array([1., 0, 0]), method='cg', return_info=True)
+    >>> np.allclose(f, f2, atol=1e-4), info['iterations'], info['converged']
+    (True, 1, True)
+    >>> f3, info = propagate(m, np.array([1., 0, 0]), method='chebyshev', x0=f, return_info=True)
+    >>> np.allclose(f, f3, atol=1e-4), info['iterations']
+    (True, 1)
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown propagation method %r (expected one of %s)" % (method, ', '.join(METHODS)))
+
+    y = np.asarray(y, dtype=np.double)
+    squeeze = y.ndim == 1
+    y = y.reshape(y.shape[0], -1)
+
+    if x0 is None:
+        f = y.copy()
+    else:
+        f = np.array(x0, dtype=np.double).reshape(y.shape)
+
+    b = (1-alpha) * y
+    g = alpha * m if operator is None else operator
+
+    solver = {'power': _power, 'cg': _conjugate_gradient, 'chebyshev': _chebyshev}[method]
+    iterations = np.zeros(y.shape[1], dtype=np.int)
+    converged = np.zeros(y.shape[1], dtype=bool)
+    solver(g, b, f, eps, max_iterations, iterations, converged, alpha)
+
+    if squeeze:
+        f, iterations, converged = f[:, 0], iterations[0], converged[0]
+
+    if return_info:
+        return f, {'method': method, 'iterations': iterations, 'converged': converged}
+    return f
+
+def _power(g, b, f, eps, max_iterations, iterations, converged, alpha):
+    """ f <- g*f + b. Updates f, iterations and converged in-place """
+    active = np.arange(b.shape[1])
+    for i in range(max_iterations):
+        if len(active) == b.shape[1]:
+            fnew = g * f
+            fnew += b
+            delta = _column_norms(fnew - f)
+            f[:] = fnew
+        else:
+            fold = f[:, active]
+            fnew = g * fold
+            fnew += b[:, active]
+            delta = _column_norms(fnew - fold)
+            f[:, active] = fnew
+
+        iterations[active] += 1
+        done = delta < eps
+        converged[active[done]] = True
+        active = active[~done]
+        if len(active) == 0:
+            break
+
+def _chebyshev(g, b, f, eps, max_iterations, iterations, converged, alpha):
+    """ Chebyshev semi-iterative acceleration of f <- g*f + b, for a
+        spectrum of g in [-alpha, alpha] """
+    rho2 = alpha ** 2
+    active = np.arange(b.shape[1])
+    fprev = f.copy()
+    omega = 1.0
     for i in range(max_iterations):
-        fold, f = f, g*f + y
-        if la.norm(f-fold) < eps:
+        fa = f[:, active]
+        step = g * fa
+        step += b[:, active]
+        step -= fa # the residual
+
+        delta = _column_norms(step)
+        iterations[active] += 1
+
+        # x_{k+1} = omega * (g*x_k + b - x_{k-1}) + x_{k-1}
+        if i == 0:
+            omega = 1.0
+        elif i == 1:
+            omega = 1.0 / (1.0 - rho2 / 2.0)
+        else:
+            omega = 1.0 / (1.0 - rho2 * omega / 4.0)
+
+        fprev_a = fprev[:, active]
+        fnew = omega * (step + fa - fprev_a) + fprev_a
+        fprev[:, active] = fa
+        f[:, active] = fnew
+
+        done = delta < eps
+        converged[active[done]] = True
+        active = active[~done]
+        if len(active) == 0:
             break
-    return f 
 
+def _conjugate_gradient(g, b, f, eps, max_iterations, iterations, converged, alpha):
+    """ Conjugate gradient for (I - g) f = b, all columns at once (each
+        column has its own step sizes) """
+    active = np.arange(b.shape[1])
+
+    x = f.copy()
+    r = b - (x - g * x)
+    p = r.copy()
+    rs = np.einsum('ij,ij->j', r, r)
+
+    for i in range(max_iterations):
+        done = np.sqrt(rs) < eps
+        if done.any():
+            f[:, active[done]] = x[:, done]
+            converged[active[done]] = True
+            keep = ~done
+            active, x, r, p, rs = active[keep], x[:, keep], r[:, keep], p[:, keep], rs[keep]
+            if len(active) == 0:
+                return
+
+        ap = p - g * p
+        step = rs / np.einsum('ij,ij->j', p, ap)
+        x += step * p
+        r -= step * ap
+        rs_new = np.einsum('ij,ij->j', r, r)
+        p *= rs_new / rs
+        p += r
+        rs = rs_new
+        iterations[active] += 1
+
+    done = np.sqrt(rs) < eps
+    converged[active[done]] = True
+    f[:, active] = x
+
+def significance(m, y, n_permutations=1000, batch_size=100, n_jobs=None, seed=None,
+                 normalization=None, directed=False, shuffle_iterations=None, **kwargs):
+    """ Empirical significance of propagation scores against degree-preserving
+    shuffles of the network.
+
+    The shuffled networks are generated (in parallel) in batches of
+    `batch_size` and propagated (in parallel, by n_jobs threads). Only
+    running exceedance counts and moments are kept, so memory is
+    O(batch_size) networks regardless of n_permutations.
+
+    Parameters:
+    -----------
+    m:                  the adjacency matrix
+    y:                  the prior (a vector)
+    n_permutations:     the number of shuffled networks
+    batch_size:         the number of shuffled networks held in memory
+    n_jobs:             the number of threads (default: all available)
+    seed:               a seed for drawing the shuffling seeds
+    normalization:      normalize m (and each of the shuffled networks) before
+                        propagation ('symmetric', 'row' or None)
+    directed:           see random.shuffled_copies
+    shuffle_iterations: the number of swaps per network (see random.shuffled_copies)
+    **kwargs:           passed to propagate (alpha, eps, method, ...)
+
+    Returns a dict of arrays: 'score' (the observed scores), 'pvalue' (the
+    fraction of shuffled networks with score >= the observed one, with a
+    pseudo-count), 'zscore', 'null_mean' and 'null_std'.
+    """
+    y = np.asarray(y, dtype=np.double)
+    if y.ndim != 1:
+        raise ValueError("significance expects a single prior vector")
+
+    if n_jobs is None or n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+
+    base = sparse.csr_matrix(m, dtype=np.double) # shuffling requires double weights
+
+    def score(network):
+        if normalization is not None:
+            network = normalize(network, normalization)
+        return propagate(network, y, **kwargs)
+
+    observed = score(base)
+
+    exceed = np.zeros(len(y), dtype=np.int)
+    mean = np.zeros(len(y))
+    m2 = np.zeros(len(y))
+    count = 0
+
+    rs = np.random.RandomState(seed)
+    pool = ThreadPool(n_jobs)
+    try:
+        while count < n_permutations:
+            k = min(batch_size, n_permutations - count)
+            seeds = rs.randint(1, np.iinfo(np.int32).max, size=k).tolist()
+            networks = shuffled_copies(base, k, directed=directed, max_iterations=shuffle_iterations,
+                                       seed=seeds, n_jobs=n_jobs)
+
+            for f in pool.imap_unordered(score, networks):
+                # Welford's online update
+                count += 1
+                exceed += f >= observed
+                delta = f - mean
+                mean += delta / count
+                m2 += delta * (f - mean)
+
+            del networks
+    finally:
+        pool.close()
+
+    std = np.sqrt(m2 / max(count - 1, 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zscore = (observed - mean) / std
+
+    return {'score': observed,
+            'pvalue': (exceed + 1.0) / (count + 1.0),
+            'zscore': zscore,
+            'null_mean': mean,
+            'null_std': std}
+
+def _column_norms(x):
+    return np.sqrt(np.einsum('ij,ij->j', x, x))
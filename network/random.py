@@ -3,6 +3,8 @@ import numpy as np
 from scipy.spatial.distance import pdist, squareform
 from scipy.sparse import csr_matrix
 
+from .util import as_index_dtype
+
 try:
     import pyximport
     pyximport.install()
@@ -81,7 +83,7 @@ def preferential(n, k=1):
 
     return csr_matrix(data)
 
-def shuffle(network, directed=False, max_iterations=None, seed=0):
+def shuffle(network, directed=False, max_iterations=None, seed=0, algorithm='batched', return_stats=False):
     """ A degree-preserving shuffling of the edges of the input network.
     Note that the shuffling changes the original matrix.
 
@@ -94,9 +96,23 @@ def shuffle(network, directed=False, max_iterations=None, seed=0):
     max_iterations: The maximum number of iterations to perform. Defaults to 10
                     times the number of edges
     seed:           A seed for the interna random number generator
+    algorithm:      The swapping kernel:
+                    'classic': finds the row of each proposed edge with a
+                               binary search over indptr
+                    'rowmap':  looks rows up in a precomputed row-of-edge
+                               array (nnz integers)
+                    'batched': rowmap, with proposals drawn and prefetched in
+                               batches (the default, fastest on large graphs)
+                    All algorithms make the same swaps for a given seed.
+    return_stats:   Also return a dict with the number of attempts, accepted
+                    swaps and rejections ('rejected_nodes': the edges share
+                    a node, 'rejected_exists': a swapped edge already exists)
 
     Returns the actual number of edge shuffles that took place. 
 
+    Networks with up to 2^31 nodes and edges are shuffled with int32
+    indices, larger ones with int64 (the index arrays are converted if needed).
+
     Examples:
         >>> from numpy import array
         >>> from scipy.sparse import csr_matrix
@@ -119,6 +135,18 @@ def shuffle(network, directed=False, max_iterations=None, seed=0):
                 [1, 1, 0, 0],
                 [0, 1, 0, 0]])
         
+        >>> h = g.astype(np.float)
+        >>> n, stats = shuffle(h, max_iterations=10, seed=1, algorithm='classic', return_stats=True)
+        >>> n == stats['accepted'], stats['attempts']
+        (True, 10)
+        >>> stats['accepted'] + stats['rejected_nodes'] + stats['rejected_exists']
+        10
+        >>> h32, h64 = g.astype(np.float), g.astype(np.float) # the int64 kernel
+        >>> h64.indices, h64.indptr = h64.indices.astype(np.int64), h64.indptr.astype(np.int64)
+        >>> _shuffle_edges(h32, False, 20, 3, 'batched') == _shuffle_edges(h64, False, 20, 3, 'batched')
+        True
+        >>> (h32 != h64).nnz
+        0
     """
     if not isinstance(network, csr_matrix):
         network = csr_matrix(network)
@@ -129,9 +157,15 @@ def shuffle(network, directed=False, max_iterations=None, seed=0):
     if network.data.dtype != np.float:
         network.data = network.data.astype(np.float)
 
-    return _shuffle_edges(network, directed, max_iterations, seed)
+    as_index_dtype(network)
 
-def shuffled_copies(network, n, directed=False, max_iterations=None, seed=0):
+    stats = {} if return_stats else None
+    switches = _shuffle_edges(network, directed, max_iterations, seed, algorithm, stats)
+    if return_stats:
+        return switches, stats
+    return switches
+
+def shuffled_copies(network, n, directed=False, max_iterations=None, seed=0, n_jobs=None):
     """ A degree-preserving shuffling of the edges of the input network.
         Returns multiple copies, uses multiple cpus, if available.
 
@@ -145,6 +179,7 @@ def shuffled_copies(network, n, directed=False, max_iterations=None, seed=0):
     max_iterations: The maximum number of iterations to perform. Defaults to 10
                     times the number of edges
     seed:           A seed for the interna random number generator
+    n_jobs:         The number of threads (default: all available)
 
     Returns the shuffled networks.
 
@@ -179,10 +214,12 @@ def shuffled_copies(network, n, directed=False, max_iterations=None, seed=0):
     if network.data.dtype != np.float:
         network.data = network.data.astype(np.float)
 
+    as_index_dtype(network)
+
     if seed == 0:
         seed = np.random.randint(32767, size=n)
 
-    return _shuffle_multiple(network, n, directed, max_iterations, seed)
+    return _shuffle_multiple(network, n, directed, max_iterations, seed, n_jobs or 0)
 
 
 if __name__ == '__main__':
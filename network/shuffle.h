@@ -5,29 +5,39 @@
 #include <random>
 #include <iostream>
 #include <iomanip>
+#include <vector>
 
-void change_edge(int t, int* edge, double* data, int* begin, int* end) {
+// data may be NULL for unweighted networks
+template <typename I>
+void change_edge(I t, I* edge, double* data, I* begin, I* end) {
 	using namespace std;
 	*edge = t;
 	while(edge < end-1 && *edge > edge[1]) {
 		swap(edge[0], edge[1]);
-		swap(data[0], data[1]);
+		if(data) {
+			swap(data[0], data[1]);
+			++data;
+		}
 		++edge;
 	}
 	while(edge > begin && *edge < edge[-1]) {
 		swap(edge[0], edge[-1]);
-		swap(data[0], data[-1]);
+		if(data) {
+			swap(data[0], data[-1]);
+			--data;
+		}
 		--edge;
 	}
 }
 
-void show_mat(const char* prefix, int nnz, int* indices, int n, int* indptr, double* data) {
+template <typename I>
+void show_mat(const char* prefix, I nnz, I* indices, I n, I* indptr, double* data) {
 	using namespace std;
 	cout << prefix << endl;
-	for(int r=0; r<n; ++r) {
-		int col = indptr[r];
+	for(I r=0; r<n; ++r) {
+		I col = indptr[r];
 		cout << r << "]    ";
-		for(int c=0; c<n; ++c)
+		for(I c=0; c<n; ++c)
 			if(col < indptr[r+1] && c == indices[col]) {
 				cout << setprecision(3) << setw(6) << left << data[col] << " ";
 				++col;
@@ -40,129 +50,169 @@ void show_mat(const char* prefix, int nnz, int* indices, int n, int* indptr, dou
 }
 	
 
-int shuffle_edges_directed(int nnz, int* indices, int n, int* indptr, double* data, int iterations, int seed) {
+// Statistics of a shuffling run. Rejected attempts are split by reason:
+// `rejected_nodes` - the two edges share a node (or one is a self loop)
+// `rejected_exists` - one of the swapped edges is already in the network
+struct shuffle_stats {
+	long long attempts;
+	long long accepted;
+	long long rejected_nodes;
+	long long rejected_exists;
+};
+
+// The row of every edge: rows[e] = u for indptr[u] <= e < indptr[u+1].
+// Swaps keep every edge in its row, so this is computed once per network
+// (and shared by all of its copies).
+template <typename I>
+void edge_rows(I n, const I* indptr, I* rows) {
+	for(I r=0; r<n-1; ++r)
+		for(I e=indptr[r]; e<indptr[r+1]; ++e)
+			rows[e] = r;
+}
+
+#if defined(__GNUC__)
+#define SHUFFLE_PREFETCH(p) __builtin_prefetch(p)
+#else
+#define SHUFFLE_PREFETCH(p)
+#endif
+
+// The number of proposals drawn (and prefetched) at once in batched mode
+const int SHUFFLE_BATCH = 64;
+
+// The swapping kernel, for int32 or int64 indices (I). Proposes
+// (u,v), (s,t) -> (u,t), (s,v) swaps.
+// rows:  the row of every edge (see edge_rows), or NULL to binary search
+//        indptr for each proposal
+// batch: if positive, proposals are drawn `batch` at a time and their memory
+//        is prefetched before they are evaluated one by one. The random
+//        numbers are drawn in the same order, so all modes make exactly the
+//        same swaps for a given seed.
+// stats: accumulates counts (may be NULL)
+template <bool Directed, typename I>
+long long shuffle_edges_impl(I nnz, I* indices, I n, I* indptr, double* data, long long iterations, int seed,
+                             const I* rows, int batch, shuffle_stats* stats) {
 	using namespace std;
 	mt19937_64 						rng(seed);
-	uniform_int_distribution<int> 	randnnz(0, nnz-1);
-	int 							switches = 0;
-
-	for(int counter=0; counter<iterations; ++counter) {
-		int iv = randnnz(rng);
-		int u = upper_bound(indptr, indptr+n, iv) - indptr - 1;
-		int v = indices[iv];
-
-		int it = randnnz(rng);
-		int s = upper_bound(indptr, indptr+n, it) - indptr - 1;
-		int t =  indices[it];
-
-		if(s==t || s==u || s==v || t==u || t==v)
-			continue;
-
-		int* ubegin = indices + indptr[u];
-		int* uend = indices + indptr[u+1];
-		int* pos = lower_bound(ubegin, uend, t);
-		if(pos < uend && *pos==t)
-			// (u,t) in g
-			continue;
-
-		int* sbegin = indices+indptr[s];
-		int* send = indices+indptr[s+1];
-		pos = lower_bound(sbegin, send, v);
-		if(pos < indices + indptr[s+1] && *pos==v)
-			// (s,v) in g
-			continue;
-
-		//cout << "u=" << u << " v=" <<v << " s="<< s << " t=" <<t <<endl;
-		//cout << "g[u,v]=" << data[iv] << " g[s,t]=" << data[it] << endl;
-		change_edge(t, indices+iv, data+iv, ubegin, uend);
-		//show_mat("1:", nnz, indices, n, indptr, data);
-		change_edge(v, indices+it, data+it, sbegin, send);
-		//show_mat("2:", nnz, indices, n, indptr, data);
-
-		//indices[iv] = t;
-		//indices[it] = v;
-		//swap(data[iv], data[it]);
-
-		//sort(ubegin, uend);
-		//sort(sbegin, send);
-		++switches;
+	uniform_int_distribution<I> 	randnnz(0, nnz-1);
+	long long						switches = 0;
+	long long						rejected_nodes = 0;
+	long long						rejected_exists = 0;
+	vector<I>						proposals(batch > 0 ? 2*batch : 0);
+
+	for(long long counter=0; counter<iterations; ) {
+		int todo = 1;
+		if(batch > 0) {
+			todo = (int)min<long long>(batch, iterations-counter);
+			for(int k=0; k<todo; ++k) {
+				I iv = proposals[2*k] = randnnz(rng);
+				I it = proposals[2*k+1] = randnnz(rng);
+				SHUFFLE_PREFETCH(indices+iv);
+				SHUFFLE_PREFETCH(indices+it);
+				if(rows) {
+					SHUFFLE_PREFETCH(rows+iv);
+					SHUFFLE_PREFETCH(rows+it);
+				}
+			}
+		}
+
+		for(int k=0; k<todo; ++k, ++counter) {
+			I iv, it;
+			if(batch > 0) {
+				iv = proposals[2*k];
+				it = proposals[2*k+1];
+				if(rows && k+8 < todo) {
+					// the rows of upcoming proposals are searched next
+					SHUFFLE_PREFETCH(indices + indptr[rows[proposals[2*k+16]]]);
+					SHUFFLE_PREFETCH(indices + indptr[rows[proposals[2*k+17]]]);
+				}
+			} else {
+				iv = randnnz(rng);
+				it = randnnz(rng);
+			}
+
+			I u = rows ? rows[iv] : upper_bound(indptr, indptr+n, iv) - indptr - 1;
+			I v = indices[iv];
+			I s = rows ? rows[it] : upper_bound(indptr, indptr+n, it) - indptr - 1;
+			I t = indices[it];
+
+			if(s==t || s==u || s==v || t==u || t==v) {
+				++rejected_nodes;
+				continue;
+			}
+
+			I* ubegin = indices + indptr[u];
+			I* uend = indices + indptr[u+1];
+			I* pos = lower_bound(ubegin, uend, t);
+			if(pos < uend && *pos==t) {
+				// (u,t) in g
+				++rejected_exists;
+				continue;
+			}
+
+			I* sbegin = indices+indptr[s];
+			I* send = indices+indptr[s+1];
+			pos = lower_bound(sbegin, send, v);
+			if(pos < send && *pos==v) {
+				// (s,v) in g
+				++rejected_exists;
+				continue;
+			}
+
+			double duv = data ? data[iv] : 0;
+			double dst = data ? data[it] : 0;
+
+			change_edge(t, indices+iv, data ? data+iv : NULL, ubegin, uend);
+			change_edge(v, indices+it, data ? data+it : NULL, sbegin, send);
+
+			if(!Directed) {
+				// the mirrored edges (v,u), (t,s) -> (v,s), (t,u)
+				I* vbegin = indices+indptr[v];
+				I* vend = indices+indptr[v+1];
+				pos = lower_bound(vbegin, vend, u);
+				if(data)
+					data[pos-indices] = dst;
+				change_edge(s, pos, data ? data + (pos-indices) : NULL, vbegin, vend);
+
+				I* tbegin = indices+indptr[t];
+				I* tend = indices+indptr[t+1];
+				pos = lower_bound(tbegin, tend, s);
+				if(data)
+					data[pos-indices] = duv;
+				change_edge(u, pos, data ? data + (pos-indices) : NULL, tbegin, tend);
+			}
+
+			++switches;
+		}
+	}
+
+	if(stats) {
+		stats->attempts += iterations > 0 ? iterations : 0;
+		stats->accepted += switches;
+		stats->rejected_nodes += rejected_nodes;
+		stats->rejected_exists += rejected_exists;
 	}
 
 	return switches;
 }
 
-int shuffle_edges_undirected(int nnz, int* indices, int n, int* indptr, double* data, int iterations, int seed) {
-	using namespace std;
-	mt19937_64 						rng(seed);
-	uniform_int_distribution<int> 	randnnz(0, nnz-1);
-	int switches = 0;
-
-	//show_mat("start", nnz, indices, n, indptr, data);
-
-	for(int counter=0; counter<iterations; ++counter) {
-		int iv = randnnz(rng);
-		int u = upper_bound(indptr, indptr+n, iv) - indptr - 1;
-		int v = indices[iv];
-
-		int it = randnnz(rng);
-		int s = upper_bound(indptr, indptr+n, it) - indptr - 1;
-		int t =  indices[it];
-
-		if(s==t || s==u || s==v || t==u || t==v)
-			continue;
-
-		int* ubegin = indices + indptr[u];
-		int* uend = indices + indptr[u+1];
-		int* pos = lower_bound(ubegin, uend, t);
-		if(pos < uend && *pos==t)
-			// (u,t) in g
-			continue;
-
-		int* sbegin = indices+indptr[s];
-		int* send = indices+indptr[s+1];
-		pos = lower_bound(sbegin, send, v);
-		if(pos < indices + indptr[s+1] && *pos==v)
-			// (s,v) in g
-			continue;
-
-		double duv = data[iv];
-		double dst = data[it];
-
-		//cout << "u=" << u << " v=" <<v << " s="<< s << " t=" <<t <<endl;
-		//cout << "g[u,v]=" << duv << " g[s,t]=" << dst << endl;
-
-		change_edge(t, indices+iv, data+iv, ubegin, uend);
-		//show_mat("1:", nnz, indices, n, indptr, data);
-		change_edge(v, indices+it, data+it, sbegin, send);
-		//show_mat("2:", nnz, indices, n, indptr, data);
-		//indices[iv] = t;
-		//indices[it] = v;
-
-		//sort(ubegin, uend);
-		//sort(sbegin, send);
-
-		int* vbegin = indices+indptr[v];
-		int* vend = indices+indptr[v+1];
-		//*lower_bound(vbegin, vend, u) = s;
-		//sort(vbegin, vend);
-		pos = lower_bound(vbegin, vend, u);
-		data[pos-indices] = dst;
-		change_edge(s, pos, data + (pos-indices), vbegin, vend);
-		//show_mat("3:", nnz, indices, n, indptr, data);
-
-		int* tbegin = indices+indptr[t];
-		int* tend = indices+indptr[t+1];
-		//*lower_bound(tbegin, tend, s) = u;
-		//sort(tbegin, tend);
-		pos = lower_bound(tbegin, tend, s);
-		data[pos-indices] = duv;
-		change_edge(u, pos, data + (pos-indices), tbegin, tend);
-		//show_mat("4:", nnz, indices, n, indptr, data);
-
-		++switches;
-	}
+template <typename I>
+long long shuffle_edges_directed(I nnz, I* indices, I n, I* indptr, double* data, long long iterations, int seed) {
+	return shuffle_edges_impl<true, I>(nnz, indices, n, indptr, data, iterations, seed, NULL, 0, NULL);
+}
 
-	return switches;
+template <typename I>
+long long shuffle_edges_undirected(I nnz, I* indices, I n, I* indptr, double* data, long long iterations, int seed) {
+	return shuffle_edges_impl<false, I>(nnz, indices, n, indptr, data, iterations, seed, NULL, 0, NULL);
+}
+
+// Shuffling with a precomputed row-of-edge array (and optionally batched, see
+// shuffle_edges_impl)
+template <typename I>
+long long shuffle_edges_fast(I nnz, I* indices, I n, I* indptr, double* data, long long iterations, int seed,
+                             bool directed, const I* rows, int batch, shuffle_stats* stats) {
+	if(directed)
+		return shuffle_edges_impl<true, I>(nnz, indices, n, indptr, data, iterations, seed, rows, batch, stats);
+	return shuffle_edges_impl<false, I>(nnz, indices, n, indptr, data, iterations, seed, rows, batch, stats);
 }
 
 
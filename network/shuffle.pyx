@@ -1,50 +1,162 @@
 cimport cython
 from cython.parallel import prange, parallel
 cimport numpy as np
+cimport openmp
 import numpy as np
 
+ctypedef fused ITYPE_f:
+    np.int32_t
+    np.int64_t
+
 cdef extern from "shuffle.h":
-    int shuffle_edges_undirected(int nnz, int* indices, int n, int* indptr, double* data, int iterations, int seed) nogil
-    int shuffle_edges_directed(int nnz, int* indices, int n, int* indptr, double* data, int iterations, int seed) nogil
+    cdef struct shuffle_stats:
+        long long attempts
+        long long accepted
+        long long rejected_nodes
+        long long rejected_exists
+
+    int SHUFFLE_BATCH
+    void edge_rows[I](I n, const I* indptr, I* rows) nogil
+    long long shuffle_edges_fast[I](I nnz, I* indices, I n, I* indptr, double* data, long long iterations, int seed,
+                                    bint directed, I* rows, int batch, shuffle_stats* stats) nogil
 
 cdef extern from "tasks.h":
-    cdef cppclass tasker:
-        void add(int nnz, int* indices, int n, int* indptr, double* data, int iterations, int seed) nogil
-        int exectue(int i, int(*func)(int, int*, int, int*, double*, int, int)) nogil
+    cdef cppclass tasker[I]:
+        void add(I nnz, I* indices, I n, I* indptr, double* data, long long iterations, int seed) nogil
+        void add(I nnz, I* indices, I n, I* indptr, double* data, long long iterations, int seed,
+                 const I* rows, int batch) nogil
+        long long run(int i, bint directed) nogil
+        shuffle_stats total_stats()
+
+ALGORITHMS = ('classic', 'rowmap', 'batched')
+
+cdef dict _as_dict(shuffle_stats stats):
+    return {'attempts': stats.attempts,
+            'accepted': stats.accepted,
+            'rejected_nodes': stats.rejected_nodes,
+            'rejected_exists': stats.rejected_exists}
+
+def row_of_edges(ITYPE_f[::1] indptr):
+    """ The row of every edge of a csr matrix (one per nonzero, same dtype as indptr) """
+    rows = np.empty(indptr[indptr.shape[0]-1] if indptr.shape[0] > 0 else 0, dtype=np.asarray(indptr).dtype)
+    cdef ITYPE_f[::1] rows_view = rows
+    if rows.shape[0] > 0:
+        edge_rows(<ITYPE_f>indptr.shape[0], &indptr[0], &rows_view[0])
+    return rows
+
+def shuffle_edges(network, directed, max_iterations, seed, algorithm='classic', stats=None):
+    """ Shuffle network in-place, returns the number of swaps.
+
+        algorithm: 'classic' (a binary search for the row of every proposed
+                   edge), 'rowmap' (a precomputed row-of-edge array) or
+                   'batched' (rowmap, with proposals drawn and prefetched
+                   in batches)
+        stats:     a dict that is updated with the number of attempts,
+                   accepted swaps and rejections (by reason)
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError("Unknown shuffling algorithm %r (expected one of %s)" % (algorithm, ', '.join(ALGORITHMS)))
+
+    return _shuffle_edges(network.indices, network.indptr, network.data, directed, max_iterations, seed,
+                          algorithm, stats)
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
-cdef int shuffle_edges_internal(int[::1] indices, int[::1] indptr, double[::1] data,
-                       bint directed, int iterations, int seed) nogil:
+def _shuffle_edges(ITYPE_f[::1] indices, ITYPE_f[::1] indptr, double[::1] data, bint directed,
+                   long long iterations, int seed, algorithm, stats):
+    cdef ITYPE_f[::1] rows
+    cdef ITYPE_f* rows_ptr = NULL
+    cdef int batch = SHUFFLE_BATCH if algorithm == 'batched' else 0
+    cdef shuffle_stats counts
+    cdef long long switches
+
+    counts.attempts = counts.accepted = counts.rejected_nodes = counts.rejected_exists = 0
+    if indices.shape[0] == 0:
+        return 0
+
+    if algorithm != 'classic':
+        rows = row_of_edges(indptr)
+        rows_ptr = &rows[0]
+
     with nogil:
-        if directed:
-            return shuffle_edges_directed(indices.shape[0], &indices[0], indptr.shape[0], &indptr[0], &data[0], iterations, seed)
-        else:
-            return shuffle_edges_undirected(indices.shape[0], &indices[0], indptr.shape[0], &indptr[0], &data[0], iterations, seed)
+        switches = shuffle_edges_fast(<ITYPE_f>indices.shape[0], &indices[0], <ITYPE_f>indptr.shape[0], &indptr[0],
+                                      &data[0], iterations, seed, directed, rows_ptr, batch, &counts)
 
-def shuffle_edges(network, directed, max_iterations, seed):
-    return shuffle_edges_internal(network.indices, network.indptr, network.data, directed, max_iterations, seed)
+    if stats is not None:
+        for key, value in _as_dict(counts).iteritems():
+            stats[key] = stats.get(key, 0) + value
 
-def shuffle_multiple(network, int n, bint directed, int max_iterations, seed):
+    return switches
+
+def shuffle_multiple(network, int n, bint directed, long long max_iterations, seed, int n_jobs=0):
+    """ Shuffle n copies of network in parallel (n_jobs threads, all
+        available if not positive) """
     networks = [network.copy() for _ in range(n)]
 
-    cdef int[::1] indices
-    cdef int[::1] indptr
+    if n == 0 or network.nnz == 0:
+        return networks
+
+    if n_jobs <= 0:
+        n_jobs = openmp.omp_get_max_threads()
+
+    _shuffle_multiple(network.indptr, networks, directed, max_iterations, seed, n_jobs)
+    return networks
+
+def _shuffle_multiple(ITYPE_f[::1] indptr, list networks, bint directed, long long max_iterations, seed, int n_jobs):
+    cdef ITYPE_f[::1] indices
     cdef double[::1] data
-    cdef tasker container
+    cdef tasker[ITYPE_f] container
     cdef int i
+    cdef int n = len(networks)
+
+    # the rows of the edges are the same for all copies
+    cdef ITYPE_f[::1] rows = row_of_edges(indptr)
 
     for i in range(n):
         indices = networks[i].indices
-        indptr = networks[i].indptr
         data = networks[i].data
-        container.add(indices.shape[0], &indices[0], indptr.shape[0], &indptr[0], &data[0], max_iterations, seed[i])
+        container.add(indices.shape[0], &indices[0], indptr.shape[0], &indptr[0], &data[0], max_iterations, seed[i],
+                      &rows[0], SHUFFLE_BATCH)
                       
-    with nogil, parallel():
+    with nogil, parallel(num_threads=n_jobs):
         for i in prange(n):
-            if directed:
-                container.exectue(i, shuffle_edges_directed)
-            else:
-                container.exectue(i, shuffle_edges_undirected)
+            container.run(i, directed)
 
-    return networks
+def shuffle_ensemble(ITYPE_f[::1] indptr, ITYPE_f[:, ::1] indices, data, bint directed, long long max_iterations,
+                     seed, int n_jobs=0):
+    """ Shuffle, in-place and in parallel, the rows of `indices` (and `data`,
+        unless None) which hold copies of the same network. All copies share
+        `indptr` as the shuffling does not change it.
+
+        Returns a dict with the total number of attempts, accepted swaps and
+        rejections (by reason) """
+    cdef double[:, ::1] data_view
+    cdef tasker[ITYPE_f] container
+    cdef int i
+    cdef int n = indices.shape[0]
+    cdef ITYPE_f nnz = indices.shape[1]
+    cdef bint weighted = data is not None
+    cdef ITYPE_f[::1] rows
+
+    if n == 0 or nnz == 0:
+        return _as_dict(container.total_stats())
+
+    if n_jobs <= 0:
+        n_jobs = openmp.omp_get_max_threads()
+
+    if weighted:
+        data_view = data
+
+    rows = row_of_edges(indptr)
+
+    for i in range(n):
+        container.add(nnz, &indices[i, 0], indptr.shape[0], &indptr[0],
+                      &data_view[i, 0] if weighted else NULL, max_iterations, seed[i],
+                      &rows[0], SHUFFLE_BATCH)
+
+    with nogil, parallel(num_threads=n_jobs):
+        for i in prange(n):
+            container.run(i, directed)
+
+    return _as_dict(container.total_stats())
@@ -3,22 +3,34 @@ import pandas as pd
 
 import numpy.linalg as la
 import scipy.spatial.distance as distance
-from scipy.sparse import csr_matrix, issparse, dia_matrix
+from scipy.sparse import csr_matrix, issparse
 
 from ..metrics import jaccard_distance
+from ..metrics.similarity import similarity, METRICS as SIMILARITY_METRICS
 from .random import shuffle, shuffled_copies
 
-from .mcl import mcl
+from .mcl import mcl, sweep
+from .propagate import propagate, normalize, significance
+from .cache import OperatorCache, freeze
+from .label_index import LabelIndex
+from . import storage, edgelist
+from .util import coalesce, csr_from_sorted, induced_subgraph, COALESCE_METHODS
 
 try:
     import pyximport
     pyximport.install()
 
-    from .topological_sort import topological_sort
+    from .topological_sort import topological_sort, topological_levels
     from .depth_first import depth_first_order
+    from .k_cores import k_cores, k_truss
+    from .traversal import Traversal, reachable
 except:
     import warnings
-    warnings.warn('Compilation with cython failed. Topological sort and DFS will not work.')
+    warnings.warn('Compilation with cython failed. Topological sort, traversals and cores will not work.')
+
+_MERGE_ALIASES = {'other': 'last', 'self': 'first'}
+
+OPERATOR_CACHE_SIZE = 8 # the number of derived operators kept per graph
 
 class SparseGraph(object):
     """ 
@@ -26,7 +38,7 @@ class SparseGraph(object):
     Node labels are also tracked (to some extent). 
     """
 
-    def __init__(self, spmat, names=None):
+    def __init__(self, spmat, names=None, label_index=None):
         """ Initialize the matrix 
 
         Parameters:
@@ -34,6 +46,8 @@ class SparseGraph(object):
         spmat: csr_matrix containing the adjacency matrix
         names: an optional numpy.array or pandas.Series containing the labels
                for the nodes. If omitted nodes are labeled with integers.
+        label_index: an optional LabelIndex for the labels in names (allows
+               sharing one index between graphs with the same labels)
         """
         if not isinstance(spmat, csr_matrix) or spmat.shape[0] != spmat.shape[1]:
             raise ValueError("Invalid sparse matrix for initialization")
@@ -44,62 +58,443 @@ class SparseGraph(object):
         if isinstance(names, pd.Series):
             self.names = names
         else:
-            self.names = pd.Series(np.arange(names.shape[0],dtype=np.int), names)
+            self._names = None # built on first use, see names
+            self._labels = names
 
+        self._cache = OperatorCache(OPERATOR_CACHE_SIZE)
         self.data = spmat
         self.shape = spmat.shape # ugly but can't think of a better way
+        self._label_index = label_index
+
+    @property
+    def names(self):
+        """ A pandas.Series that maps the node labels to their ids. Built on
+            first use from the labels the graph was created with, so loading
+            (see load) does not read memory-mapped labels """
+        if self._names is None:
+            self._names = pd.Series(np.arange(len(self._labels), dtype=np.int), self._labels)
+            self._labels = None
+        return self._names
+
+    @names.setter
+    def names(self, names):
+        self._names = names
+        self._labels = None
+
+    @property
+    def data(self):
+        """ The adjacency matrix (csr_matrix). Assigning a new matrix drops
+            the cached operators; after modifying its arrays in-place call
+            invalidate_cache() """
+        return self._data
+
+    @data.setter
+    def data(self, spmat):
+        self._data = spmat
+        self._cache.clear()
+
+    def __getstate__(self):
+        """ The cached operators are not pickled """
+        state = self.__dict__.copy()
+        del state['_cache']
+        return state
+
+    def __setstate__(self, state):
+        """ Also reads graphs pickled before data became a property (and
+            before the label index)
+
+        >>> import pickle
+        >>> g = SparseGraph.from_indices(['a', 'b'], ['b', 'c'])
+        >>> g.normalize().cache_info().size, g.cache_info().size
+        (0, 1)
+        >>> pickle.loads(pickle.dumps(g)).cache_info().size
+        0
+        >>> old = SparseGraph.__new__(SparseGraph)
+        >>> old.__setstate__({'data': g.data, 'names': g.names, 'shape': g.shape})
+        >>> old.to_frame().equals(g.to_frame())
+        True
+        """
+        state = dict(state)
+        if 'data' in state:
+            state['_data'] = state.pop('data')
+        if 'names' in state:
+            state['_names'] = state.pop('names')
+            state['_labels'] = None
+        state.setdefault('_label_index', None)
+        self.__dict__.update(state)
+        self._cache = OperatorCache(OPERATOR_CACHE_SIZE)
+
+    def _own_data(self):
+        """ Copy the matrix before an in-place operation if its arrays are
+            read-only (a cached operator, or memory-mapped) """
+        m = self._data
+        if not all(x.flags.writeable for x in (m.data, m.indices, m.indptr)):
+            self.data = m.copy()
+
+    def _kernel_input(self):
+        """ The matrix for the Cython kernels, which take writeable index
+            arrays: a read-only matrix is viewed over copies of its indices
+            and indptr """
+        m = self.data
+        if m.indices.flags.writeable and m.indptr.flags.writeable:
+            return m
+        return csr_matrix((m.data, m.indices.copy(), m.indptr.copy()), shape=m.shape)
+
+    def invalidate_cache(self):
+        """ Drop the cached operators (normalized / scaled matrices) """
+        self._cache.clear()
+
+    def cache_info(self):
+        """ Returns the (hits, misses, size) of the operator cache """
+        return self._cache.info()
+
+    def operator(self, normalization=None, alpha=None):
+        """ Returns an operator derived from the graph: the adjacency matrix
+            normalized by `normalization` (None, 'symmetric' or 'row') and
+            scaled by `alpha` (if not None).
+
+            Derived operators are cached (read-only) under (normalization,
+            alpha), the least recently used beyond OPERATOR_CACHE_SIZE are
+            dropped, and the cache is cleared when the graph changes (see
+            `data`).
+
+        >>> g = SparseGraph.from_indices(['a', 'a'], ['b', 'c'], [1., 1.])
+        >>> g.operator('row', 0.5) is g.operator('row', 0.5), g.cache_info()
+        (True, CacheInfo(hits=1, misses=2, size=2))
+        """
+        if normalization is None and alpha is None:
+            return self.data
+
+        def build():
+            if alpha is not None:
+                return freeze(alpha * self.operator(normalization))
+            return freeze(normalize(self.data, normalization))
+
+        return self._cache.get((normalization, alpha), build)
+
+    @property
+    def label_index(self):
+        """ The LabelIndex that maps node labels to row/column ids (built once) """
+        if self._label_index is None:
+            self._label_index = LabelIndex(self.names.index)
+        return self._label_index
+
+    def _resolve(self, key):
+        """ Translate a label (or a list of labels) to ids. Keys that are not
+            labels are returned as is (i.e., treated as positions) """
+        if isinstance(key, slice) or issparse(key) or isinstance(key, np.ndarray):
+            return key
+
+        try:
+            ids = self.label_index.positions(key)
+        except TypeError: # unhashable keys
+            return key
+
+        if len(ids) == 0 or np.any(ids < 0):
+            return key
+
+        return ids[0] if np.isscalar(key) else ids
 
     def __getitem__(self, key):
         if issparse(key) or isinstance(key, np.ndarray):
             return self.data[key]
 
-        if isinstance(key, tuple) or key in self.names.index:
-            try:
-                newkey = tuple(self.names[x] for x in key)
-                return self.data[newkey]
-            except:
-                pass
+        if isinstance(key, tuple):
+            return self.data[tuple(self._resolve(x) for x in key)]
+
+        return self.data[self._resolve(key)]
 
-        return self.data[key]
+    def lookup(self, labels, missing='raise'):
+        """ Returns the ids of the nodes labeled `labels`. See LabelIndex for
+            the `missing` policy """
+        return self.label_index.lookup(labels, missing=missing)
+
+    def edge_weights(self, i, j, missing='raise'):
+        """ Returns the weights of the edges (i[k], j[k]) (0 for non-edges).
+
+        Parameters:
+        -----------
+        i, j: equal-length sequences of node labels
+        missing: the policy for unknown labels ('raise', 'mask' or an integer,
+                 see LabelIndex)
+
+        Examples:
+        ---------
+        >>> g = SparseGraph.from_indices(['a', 'b', 'c'], ['b', 'c', 'd'], [1, 2, 3])
+        >>> g.edge_weights(['a', 'd', 'a'], ['b', 'c', 'c'])
+        array([1, 3, 0])
+        >>> g.has_edges(['a', 'x'], ['b', 'b'], missing=-1)
+        array([ True, False], dtype=bool)
+        """
+        return self.label_index.edge_weights(self.data, i, j, missing=missing)
+
+    def has_edges(self, i, j, missing='raise'):
+        """ Returns a boolean array, True where (i[k], j[k]) is an edge """
+        return self.label_index.has_edges(self.data, i, j, missing=missing)
 
     def submatrix(self, keys):
-        try:
-            keys = self.names[keys]
-        except:
-            pass
+        """ The subgraph induced by keys (labels, positions or a boolean
+            mask). The subgraph resolves labels through the label index of
+            this graph.
+
+        Example:
+        --------
+        >>> g = SparseGraph.from_indices(['a', 'a', 'b', 'c'], ['b', 'c', 'c', 'd'], [1, 2, 3, 4])
+        >>> s = g.submatrix(['c', 'a'])
+        >>> s.to_frame()
+           c  a
+        c  0  2
+        a  2  0
+        >>> s.lookup(['a'])
+        array([1])
+        """
+        ids = self.label_index.positions(keys)
+        if len(ids) == 0 or np.any(ids < 0):
+            ids = np.asarray(keys) # not labels, treat as positions
+            if ids.dtype == bool:
+                ids = np.flatnonzero(ids)
+
+        if len(np.unique(ids)) < len(ids): # repeated nodes
+            return SparseGraph(self.data[ids,:][:,ids],
+                               pd.Series(np.arange(len(ids)), self.names.index[ids]))
+
+        return self._induced(ids)
+
+    def _induced(self, ids):
+        """ The subgraph induced by unique positions """
+        return SparseGraph(induced_subgraph(self.data, ids),
+                           pd.Series(np.arange(len(ids)), self.names.index[ids]),
+                           self.label_index.subset(ids))
+
+    def neighbourhood(self, seeds, hops=1, max_nodes=None):
+        """ The subgraph induced by the nodes within `hops` edges of the
+            seeds (labels or positions, edges are followed from row to
+            column).
+
+        Parameters:
+        -----------
+        seeds:     a node or a list of nodes
+        hops:      the radius of the neighbourhood
+        max_nodes: an upper bound on the number of nodes. Once reached, the
+                   nodes of the last hop with the most edges from the
+                   previous hop are kept (ties are broken by position)
 
-        return SparseGraph(self.data[keys,:][:,keys], self.names[keys])
+        Example:
+        --------
+        >>> g = SparseGraph.from_indices(['a', 'b', 'c', 'c', 'd'], ['b', 'c', 'd', 'e', 'f'])
+        >>> g.neighbourhood('b').names.index.tolist()
+        ['a', 'b', 'c']
+        >>> g.neighbourhood(['a', 'f'], hops=2).names.index.tolist()
+        ['a', 'b', 'c', 'd', 'f']
+        >>> g.neighbourhood('d', hops=2, max_nodes=4).names.index.tolist()
+        ['b', 'c', 'd', 'f']
+        """
+        return self.ego_networks([seeds], hops, max_nodes)[0]
 
+    def ego_networks(self, seeds_list, hops=1, max_nodes=None):
+        """ neighbourhood() of every item of seeds_list (a node or a list of
+            nodes). The frontiers of all the items are expanded together,
+            with one sparse product per hop.
 
-    def normalize(self, inplace=False):
-        """ Normalization for propagation """
+        Example:
+        --------
+        >>> g = SparseGraph.from_indices(['a', 'b', 'c', 'c', 'd'], ['b', 'c', 'd', 'e', 'f'])
+        >>> [x.names.index.tolist() for x in g.ego_networks(['a', ['e', 'f']])]
+        [['a', 'b'], ['c', 'd', 'e', 'f']]
+        """
+        return [self._induced(ids) for ids in self._neighbourhood_ids(seeds_list, hops, max_nodes)]
+
+    def _neighbourhood_ids(self, seeds_list, hops, max_nodes):
+        """ The (sorted) positions of the nodes in each neighbourhood """
+        seeds = [self._node_ids(x) for x in seeds_list]
+        lengths = np.array([len(x) for x in seeds], dtype=np.int64)
+        indptr = np.zeros(len(seeds) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        cols = np.concatenate(seeds) if len(seeds) else np.empty(0, dtype=np.int64)
+
+        # one row per item, the matrices hold 1 for the reached nodes
+        reached = csr_matrix((np.ones(len(cols)), cols, indptr), shape=(len(seeds), self.shape[0]))
+        reached.sum_duplicates()
+        reached.data[:] = 1
+        frontier = reached
+
+        # shares the index arrays of data
+        pattern = self._cache.get('pattern', lambda: csr_matrix((np.ones(self.data.nnz), self.data.indices, self.data.indptr),
+                                                                shape=self.shape))
+        for hop in range(hops):
+            if frontier.nnz == 0:
+                break
+
+            counts = frontier * pattern # the number of edges from the frontier
+            counts = counts - counts.multiply(reached)
+            counts.eliminate_zeros()
+
+            if max_nodes is not None:
+                counts = _truncate_rows(counts, max_nodes - np.diff(reached.indptr))
+
+            counts.data[:] = 1
+            reached = reached + counts
+            frontier = counts
+
+        reached.sort_indices()
+        return [reached.indices[reached.indptr[k]:reached.indptr[k + 1]] for k in range(len(seeds))]
+
+
+    def normalize(self, inplace=False, kind='symmetric'):
+        """ Normalization for propagation (see propagate.normalize for `kind`).
+
+        Unless inplace, the normalized matrix is computed once and cached; the
+        returned graph shares it (read-only) and copies it before an
+        in-place operation.
+
+        Examples:
+        ---------
+        >>> g = SparseGraph.from_indices(['a', 'a'], ['b', 'c'], [1., 1.])
+        >>> h = g.normalize()
+        >>> h.data is g.normalize().data, h.data.data.flags.writeable
+        (True, False)
+        >>> g.cache_info()
+        CacheInfo(hits=1, misses=1, size=1)
+        >>> h.eliminate_zeros() # copies
+        >>> h.data is g.normalize().data, h.data.data.flags.writeable
+        (False, True)
+        >>> h.to_frame().round(3)
+               a      b      c
+        a  0.000  0.707  0.707
+        b  0.707  0.000  0.000
+        c  0.707  0.000  0.000
+        """
         if inplace:
-            data = 1.0 / np.sqrt(self.data.sum(1))
-            d = dia_matrix((data.T,[0]), (len(data),len(data)))
-            self.data = d * self.data * d
+            self.data = normalize(self.data, kind)
             return self
-    
-        return self.copy().normalize(inplace=True)
-
-    def propagate(self, y, alpha=0.6, eps=1e-5, max_iter=1000):
-        # TODO: Create nicer interface for y of type pd.Series 
-        #       (align to network and return value as Series with index)
-        f = np.copy(y)
-        y = (1-alpha)*y
-        g = alpha * self.data
-        for i in range(max_iter):
-            fold, f = f, g*f + y
-            if la.norm(f-fold) < eps:
-                break
-        return f 
+
+        return SparseGraph(self.operator(kind), self.names, self.label_index)
+
+    def propagate(self, y, alpha=0.6, eps=1e-5, max_iter=1000, method='power', x0=None, return_info=False, normalization=None):
+        """ Network propagation (smoothing) of the prior y over the graph.
+
+        Parameters:
+        -----------
+        y: the prior. One of
+           - a vector (n), the result is a vector
+           - a pandas.Series indexed by node labels (aligned to the graph,
+             missing nodes get 0), the result is a Series
+           - a block of priors (n X k array or a DataFrame indexed by node
+             labels), propagated together. The result is a DataFrame
+        alpha, eps, max_iter: see propagate.propagate
+        method: the solver, 'power' (the default), 'cg' or 'chebyshev'. The
+                latter two converge much faster for alpha close to 1 and
+                assume a symmetric normalized graph (see normalize)
+        x0: a warm start, e.g., a previous result (same form as y)
+        return_info: also return the number of iterations (see propagate.propagate)
+        normalization: propagate over the normalized graph ('symmetric' or
+                'row') rather than over the graph as is. The normalized and
+                alpha-scaled operators are cached (see operator), so
+                repeated calls skip all preprocessing.
+
+        Examples:
+        ---------
+        >>> g = SparseGraph.from_indices(['a', 'a'], ['b', 'c'], [1., 1.]).normalize()
+        >>> g.propagate(pd.Series({'a': 1.0})).round(3)
+        a    0.625
+        b    0.265
+        c    0.265
+        dtype: float64
+        >>> g.propagate(pd.DataFrame({'s1': {'a': 1.0}, 's2': {'c': 1.0}})).round(3)
+              s1     s2
+        a  0.625  0.265
+        b  0.265  0.112
+        c  0.265  0.512
+        >>> f, info = g.propagate(pd.Series({'a': 1.0}), method='cg', return_info=True)
+        >>> f.round(3).tolist(), info['iterations']
+        ([0.625, 0.265, 0.265], 1)
+        >>> g = SparseGraph.from_indices(['a', 'a'], ['b', 'c'], [1., 1.])
+        >>> f = g.propagate(pd.Series({'a': 1.0}), normalization='symmetric')
+        >>> f = g.propagate(pd.Series({'b': 1.0}), normalization='symmetric')
+        >>> g.cache_info()
+        CacheInfo(hits=3, misses=2, size=2)
+        """
+        labels = self.names.index
+        if isinstance(y, (pd.Series, pd.DataFrame)):
+            values = y.reindex(labels).fillna(0).values
+            if x0 is not None:
+                x0 = x0.reindex(labels).fillna(0).values
+        else:
+            values = y
+
+        f, info = propagate(self.operator(normalization), values, alpha, eps, max_iter, method=method, x0=x0,
+                            return_info=True, operator=self.operator(normalization, alpha))
+
+        if isinstance(y, pd.Series):
+            f = pd.Series(f, labels, name=y.name)
+        elif isinstance(y, pd.DataFrame):
+            f = pd.DataFrame(f, labels, y.columns)
+        elif f.ndim == 2:
+            f = pd.DataFrame(f, labels)
+
+        if return_info:
+            return f, info
+        return f
     smooth = propagate # alias
+
+    def propagation_significance(self, y, n_permutations=1000, batch_size=100, n_jobs=None, seed=None,
+                                 normalization=None, directed=False, shuffle_iterations=None, **kwargs):
+        """ Empirical p-values for propagation scores, against degree-preserving
+        shuffles of the graph (see propagate.significance).
+
+        Shuffled graphs are generated and propagated in batches of batch_size
+        and only running statistics are kept, so memory does not grow with
+        n_permutations. When the graph is not normalized already, pass
+        normalization='symmetric' so every shuffled graph is normalized
+        before propagation.
+
+        Parameters:
+        -----------
+        y: the prior, a vector or a pandas.Series indexed by node labels
+        n_permutations, batch_size, n_jobs, seed, normalization, directed,
+        shuffle_iterations: see propagate.significance
+        **kwargs: passed to propagate (alpha, eps, method, ...)
+
+        Returns a DataFrame indexed by node labels with the columns score,
+        pvalue, zscore, null_mean and null_std.
+
+        Examples:
+        ---------
+        >>> i, j = zip(('a', 'b'), ('a', 'c'), ('b', 'c'), ('c', 'd'), ('c', 'f'), ('d', 'e'), ('d', 'g'), ('e', 'g'), ('f', 'h'))
+        >>> g = SparseGraph.from_indices(i, j)
+        >>> r = g.propagation_significance(pd.Series({'a': 1.0}), n_permutations=20, batch_size=8, seed=1, normalization='symmetric')
+        >>> list(r.columns)
+        ['score', 'pvalue', 'zscore', 'null_mean', 'null_std']
+        >>> bool((r.pvalue > 0).all() and (r.pvalue <= 1).all())
+        True
+        """
+        labels = self.names.index
+        if isinstance(y, pd.Series):
+            y = y.reindex(labels).fillna(0).values
+
+        result = significance(self.data, y, n_permutations=n_permutations, batch_size=batch_size,
+                              n_jobs=n_jobs, seed=seed, normalization=normalization, directed=directed,
+                              shuffle_iterations=shuffle_iterations, **kwargs)
+
+        return pd.DataFrame(result, labels, columns=('score', 'pvalue', 'zscore', 'null_mean', 'null_std'))
     
-    def mcl(self, **kwargs):
+    def mcl(self, select=None, recover=None, block_size=None, return_stats=False, n_jobs=1, **kwargs):
         """ A straightforward implementation for Markov Cluster.
 
         Parameters: 
         -----------
-        see mcl module
+        select:       keep at most this many entries per column after each
+                      iteration (bounds the memory to about select * n entries)
+        recover:      recover pruned entries of columns that lost too much of
+                      their mass (see mcl.prune)
+        block_size:   expand this many columns at a time (bounds the memory of
+                      the unpruned product)
+        return_stats: also return a DataFrame with the nnz and memory (bytes)
+                      of each iteration
+        n_jobs:       cluster the connected components in n_jobs processes
+                      (small components are batched together, see
+                      mcl.component_batches). The clusters are the same
+        **kwargs:     see mcl module (inflation, expansion, cap, ...)
 
         Examples:
         ---------
@@ -108,10 +503,143 @@ class SparseGraph(object):
         [array(['a', 'b', 'c', 'd', 'e'], dtype=object), array(['f', 'g', 'h'], dtype=object)]
         >>> [np.sort(c) for c in g.mcl(inflation=1.2)]
         [array(['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'], dtype=object)]
+        >>> clusters, stats = g.mcl(select=4, block_size=3, return_stats=True)
+        >>> [np.sort(c) for c in clusters]
+        [array(['a', 'b', 'c', 'd', 'e'], dtype=object), array(['f', 'g', 'h'], dtype=object)]
+        >>> list(stats.columns)
+        ['nnz', 'expanded_nnz', 'max_column_nnz', 'chaos', 'bytes']
+        >>> [np.sort(c) for c in g.mcl(n_jobs=2, batch_nodes=4)]
+        [array(['a', 'b', 'c', 'd', 'e'], dtype=object), array(['f', 'g', 'h'], dtype=object)]
         """
        
-        clusters = mcl(self.data, **kwargs)
-        return [self.names.index[c].values for c in clusters]
+        result = mcl(self.data, select=select, recover=recover, block_size=block_size, return_stats=return_stats,
+                     n_jobs=n_jobs, **kwargs)
+        if return_stats:
+            clusters, stats = result
+        else:
+            clusters = result
+
+        clusters = [self.names.index[c].values for c in clusters]
+        if return_stats:
+            stats = pd.DataFrame(stats, columns=('iteration', 'nnz', 'expanded_nnz', 'max_column_nnz', 'chaos', 'bytes'))
+            return clusters, stats.set_index('iteration')
+        return clusters
+
+    def mcl_sweep(self, inflations, n_jobs=None, **kwargs):
+        """ Markov Cluster at several inflation values, e.g., to choose the
+        granularity of the clustering. The matrix is prepared once and the
+        runs are concurrent, see mcl.sweep.
+
+        Parameters:
+        -----------
+        inflations: the inflation values
+        n_jobs:     the number of threads (default: all available)
+        **kwargs:   see mcl.sweep
+
+        Returns a tuple of DataFrames: the assignments (one row per inflation,
+        cluster and node) and per-inflation stats (number of clusters,
+        iterations, seconds, final nnz and chaos, peak bytes)
+
+        Examples:
+        ---------
+        >>> g = SparseGraph.from_indices(['a', 'a', 'b', 'b', 'b', 'c', 'c', 'd', 'd', 'f', 'f', 'g'], ['b', 'd', 'd', 'c', 'e', 'd', 'e', 'e', 'f', 'g', 'h', 'h'])
+        >>> assignments, stats = g.mcl_sweep([1.2, 2.0])
+        >>> assignments[assignments.inflation == 2.0].groupby('cluster').node.apply(sorted).tolist()
+        [['a', 'b', 'c', 'd', 'e'], ['f', 'g', 'h']]
+        >>> stats.clusters.tolist()
+        [1, 2]
+        """
+        runs = sweep(self.data, inflations, n_jobs=n_jobs, **kwargs)
+        labels = self.names.index.values
+
+        frames = []
+        for run in runs:
+            clusters = run['clusters']
+            sizes = [len(c) for c in clusters]
+            members = np.concatenate(clusters) if clusters else np.empty(0, dtype=np.int)
+            frames.append(pd.DataFrame({'inflation': run['inflation'],
+                                        'cluster': np.repeat(np.arange(len(clusters)), sizes),
+                                        'node': labels[members]},
+                                       columns=('inflation', 'cluster', 'node')))
+        assignments = pd.concat(frames, ignore_index=True)
+
+        stats = pd.DataFrame([{'inflation': run['inflation'],
+                               'clusters': len(run['clusters']),
+                               'iterations': run['iterations'],
+                               'seconds': run['seconds'],
+                               'nnz': run['stats'][-1]['nnz'] if run['stats'] else 0,
+                               'chaos': run['stats'][-1]['chaos'] if run['stats'] else 0.0,
+                               'max_bytes': max([x['bytes'] for x in run['stats']] or [0])} for run in runs],
+                             columns=('inflation', 'clusters', 'iterations', 'seconds', 'nnz', 'chaos', 'max_bytes'))
+
+        return assignments, stats.set_index('inflation')
+
+    def k_cores(self):
+        """ The core number of every node (the largest k such that the node
+            is in the k-core, the maximal subgraph with minimum degree k).
+            The graph is treated as undirected, self loops are ignored.
+
+        Examples:
+        ---------
+        >>> g = SparseGraph.from_indices(['a', 'a', 'b', 'c'], ['b', 'c', 'c', 'd'])
+        >>> g.k_cores()
+        a    2
+        b    2
+        c    2
+        d    1
+        Name: core, dtype: int32
+        """
+        return pd.Series(k_cores(self._kernel_input()), self.names.index, name='core')
+
+    def k_core_subgraph(self, k):
+        """ The k-core: the subgraph induced by the nodes with core number of
+            at least k
+
+        Examples:
+        ---------
+        >>> g = SparseGraph.from_indices(['a', 'a', 'b', 'c'], ['b', 'c', 'c', 'd'])
+        >>> g.k_core_subgraph(2).names.index.tolist()
+        ['a', 'b', 'c']
+        >>> SparseGraph.from_indices([1, 2, 2, 3], [2, 3, 4, 4]).k_core_subgraph(2).names.index.tolist()
+        [2, 3, 4]
+        """
+        return self._induced(np.flatnonzero(k_cores(self._kernel_input()) >= k))
+
+    def k_truss(self, k=None):
+        """ k-truss decomposition (the graph must be symmetric).
+
+        Parameters:
+        -----------
+        k: if None, return a graph with the pattern of this one (without self
+           loops) whose weights are the truss numbers of the edges. Otherwise
+           return the k-truss: the edges (with their weights) with a truss
+           number of at least k, and the nodes they touch
+
+        Examples:
+        ---------
+        >>> g = SparseGraph.from_indices(['a', 'a', 'b', 'c'], ['b', 'c', 'c', 'd'])
+        >>> g.k_truss().to_frame()
+           a  b  c  d
+        a  0  3  3  0
+        b  3  0  3  0
+        c  3  3  0  2
+        d  0  0  2  0
+        >>> g.k_truss(3).names.index.tolist()
+        ['a', 'b', 'c']
+        >>> SparseGraph.from_indices([1, 2, 2, 3], [2, 3, 4, 4]).k_truss(3).names.index.tolist()
+        [2, 3, 4]
+        """
+        truss = k_truss(self._kernel_input())
+        if k is None:
+            return SparseGraph(truss, self.names, self.label_index)
+
+        keep = truss.data >= k
+        rows = np.repeat(np.arange(truss.shape[0]), np.diff(truss.indptr))
+        nodes = np.unique(rows[keep])
+        weights = csr_matrix(self.data)
+        weights = csr_matrix((np.asarray(weights[rows[keep], truss.indices[keep]]).ravel(),
+                              (rows[keep], truss.indices[keep])), shape=truss.shape)
+        return SparseGraph(weights, self.names, self.label_index)._induced(nodes)
 
     def topological_sort(self):
         """ Returns an ordered list of the nodes of a DAG so that 
@@ -125,7 +653,26 @@ class SparseGraph(object):
         >>> g.topological_sort()
         array([ 7,  5, 11,  3, 10,  8,  9,  2])
         """
-        return self.names.index.values[topological_sort(self.data)]
+        return self.names.index.values[topological_sort(self._kernel_input())]
+
+    def topological_levels(self):
+        """ Groups the nodes of a DAG by depth: the first group holds the
+            nodes without incoming edges and every other node is in the
+            group after the deepest of its predecessors, so all the edges
+            go from a group to a later one and the nodes within a group
+            can be processed independently. Raises ValueError if the graph
+            has a cycle.
+
+        Example:
+        --------
+
+        >>> g = SparseGraph.from_indices([7, 7, 5, 3, 3, 11, 11, 11, 8], [11, 8, 11, 8, 10, 2, 9, 10, 9], symmetric=False)
+        >>> g.topological_levels()
+        [array([3, 5, 7]), array([ 8, 11]), array([ 2,  9, 10])]
+        """
+        order, levels = topological_levels(self._kernel_input())
+        bounds = np.flatnonzero(np.diff(levels[order])) + 1
+        return np.split(self.names.index.values[order], bounds)
 
     def depth_first_order(self, i, return_predecessors=True):
         """ Performs a depth-first walk on the graph and return 
@@ -149,13 +696,87 @@ class SparseGraph(object):
         if i in self.names.index:
             i = self.names[i]
 
-        result = depth_first_order(self.data, i, return_predecessors=return_predecessors, scipy_compat=False)
+        result = depth_first_order(self._kernel_input(), i, return_predecessors=return_predecessors, scipy_compat=False)
 
         if return_predecessors:
             return self.names.index[result[0]].values, self.names.index[result[1]].values
 
         return self.names.index[result[0]].values
 
+    def traversal(self):
+        """ The (cached) Traversal of the graph, see traversal.Traversal """
+        return self._cache.get('traversal', lambda: Traversal(self._kernel_input()))
+
+    def _node_ids(self, keys):
+        return np.atleast_1d(self._resolve(keys))
+
+    def bfs(self, sources, max_hops=None):
+        """ Breadth-first search from all the sources (labels or positions)
+            at once, following edges from row to column.
+
+            Returns a Series of the distance (in edges) from the nearest
+            source, indexed by the reached nodes in the order they were found.
+
+        Example:
+        --------
+        >>> g = SparseGraph.from_indices(['a', 'b', 'c', 'e'], ['b', 'c', 'd', 'f'])
+        >>> g.bfs(['a', 'f'], max_hops=2)
+        a    0
+        f    0
+        b    1
+        e    1
+        c    2
+        Name: hops, dtype: int64
+        """
+        order, hops = self.traversal().bfs(self._node_ids(sources), max_hops)
+        return pd.Series(hops, self.names.index[order], name='hops')
+
+    def dfs(self, sources, max_hops=None):
+        """ Depth-first search from each of the sources in turn. As bfs,
+            except that the hops are the depths in the search tree.
+
+        Example:
+        --------
+        >>> g = SparseGraph.from_indices(['a', 'b', 'c', 'e'], ['b', 'c', 'd', 'f'])
+        >>> g.dfs(['b', 'e']).index.tolist()
+        ['b', 'a', 'c', 'd', 'e', 'f']
+        """
+        order, hops = self.traversal().dfs(self._node_ids(sources), max_hops)
+        return pd.Series(hops, self.names.index[order], name='hops')
+
+    def connected_components(self, connection='weak'):
+        """ The component of every node ('weak' or 'strong' connection),
+            numbered in order of the first node of each component.
+
+        Example:
+        --------
+        >>> g = SparseGraph.from_indices(['a', 'b', 'c'], ['b', 'a', 'd'], symmetric=False)
+        >>> g.connected_components()
+        a    0
+        b    0
+        c    1
+        d    1
+        Name: component, dtype: int64
+        >>> g.connected_components('strong').tolist()
+        [0, 0, 1, 2]
+        """
+        _, labels = self.traversal().connected_components(connection)
+        return pd.Series(labels, self.names.index, name='component')
+
+    def reachable(self, queries, max_hops=None, n_jobs=None):
+        """ The labels of the nodes reachable from each query (a node or a
+            list of nodes) within max_hops edges, answered concurrently by
+            n_jobs threads.
+
+        Example:
+        --------
+        >>> g = SparseGraph.from_indices(['a', 'b', 'c', 'e'], ['b', 'c', 'd', 'f'])
+        >>> g.reachable(['a', ['e', 'd']], max_hops=1)
+        [array(['a', 'b'], dtype=object), array(['e', 'd', 'f', 'c'], dtype=object)]
+        """
+        ids = [self._node_ids(x) for x in queries]
+        return [self.names.index.values[x] for x in reachable(self._kernel_input(), ids, max_hops, n_jobs)]
+
     def edges(self, symmetric=True):
         if symmetric:
             return (np.count_nonzero(self.data.diagonal()) + self.data.nnz) / 2
@@ -172,13 +793,15 @@ class SparseGraph(object):
         indices = np.where(b)[0]
         return pd.Series(data=b[indices], index=indices, name='count')
 
-    def merge(self, other):
-        """ Combine two networks (based on their node labels). Weight for
-        duplicate edges are taken from other.
+    def merge(self, other, how='other'):
+        """ Combine two networks (based on their node labels). By default,
+        weights for duplicate edges are taken from other.
 
         Parameters:
         -----------
         other: the network to merge
+        how:   the weight of edges that appear in both networks: 'other',
+               'self', 'max', 'min', 'sum' or 'mean'
 
         Returns the merged network
 
@@ -208,16 +831,87 @@ class SparseGraph(object):
         d  0  0  1  0  2
         e  2  0  0  2  0
         """
-        df = self.to_frame(asmatrix=False, symmetric=False)
-        df = df.append(other.to_frame(asmatrix=False, symmetric=False), ignore_index=True)
-        df.drop_duplicates(subset=('i', 'j'), take_last=True, inplace=True)
-        return self.from_indices(df.i, df.j, df.data, symmetric=False)
-        
+        return SparseGraph.merge_all([self, other], how=_MERGE_ALIASES.get(how, how))
+
+    @staticmethod
+    def merge_all(graphs, how='last'):
+        """ Combine several networks (based on their node labels) in a single pass.
+
+        Node labels are aligned once: nodes keep the order of the first
+        network, followed by nodes first seen in later ones. The edges of all
+        networks are then combined directly in sparse form.
+
+        Parameters:
+        -----------
+        graphs: a sequence of SparseGraphs
+        how:    the weight of edges that appear in several networks: 'last'
+                (the default), 'first', 'max', 'min', 'sum' or 'mean'
+
+        Examples:
+        ---------
+        >>> g1 = SparseGraph.from_indices(['a', 'b'], ['b', 'c'], [1., 1.])
+        >>> g2 = SparseGraph.from_indices(['a', 'c'], ['b', 'd'], [3., 3.])
+        >>> g3 = SparseGraph.from_indices(['b'], ['a'], [5.])
+        >>> SparseGraph.merge_all([g1, g2, g3], how='mean').to_frame()
+             a    b    c    d
+        a  0.0  3.0  0.0  0.0
+        b  3.0  0.0  1.0  0.0
+        c  0.0  1.0  0.0  3.0
+        d  0.0  0.0  3.0  0.0
+        """
+        if how not in COALESCE_METHODS:
+            raise ValueError("Unknown merge method: %r" % (how,))
+
+        graphs = list(graphs)
+        if len(graphs) == 0:
+            raise ValueError("Nothing to merge")
+
+        labels = graphs[0].names.index
+        for g in graphs[1:]:
+            other = g.names.index
+            labels = labels.append(other[~other.isin(labels)])
+        index = graphs[0].label_index if len(labels) == len(graphs[0].names) else LabelIndex(labels)
+
+        rows, cols, data = [], [], []
+        for k, g in enumerate(graphs):
+            m = g.data
+            row = np.repeat(np.arange(m.shape[0], dtype=np.int32), np.diff(m.indptr))
+            col = m.indices
+            if k > 0: # the first network is already aligned
+                remap = index.positions(g.names.index).astype(np.int32)
+                row, col = remap[row], remap[col]
+            rows.append(row)
+            cols.append(col)
+            data.append(m.data)
+
+        rows, cols, data = coalesce(np.concatenate(rows), np.concatenate(cols),
+                                    np.concatenate(data), how=how)
+
+        names = pd.Series(np.arange(len(labels), dtype=np.int), labels)
+        return SparseGraph(csr_from_sorted(rows, cols, data, len(labels)), names, index)
 
     def copy(self):
-        return SparseGraph(self.data.copy(), self.names.copy())
+        return SparseGraph(self.data.copy(), self.names.copy(), self.label_index)
+
+    def lazy(self):
+        """ A LazyGraph: elementwise operations on it are recorded and fused
+            into a single pass over data by compute() (see the lazy module)
+
+        Example:
+        --------
+        >>> g = SparseGraph.from_indices(['a', 'b'], ['b', 'c'], [1., 4.])
+        >>> ((g.lazy() > 2).multiply(g).sqrt() * 3).compute().to_frame()
+             a    b    c
+        a  0.0  0.0  0.0
+        b  0.0  0.0  6.0
+        c  0.0  6.0  0.0
+        """
+        from .lazy import LazyGraph
+        return LazyGraph(self)
 
     def shuffle(self, directed=False, max_iterations=None, seed=0):
+        self._own_data()
+        self.invalidate_cache() # shuffles in-place
         return shuffle(self.data, directed=directed,
                        max_iterations=max_iterations, seed=seed)
 
@@ -225,48 +919,103 @@ class SparseGraph(object):
         random_networks = shuffled_copies(self.data, n, directed=directed,
                                           max_iterations=max_iterations,
                                           seed=seed)
-        return [SparseGraph(x, self.names) for x in random_networks]
+        return [SparseGraph(x, self.names, self.label_index) for x in random_networks]
+
+    def shuffled_ensemble(self, n, directed=False, max_iterations=None, seed=None, **kwargs):
+        """ n degree-preserving shuffles of the graph, stored compactly (one
+            shared indptr, see ensemble.ShuffledEnsemble for the options).
+            Indexing the ensemble returns SparseGraph views of the copies. """
+        from .ensemble import ShuffledEnsemble
+
+        return ShuffledEnsemble(self.data, n, directed=directed, max_iterations=max_iterations, seed=seed,
+                                names=self.names, label_index=self.label_index, **kwargs)
 
     def pdist(self, metric='correlation', *args, **kwargs):
+        """ Pairwise distances (or similarities) between the neighbourhoods
+        (rows) of the nodes.
+
+        Parameters:
+        -----------
+        metric:   one of metrics.similarity.METRICS ('cosine', 'correlation',
+                  'pearson_neighbours', 'jaccard'), computed on the sparse
+                  matrix in blocks of rows, or any other metric of
+                  scipy.spatial.distance.pdist (on the dense matrix)
+        output:   (keyword) for the sparse metrics:
+                  'dense':  a DataFrame of distances (1 - similarity, the
+                            default)
+                  'sparse': a SparseGraph of the similarities that are at
+                            least min_similarity
+                  'topk':   a SparseGraph with the k most similar nodes of
+                            each node (edges from the node)
+        min_similarity, k, block_size, n_jobs, include_self:
+                  (keywords) see metrics.similarity
+
+        Examples:
+        ---------
+        >>> g = SparseGraph.from_indices(['a', 'a', 'b', 'c'], ['b', 'c', 'c', 'd'])
+        >>> g.pdist('cosine').round(3)
+               a      b      c      d
+        a  0.000  0.500  0.592  0.293
+        b  0.500  0.000  0.592  0.293
+        c  0.592  0.592  0.000  1.000
+        d  0.293  0.293  1.000  0.000
+        >>> g.pdist('cosine', output='topk', k=1).to_frame().round(3)
+             a      b    c      d
+        a  0.0  0.000  0.0  0.707
+        b  0.0  0.000  0.0  0.707
+        c  0.0  0.408  0.0  0.000
+        d  0.0  0.707  0.0  0.000
+        >>> g.pdist('jaccard', output='sparse', min_similarity=0.5).to_frame()
+             a    b    c    d
+        a  0.0  0.0  0.0  0.5
+        b  0.0  0.0  0.0  0.5
+        c  0.0  0.0  0.0  0.0
+        d  0.5  0.5  0.0  0.0
+        """
 #        pd.DataFrame(1.0-pairwise_distances(holstege, metric='correlation', n_jobs=-1), 
 #                                      index=holstege.index, columns=holstege.index)
-        if metric=='jaccard':
+        if metric=='jaccard' and kwargs.get('output', 'dense') == 'dense':
+            kwargs.pop('output', None)
             distances = jaccard_distance(self.data, *args, **kwargs)
+        elif metric in SIMILARITY_METRICS:
+            output = kwargs.pop('output', 'dense')
+            result = similarity(self.data, metric, output, *args, **kwargs)
+            if output != 'dense':
+                return SparseGraph(result, self.names, self.label_index)
+            distances = 1.0 - result
+            np.fill_diagonal(distances, 0) # as squareform
         else:
             distances = distance.squareform(distance.pdist(self.data.todense(), metric, *args, **kwargs))
         return pd.DataFrame(distances, self.names.index, self.names.index)
 
-    def to_cyjs(self, node_attributes=None, symmetric=True):
-        source, target = self.data.nonzero()
-        data = self.data.data
-        if symmetric:
-            mask = source < target
-            source = source[mask]
-            target = target[mask]
-            data = data[mask]
-
-        nodes_df = pd.DataFrame({'name': self.names.index, 'id': range(self.names.shape[0])})
-        nodes_df['id'] = nodes_df['id'].astype(str)
-        if not node_attributes is None:
-            if isinstance(node_attributes, pd.DataFrame):
-                vals = nodes_df.name[nodes_df.name.isin(node_attributes.index)].apply(lambda x: node_attributes.loc[x])
-            else:
-                vals = nodes_df.name[nodes_df.name.isin(node_attributes.keys())].apply(lambda x: pd.Series(node_attributes[x])) 
-            nodes_df = nodes_df.merge(vals, how='left', left_index=True, right_index=True)
+    def to_cyjs(self, node_attributes=None, symmetric=True, f=None, indent=3, chunk_size=100000):
+        """ Export to Cytoscape.js JSON (see cytoscape.write_cyjs).
 
-        edges_df = pd.DataFrame({'source': source, 'target': target, 'value': data})
-        # hack for pandas df behavior that will turn all columns to one dtype
-        edges_df.source = edges_df.source.astype(str)
-        edges_df.target = edges_df.target.astype(str)
-
-        def map_dict(df):
-            return [{'data': x} for x in df.to_dict('records')]
+        Parameters:
+        -----------
+        node_attributes: a DataFrame indexed by label or a dict of dicts
+        symmetric:       export each edge once
+        f:               a file object to stream the JSON to (returns None).
+                         By default the JSON is returned as a string
+        indent:          the indentation, None for compact output
+        chunk_size:      the number of nodes/edges encoded at once
 
-        import json
+        Example:
+        --------
+        >>> import json
+        >>> g = SparseGraph.from_indices(['a', 'b'], ['b', 'c'], [1., 2.])
+        >>> attributes = pd.DataFrame({'score': [0.5]}, index=['c'])
+        >>> cyjs = json.loads(g.to_cyjs(attributes))
+        >>> [x['data']['score'] for x in cyjs['elements']['nodes']]
+        [None, None, 0.5]
+        >>> [x['data']['value'] for x in cyjs['elements']['edges']]
+        [1.0, 2.0]
+        """
+        from .cytoscape import write_cyjs, to_cyjs
 
-        return json.dumps({'elements': {'nodes': map_dict(nodes_df),
-                                        'edges': map_dict(edges_df) },
-                           'data': {} }, indent=3)
+        if f is None:
+            return to_cyjs(self.data, self.names.index, node_attributes, symmetric, indent, chunk_size)
+        write_cyjs(f, self.data, self.names.index, node_attributes, symmetric, indent, chunk_size)
 
     def to_frame(self, asmatrix=True, symmetric=True):
         """ Convert the current network to pandas.DataFrame 
@@ -306,22 +1055,105 @@ class SparseGraph(object):
         """
 
         if not asmatrix:
-            inv = self.names.index.to_series()
+            labels = self.names.index.values
 
             if symmetric:
                 i, j = self.data.nonzero()
                 mask = i <= j
-                i = inv.iloc[i[mask]].values
-                j = inv.iloc[j[mask]].values
+                i = labels[i[mask]]
+                j = labels[j[mask]]
                 data = self.data.data[mask]
             else:
-                i, j = [inv.iloc[x].values for x in self.data.nonzero()]
+                i, j = [labels[x] for x in self.data.nonzero()]
                 data = self.data.data
 
             return pd.DataFrame({'i': i, 'j': j, 'data': data}, columns=('i','j','data'))
 
         return pd.DataFrame(data=np.asarray(self.data.todense()), index=self.names.index, columns=self.names.index)
 
+    def save(self, path):
+        """ Store the graph in the directory `path` (see the storage module).
+            Use SparseGraph.load to read it back.
+
+        Examples:
+        ---------
+        >>> import tempfile, shutil
+        >>> path = tempfile.mkdtemp()
+        >>> g = SparseGraph.from_indices(['a', 'b', 'c'], ['b', 'c', 'd'], [1., 2., 3.])
+        >>> g.save(path)
+        >>> h = SparseGraph.load(path)
+        >>> h._names is None # the labels stay mapped until they are used
+        True
+        >>> h.to_frame()
+             a    b    c    d
+        a  0.0  1.0  0.0  0.0
+        b  1.0  0.0  2.0  0.0
+        c  0.0  2.0  0.0  3.0
+        d  0.0  0.0  3.0  0.0
+        >>> shutil.rmtree(path)
+        """
+        storage.save(self.data, self.names.index, path)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """ Load a graph stored with SparseGraph.save.
+
+        Parameters:
+        -----------
+        path: the directory the graph was saved to
+        mmap: memory-map the arrays rather than reading them. Loading is then
+              O(1) and processes that load the same graph share memory. The
+              arrays are read-only: in-place operations (e.g., shuffle,
+              eliminate_zeros) copy them first.
+        """
+        m, labels = storage.load(path, mmap=mmap)
+        return SparseGraph(m, labels)
+
+    def to_edgelist(self, path, format=None, symmetric=True, chunk_size=1000000):
+        """ Store the edges in a columnar file (see the edgelist module):
+            the endpoints as integer codes and the labels once.
+
+        Parameters:
+        -----------
+        path:       the file name
+        format:     'parquet', 'feather' or 'npz' (default: by the extension)
+        symmetric:  store each edge once (i <= j), from_edgelist mirrors them
+                    back unless told otherwise
+        chunk_size: the number of entries converted (and written) at once
+
+        Examples:
+        ---------
+        >>> import tempfile, shutil, os
+        >>> path = tempfile.mkdtemp()
+        >>> g = SparseGraph.from_indices(['a', 'b', 'c'], ['b', 'c', 'd'], [1., 2., 3.])
+        >>> g.to_edgelist(os.path.join(path, 'g.npz'))
+        >>> SparseGraph.from_edgelist(os.path.join(path, 'g.npz'), min_weight=2).to_frame()
+             a    b    c    d
+        a  0.0  0.0  0.0  0.0
+        b  0.0  0.0  2.0  0.0
+        c  0.0  2.0  0.0  3.0
+        d  0.0  0.0  3.0  0.0
+        >>> SparseGraph.from_edgelist(os.path.join(path, 'g.npz'), filters=[('i', '==', 'c')]).to_frame()
+             a    b    c    d
+        a  0.0  0.0  0.0  0.0
+        b  0.0  0.0  0.0  0.0
+        c  0.0  2.0  0.0  3.0
+        d  0.0  0.0  0.0  0.0
+        >>> g.to_edgelist(os.path.join(path, 'directed.npz'), symmetric=False)
+        >>> SparseGraph.from_edgelist(os.path.join(path, 'directed.npz')).to_frame().equals(g.to_frame())
+        True
+        >>> shutil.rmtree(path)
+        """
+        edgelist.write(self.data, self.names.index, path, format, symmetric, chunk_size)
+
+    @staticmethod
+    def from_edgelist(path, format=None, min_weight=None, filters=None, symmetric=None):
+        """ Load a graph stored with to_edgelist, optionally only the edges
+            with weight >= min_weight or that pass filters (see edgelist.read).
+            All the nodes are kept. """
+        m, labels = edgelist.read(path, format, min_weight, filters, symmetric)
+        return SparseGraph(m, pd.Series(np.arange(len(labels), dtype=np.int), labels))
+
     @staticmethod 
     def from_indices(i, j, data=None, symmetric=True, names=None):
         """ Create a sparse network from a list of edges. 
@@ -366,30 +1198,41 @@ class SparseGraph(object):
         if isinstance(j, tuple):
             j = list(j)
 
-        if names is None:
-            allnames = np.union1d(i, j)
-            names = pd.Series(np.arange(allnames.shape[0], dtype=np.int), allnames)
-        else:
-            allnames = names.index.values
-            mask = np.in1d(i, allnames) & np.in1d(j, allnames)
-            i = i[mask]
-            j = j[mask]
-
         if data is None:
             data = np.ones(len(i), dtype=np.int)
         elif np.isscalar(data):
             data *= np.ones(len(i), dtype=np.int)
 
-        smatrix = csr_matrix((data, (names.loc[i], names.loc[j])), shape=(allnames.shape[0], allnames.shape[0]))
+        label_index = None
+        if names is None:
+            allnames = np.union1d(i, j)
+            names = pd.Series(np.arange(allnames.shape[0], dtype=np.int), allnames)
+            # allnames is sorted, no need for hashing
+            row = np.searchsorted(allnames, i)
+            col = np.searchsorted(allnames, j)
+        else:
+            allnames = names.index.values
+            label_index = LabelIndex(names.index)
+            row = label_index.positions(i)
+            col = label_index.positions(j)
+            mask = (row >= 0) & (col >= 0)
+            row = row[mask]
+            col = col[mask]
+            data = np.asarray(data)[mask]
+
+        smatrix = csr_matrix((data, (row, col)), shape=(allnames.shape[0], allnames.shape[0]))
         data = smatrix if not symmetric else smatrix + smatrix.T
 
-        return SparseGraph(data, names)
+        return SparseGraph(data, names, label_index=label_index)
 
     @classmethod
     def _add_comparison_method(cls):
 
         def create_comp_method(op, eliminate_zeros=False):
             def comp_method(self, other):
+                if op.__name__.startswith('__i'): # in-place
+                    self._own_data()
+
                 if isinstance(other, SparseGraph):
                     result = op(self.data, other.data)
                 else:
@@ -400,7 +1243,7 @@ class SparseGraph(object):
                         result.eliminate_zeros()
 
                     if result.shape == self.data.shape:
-                        return SparseGraph(result, self.names)
+                        return SparseGraph(result, self.names, self.label_index)
 
                 return result
 
@@ -434,14 +1277,22 @@ class SparseGraph(object):
     @classmethod
     def _add_sparse_ops(cls):
 
+        IN_PLACE = ('eliminate_zeros', 'prune', 'sort_indices', 'sum_duplicates')
+
         def create_noarg_method(method):
             def wrapper(self):
+                if method.__name__ in IN_PLACE:
+                    self._own_data()
+
                 result = method(self.data)
                 
+                if result is None: # an in-place operation (e.g., sort_indices)
+                    self.invalidate_cache()
+
                 if (result is not None) and \
                    hasattr(result, 'shape') and \
                    (result.shape == self.data.shape):
-                    return SparseGraph(result, self.names.copy())
+                    return SparseGraph(result, self.names, self.label_index)
 
                 return result
 
@@ -475,7 +1326,6 @@ class SparseGraph(object):
         cls.ceil = create_noarg_method(csr_matrix.ceil)
         cls.conj = create_noarg_method(csr_matrix.conj)
         cls.conjugate = create_noarg_method(csr_matrix.conjugate)
-        cls.copy = create_noarg_method(csr_matrix.copy)
 
         cls.diagonal = create_noarg_method(csr_matrix.diagonal)
         cls.eliminate_zeros = create_noarg_method(csr_matrix.eliminate_zeros)
@@ -506,6 +1356,25 @@ class SparseGraph(object):
         cls.mean = create_axis_method(csr_matrix.mean)
         cls.min = create_axis_method(csr_matrix.min)
 
+def _truncate_rows(m, room):
+    """ Keep at most room[k] entries of row k of a csr_matrix, those with
+        the largest values (the first ones on ties) """
+    lengths = np.diff(m.indptr)
+    room = np.maximum(room, 0)
+    if not (lengths > room).any():
+        return m
+
+    # rank the entries of every row at once (lexsort is stable, so ties
+    # keep their order)
+    row_of = np.repeat(np.arange(m.shape[0]), lengths)
+    order = np.lexsort((-m.data, row_of))
+    rank = np.empty(m.nnz, dtype=np.int64)
+    rank[order] = np.arange(m.nnz) - m.indptr[row_of]
+    keep = rank < room[row_of]
+
+    row_of = row_of[keep]
+    return csr_matrix((m.data[keep], (row_of, m.indices[keep])), shape=m.shape)
+
 SparseGraph._add_comparison_method()
 SparseGraph._add_sparse_ops()
 
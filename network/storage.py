@@ -0,0 +1,108 @@
+"""
+On-disk format for SparseGraph.
+
+A graph is stored as a directory holding one .npy file per csr array
+(indptr, indices, data), the node labels (names.npy) and a small json
+header with the format version and the shape. Loading memory-maps the
+arrays, so it takes constant time and processes that load the same graph
+share the page cache.
+"""
+import os
+import json
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from ..os_utils import mkdir
+
+FORMAT_NAME = 'mypy.network.SparseGraph'
+FORMAT_VERSION = 1
+
+HEADER_FILENAME = 'header.json'
+ARRAYS = ('indptr', 'indices', 'data', 'names')
+
+def save(m, names, path):
+    """ Store a csr_matrix and its node labels in the directory `path`
+        (created if needed, existing files are overwritten).
+
+    Parameters:
+    -----------
+    m:     a csr_matrix
+    names: the node labels (a pandas.Index or an array)
+    path:  the target directory
+    """
+    if not isinstance(m, csr_matrix):
+        m = csr_matrix(m)
+
+    names = _encode_names(names)
+    if names.shape[0] != m.shape[0]:
+        raise ValueError("Number of labels does not match the matrix")
+
+    mkdir(path)
+
+    arrays = {'indptr': m.indptr, 'indices': m.indices, 'data': m.data, 'names': names}
+    for name in ARRAYS:
+        np.save(os.path.join(path, name + '.npy'), arrays[name])
+
+    header = {'format': FORMAT_NAME,
+              'version': FORMAT_VERSION,
+              'shape': list(m.shape),
+              'has_sorted_indices': bool(m.has_sorted_indices)}
+
+    # written last, a directory without a header is an incomplete save
+    with open(os.path.join(path, HEADER_FILENAME), 'w') as f:
+        json.dump(header, f)
+
+def load(path, mmap=True):
+    """ Load a matrix stored with `save`.
+
+    Parameters:
+    -----------
+    path: the directory
+    mmap: memory-map the arrays (read-only) rather than reading them into memory
+
+    Returns a tuple (csr_matrix, array of labels). Fixed-width labels are
+    memory-mapped as well (wrap them in a pandas.Index when needed, it reads
+    them all)
+    """
+    header_path = os.path.join(path, HEADER_FILENAME)
+    if not os.path.isfile(header_path):
+        raise IOError("Not a stored graph (missing %s): %s" % (HEADER_FILENAME, path))
+
+    with open(header_path) as f:
+        header = json.load(f)
+
+    if header.get('format') != FORMAT_NAME:
+        raise ValueError("Not a stored graph: %s" % path)
+    if header.get('version') != FORMAT_VERSION:
+        raise ValueError("Unsupported format version %s (expected %d)" % (header.get('version'), FORMAT_VERSION))
+
+    mmap_mode = 'r' if mmap else None
+    arrays = {}
+    for name in ('indptr', 'indices', 'data'):
+        arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+    names_path = os.path.join(path, 'names.npy')
+    try:
+        names = np.load(names_path, mmap_mode=mmap_mode)
+    except ValueError: # object arrays are pickled and cannot be memory-mapped
+        names = np.load(names_path, allow_pickle=True)
+
+    shape = tuple(header['shape'])
+    m = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+    if header.get('has_sorted_indices'):
+        m.has_sorted_indices = True
+
+    return m, names
+
+def _encode_names(names):
+    """ Prefer a fixed-width (memory-mappable) array over a pickled object array """
+    values = np.asarray(names)
+    if values.dtype != object:
+        return values
+
+    fixed = np.asarray(values.tolist())
+    if fixed.ndim == 1 and fixed.dtype.kind in 'biufSU' and (fixed == values).all():
+        return fixed
+
+    return values
@@ -3,36 +3,67 @@
 
 #include <vector>
 
+#include "shuffle.h"
+
+template <typename I>
 struct shuffle_task {
-	int nnz_;
-	int* indices_;
-	int n_; 
-	int* indptr_;
+	I nnz_;
+	I* indices_;
+	I n_; 
+	I* indptr_;
 	double* data_; 
-	int iterations_;
+	long long iterations_;
 	int seed_;
+	const I* rows_;
+	int batch_;
+	shuffle_stats stats_;
 
-	shuffle_task(int nnz, int* indices, int n, int* indptr, double* data, int iterations, int seed)
-		: nnz_(nnz), indices_(indices), n_(n), indptr_(indptr), data_(data), iterations_(iterations), seed_(seed)
+	shuffle_task(I nnz, I* indices, I n, I* indptr, double* data, long long iterations, int seed,
+	             const I* rows, int batch)
+		: nnz_(nnz), indices_(indices), n_(n), indptr_(indptr), data_(data), iterations_(iterations), seed_(seed),
+		  rows_(rows), batch_(batch), stats_()
 	{}
 };
 
+// Shuffling tasks for int32 or int64 indices (I)
+template <typename I>
 struct tasker {
 	tasker() {
 		tasks_.reserve(100);
 	}
 
-	void add(int nnz, int* indices, int n, int* indptr, double* data, int iterations, int seed) {
-		tasks_.emplace_back(nnz, indices, n, indptr, data, iterations, seed);
+	void add(I nnz, I* indices, I n, I* indptr, double* data, long long iterations, int seed) {
+		tasks_.emplace_back(nnz, indices, n, indptr, data, iterations, seed, (const I*)NULL, 0);
+	}
+
+	void add(I nnz, I* indices, I n, I* indptr, double* data, long long iterations, int seed,
+	         const I* rows, int batch) {
+		tasks_.emplace_back(nnz, indices, n, indptr, data, iterations, seed, rows, batch);
 	}
 
-	int exectue(int i, int(*func)(int, int*, int, int*, double*, int, int)) {
-		shuffle_task& params = tasks_[i];
+	long long exectue(int i, long long(*func)(I, I*, I, I*, double*, long long, int)) {
+		shuffle_task<I>& params = tasks_[i];
 		return func(params.nnz_, params.indices_, params.n_, params.indptr_, params.data_, params.iterations_, params.seed_);
 	}
+
+	long long run(int i, bool directed) {
+		shuffle_task<I>& p = tasks_[i];
+		return shuffle_edges_fast(p.nnz_, p.indices_, p.n_, p.indptr_, p.data_, p.iterations_, p.seed_,
+		                          directed, p.rows_, p.batch_, &p.stats_);
+	}
+
+	shuffle_stats total_stats() const {
+		shuffle_stats total = shuffle_stats();
+		for(size_t i=0; i<tasks_.size(); ++i) {
+			total.attempts += tasks_[i].stats_.attempts;
+			total.accepted += tasks_[i].stats_.accepted;
+			total.rejected_nodes += tasks_[i].stats_.rejected_nodes;
+			total.rejected_exists += tasks_[i].stats_.rejected_exists;
+		}
+		return total;
+	}
 private:
-	std::vector<shuffle_task> tasks_;
+	std::vector<shuffle_task<I> > tasks_;
 };
 
 #endif /* end of include guard: TASKS_H_UBEJFEAR */
-
@@ -2,58 +2,148 @@ import numpy as np
 cimport numpy as np
 cimport cython
 
+ctypedef fused ITYPE_f:
+    np.int32_t
+    np.int64_t
+
+def _index_arrays(csgraph):
+    indices, indptr = csgraph.indices, csgraph.indptr
+    if indices.dtype != indptr.dtype:
+        indices, indptr = indices.astype(np.int64), indptr.astype(np.int64)
+    return indices, indptr
+
 def topological_sort(csgraph):
-    cdef int N = csgraph.shape[0]
-    
-    node_list = np.empty(N, dtype=np.int)
-    status = np.zeros(N, dtype=np.int)
+    """ Depth-first topological order of a DAG (a csr matrix). The walk
+        keeps an explicit stack, so the depth of the graph is not limited
+        by the C stack. Raises ValueError if the graph has a cycle. """
+    cdef np.int64_t N = csgraph.shape[0]
+
+    node_list = np.empty(N, dtype=np.int64)
+    indices, indptr = _index_arrays(csgraph)
 
-    _topological_sort(csgraph.indices, csgraph.indptr, node_list, status)
+    if not _topological_sort(indices, indptr, node_list):
+        raise ValueError("Not a DAG")
 
     return node_list
 
+def topological_levels(csgraph):
+    """ Kahn's algorithm. Returns a tuple (order, levels): the nodes in
+        topological order, sorted by level, and the level of every node
+        (0 for nodes without incoming edges, otherwise one more than the
+        largest level of a predecessor). Raises ValueError if the graph
+        has a cycle. """
+    cdef np.int64_t N = csgraph.shape[0]
+
+    order = np.empty(N, dtype=np.int64)
+    levels = np.zeros(N, dtype=np.int64)
+    indices, indptr = _index_arrays(csgraph)
+
+    if not _topological_levels(indices, indptr, order, levels):
+        raise ValueError("Not a DAG")
+
+    return order, levels
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def _topological_sort(ITYPE_f[::1] indices,
+                      ITYPE_f[::1] indptr,
+                      np.int64_t[::1] node_list):
+    """ Fills node_list, returns False if a cycle was found """
+    cdef np.int64_t N = indptr.shape[0] - 1
+    cdef np.ndarray[np.int8_t] status_arr = np.zeros(N, dtype=np.int8)
+    cdef np.ndarray[np.int64_t] stack_arr = np.empty(N, dtype=np.int64)
+    cdef np.ndarray[np.int64_t] position_arr = np.empty(N, dtype=np.int64)
+    cdef np.int8_t[::1] status = status_arr
+    cdef np.int64_t[::1] stack = stack_arr
+    cdef np.int64_t[::1] position = position_arr
+    cdef bint ok
+
+    with nogil:
+        ok = _topological_sort_visit(indices, indptr, node_list, status, stack, position)
+    return ok
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
-cdef void _topological_sort(int[::1] indices,
-                            int[::1] indptr,
-                            long[::1] node_list,
-                            long[::1] status) nogil:
-    cdef int N = indices.shape[0] - 1
-    cdef int i_nl_end = N-1
-    cdef int i
-    
+cdef bint _topological_sort_visit(ITYPE_f[::1] indices,
+                                  ITYPE_f[::1] indptr,
+                                  np.int64_t[::1] node_list,
+                                  np.int8_t[::1] status,
+                                  np.int64_t[::1] stack,
+                                  np.int64_t[::1] position) nogil:
+    """ status: 0 - unvisited, 1 - on the stack, 2 - done. position holds
+        the next edge to follow for every node on the stack """
+    cdef np.int64_t N = indptr.shape[0] - 1
+    cdef np.int64_t i_nl_end = N-1
+    cdef np.int64_t top, head_node, child, i
+
     for i from 0 <= i < N:
-        if status[i] == 2:
+        if status[i] != 0:
             continue
 
-        i_nl_end = _topological_sort_visit_rec(i, i_nl_end, indices, indptr, node_list, status)
+        top = 0
+        stack[0] = i
+        position[i] = indptr[i]
+        status[i] = 1
+
+        while top >= 0:
+            head_node = stack[top]
+            if position[head_node] < indptr[head_node + 1]:
+                child = indices[position[head_node]]
+                position[head_node] += 1
+
+                if status[child] == 1:
+                    return False
+                if status[child] == 0:
+                    status[child] = 1
+                    position[child] = indptr[child]
+                    top += 1
+                    stack[top] = child
+            else:
+                status[head_node] = 2
+                node_list[i_nl_end] = head_node
+                i_nl_end -= 1
+                top -= 1
+
+    return True
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
-cdef unsigned int _topological_sort_visit_rec(
-                           unsigned int head_node,
-                           unsigned int i_nl_end,
-                           int[::1] indices,
-                           int[::1] indptr,
-                           long[::1] node_list,
-                           long[::1] status) nogil:
-    cdef int i
-
-    if status[head_node] == 1:
-        with gil:
-            raise ValueError("Not a DAG")
-    
-    if status[head_node] == 0:
-        status[head_node] = 1
-
-        for i from indptr[head_node] <= i < indptr[head_node + 1]:
-            i_nl_end = _topological_sort_visit_rec(indices[i], i_nl_end, indices, indptr, node_list, status)
-
-        status[head_node] = 2
-        node_list[i_nl_end] = head_node
-
-        i_nl_end -= 1
-
-    return i_nl_end
+def _topological_levels(ITYPE_f[::1] indices,
+                        ITYPE_f[::1] indptr,
+                        np.int64_t[::1] order,
+                        np.int64_t[::1] levels):
+    """ Fills order and levels, returns False if a cycle was found """
+    cdef np.int64_t N = indptr.shape[0] - 1
+    cdef np.ndarray[np.int64_t] in_degree_arr = np.zeros(N, dtype=np.int64)
+    cdef np.int64_t[::1] in_degree = in_degree_arr
+    cdef np.int64_t head, tail, u, v, i
+
+    with nogil:
+        for i from 0 <= i < indptr[N]:
+            in_degree[indices[i]] += 1
+
+        tail = 0
+        for u from 0 <= u < N:
+            if in_degree[u] == 0:
+                order[tail] = u
+                tail += 1
+
+        # the queue is processed in FIFO order, so nodes are appended level
+        # by level and a node is queued only after all its predecessors
+        head = 0
+        while head < tail:
+            u = order[head]
+            head += 1
+            for i from indptr[u] <= i < indptr[u + 1]:
+                v = indices[i]
+                if levels[v] < levels[u] + 1:
+                    levels[v] = levels[u] + 1
+                in_degree[v] -= 1
+                if in_degree[v] == 0:
+                    order[tail] = v
+                    tail += 1
+
+    return tail == N
@@ -0,0 +1,389 @@
+"""
+Traversals and connected components over csr matrices.
+
+A Traversal owns the scratch buffers of a graph: BFS/DFS mark nodes with a
+per-call stamp rather than clearing a status array, so the cost of a query
+is proportional to the part of the graph it visits. The kernels release
+the GIL, so queries on separate Traversals run concurrently in threads.
+"""
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+cimport numpy as np
+cimport cython
+
+ctypedef fused ITYPE_f:
+    np.int32_t
+    np.int64_t
+
+CONNECTIONS = ('weak', 'strong')
+
+cdef class Traversal:
+    """ BFS, DFS and connected components over a csr matrix (edges are
+        followed from row to column), reusing the scratch buffers across
+        calls. Not thread-safe: use one Traversal per thread.
+
+    Parameters:
+    -----------
+    csgraph: a square csr_matrix
+
+    Examples:
+    ---------
+    >>> from scipy.sparse import csr_matrix
+    >>> m = csr_matrix(([1., 1, 1, 1], ([0, 1, 2, 4], [1, 2, 3, 3])), shape=(5, 5))
+    >>> t = Traversal(m)
+    >>> t.bfs([0, 4])
+    (array([0, 4, 1, 3, 2]), array([0, 0, 1, 1, 2]))
+    >>> t.bfs([0], max_hops=1)
+    (array([0, 1]), array([0, 1]))
+    >>> order, hops, predecessors = t.dfs([0], return_predecessors=True)
+    >>> order, predecessors
+    (array([0, 1, 2, 3]), array([-1,  0,  1,  2]))
+    >>> t.connected_components()
+    (1, array([0, 0, 0, 0, 0]))
+    >>> t.connected_components('strong')
+    (5, array([0, 1, 2, 3, 4]))
+    """
+    cdef readonly object indptr, indices
+    cdef readonly np.int64_t n
+    cdef np.int64_t current
+    cdef object _stamp, _buffers
+
+    def __init__(self, csgraph):
+        if csgraph.shape[0] != csgraph.shape[1]:
+            raise ValueError("Expected a square matrix")
+
+        indices, indptr = csgraph.indices, csgraph.indptr
+        if indices.dtype != indptr.dtype or indices.dtype not in (np.int32, np.int64):
+            indices, indptr = indices.astype(np.int64), indptr.astype(np.int64)
+
+        self.indptr, self.indices = np.ascontiguousarray(indptr), np.ascontiguousarray(indices)
+        self.n = csgraph.shape[0]
+        self.current = 0
+        self._stamp = None
+        self._buffers = {}
+
+    def _buffer(self, name):
+        """ An int64 array of n entries, allocated on first use """
+        try:
+            return self._buffers[name]
+        except KeyError:
+            result = self._buffers[name] = np.empty(self.n, dtype=np.int64)
+            return result
+
+    def _next_stamp(self):
+        if self._stamp is None:
+            self._stamp = np.zeros(self.n, dtype=np.int64)
+        self.current += 1
+        return self.current
+
+    def _sources(self, sources):
+        sources = np.atleast_1d(np.asarray(sources, dtype=np.int64)).ravel()
+        if len(sources) and (sources.min() < 0 or sources.max() >= self.n):
+            raise IndexError("source node out of range")
+        return sources
+
+    def bfs(self, sources, max_hops=None, return_predecessors=False):
+        """ Breadth-first search from all the sources at once.
+
+        Parameters:
+        -----------
+        sources:             node ids (at hop 0)
+        max_hops:            do not go further than max_hops edges (default: no limit)
+        return_predecessors: also return the node each node was reached from
+                             (-1 for the sources)
+
+        Returns the reached nodes in the order they were found and their
+        distance (in edges) from the nearest source.
+        """
+        return self._walk(_bfs, sources, max_hops, return_predecessors)
+
+    def dfs(self, sources, max_hops=None, return_predecessors=False):
+        """ Depth-first search from each of the sources in turn (nodes found
+            from an earlier source are not visited again). As bfs, except
+            that the hops are the depths in the search tree, and max_hops
+            limits that depth. """
+        return self._walk(_dfs, sources, max_hops, return_predecessors)
+
+    def _walk(self, kernel, sources, max_hops, return_predecessors):
+        sources = self._sources(sources)
+        stamp = self._next_stamp()
+        order, hops, predecessors = self._buffer('order'), self._buffer('hops'), self._buffer('predecessors')
+
+        count = kernel(self.indptr, self.indices, sources, -1 if max_hops is None else max_hops,
+                       self._stamp, stamp, order, hops, predecessors, self._buffer('cursor'))
+
+        order = order[:count].copy()
+        if return_predecessors:
+            return order, hops[order], predecessors[order]
+        return order, hops[order]
+
+    def connected_components(self, connection='weak'):
+        """ Returns (the number of components, the component of every node).
+            'weak' ignores the direction of the edges, 'strong' requires a
+            directed path between every two nodes of a component. Components
+            are numbered in order of their smallest node. """
+        if connection not in CONNECTIONS:
+            raise ValueError("Unknown connection %r (expected one of %s)" % (connection, ', '.join(CONNECTIONS)))
+
+        labels = np.empty(self.n, dtype=np.int64)
+        if connection == 'weak':
+            count = _weak_components(self.indptr, self.indices, self._buffer('order'), labels)
+            return count, labels
+
+        count = _strong_components(self.indptr, self.indices, labels, self._buffer('order'), self._buffer('hops'),
+                                   self._buffer('predecessors'), self._buffer('cursor'), self._buffer('stack'))
+
+        # renumber by the smallest node
+        _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+        rank = np.empty(count, dtype=np.int64)
+        rank[np.argsort(first, kind='mergesort')] = np.arange(count)
+        return count, rank[inverse]
+
+def connected_components(csgraph, connection='weak'):
+    """ See Traversal.connected_components """
+    return Traversal(csgraph).connected_components(connection)
+
+def reachable(csgraph, queries, max_hops=None, n_jobs=None):
+    """ The nodes reachable from each query (a node id or a sequence of node
+        ids) within max_hops edges, in breadth-first order. The queries are
+        answered by n_jobs threads (default: all available), each with its
+        own Traversal.
+
+    Examples:
+    ---------
+    >>> from scipy.sparse import csr_matrix
+    >>> m = csr_matrix(([1., 1, 1], ([0, 1, 2], [1, 2, 3])), shape=(4, 4))
+    >>> reachable(m, [0, 2, [1, 3]], max_hops=1, n_jobs=2)
+    [array([0, 1]), array([2, 3]), array([1, 3, 2])]
+    """
+    if n_jobs is None or n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+
+    local = threading.local()
+    def query(sources):
+        t = getattr(local, 'traversal', None)
+        if t is None:
+            t = local.traversal = Traversal(csgraph)
+        return t.bfs(sources, max_hops)[0]
+
+    queries = list(queries)
+    if n_jobs == 1 or len(queries) < 2:
+        return [query(x) for x in queries]
+
+    pool = ThreadPool(min(n_jobs, len(queries)))
+    try:
+        return pool.map(query, queries)
+    finally:
+        pool.close()
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def _bfs(ITYPE_f[::1] indptr,
+         ITYPE_f[::1] indices,
+         np.int64_t[::1] sources,
+         np.int64_t max_hops,
+         np.int64_t[::1] stamp,
+         np.int64_t current,
+         np.int64_t[::1] order,
+         np.int64_t[::1] hops,
+         np.int64_t[::1] predecessors,
+         np.int64_t[::1] cursor):
+    """ Returns the number of nodes written to order """
+    cdef np.int64_t head = 0, tail = 0
+    cdef np.int64_t k, u, v
+    cdef ITYPE_f e
+
+    with nogil:
+        for k in range(sources.shape[0]):
+            u = sources[k]
+            if stamp[u] != current:
+                stamp[u] = current
+                hops[u] = 0
+                predecessors[u] = -1
+                order[tail] = u
+                tail += 1
+
+        while head < tail:
+            u = order[head]
+            head += 1
+            if hops[u] == max_hops:
+                continue
+
+            for e in range(indptr[u], indptr[u + 1]):
+                v = indices[e]
+                if stamp[v] != current:
+                    stamp[v] = current
+                    hops[v] = hops[u] + 1
+                    predecessors[v] = u
+                    order[tail] = v
+                    tail += 1
+
+    return tail
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def _dfs(ITYPE_f[::1] indptr,
+         ITYPE_f[::1] indices,
+         np.int64_t[::1] sources,
+         np.int64_t max_hops,
+         np.int64_t[::1] stamp,
+         np.int64_t current,
+         np.int64_t[::1] order,
+         np.int64_t[::1] hops,
+         np.int64_t[::1] predecessors,
+         np.int64_t[::1] cursor):
+    """ Returns the number of nodes written to order. The stack is the path
+        from the source, i.e., follows the predecessors; cursor holds the
+        next edge of every node on it. """
+    cdef np.int64_t count = 0
+    cdef np.int64_t k, u, v
+
+    with nogil:
+        for k in range(sources.shape[0]):
+            u = sources[k]
+            if stamp[u] == current:
+                continue
+
+            stamp[u] = current
+            hops[u] = 0
+            predecessors[u] = -1
+            cursor[u] = indptr[u]
+            order[count] = u
+            count += 1
+
+            while u >= 0:
+                if hops[u] == max_hops or cursor[u] == indptr[u + 1]:
+                    u = predecessors[u] # done, back up
+                    continue
+
+                v = indices[cursor[u]]
+                cursor[u] += 1
+                if stamp[v] != current:
+                    stamp[v] = current
+                    hops[v] = hops[u] + 1
+                    predecessors[v] = u
+                    cursor[v] = indptr[v]
+                    order[count] = v
+                    count += 1
+                    u = v
+
+    return count
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def _weak_components(ITYPE_f[::1] indptr,
+                     ITYPE_f[::1] indices,
+                     np.int64_t[::1] parent,
+                     np.int64_t[::1] labels):
+    """ Union-find in which the root of a set is its smallest node, so no
+        transpose is needed for directed graphs. Returns the number of
+        components """
+    cdef np.int64_t n = indptr.shape[0] - 1
+    cdef np.int64_t count = 0
+    cdef np.int64_t u, v, ru, rv
+    cdef ITYPE_f e
+
+    with nogil:
+        for u in range(n):
+            parent[u] = u
+
+        for u in range(n):
+            for e in range(indptr[u], indptr[u + 1]):
+                ru = _find(parent, u)
+                rv = _find(parent, indices[e])
+                if ru < rv:
+                    parent[rv] = ru
+                elif rv < ru:
+                    parent[ru] = rv
+
+        # roots come before the other nodes of their set
+        for u in range(n):
+            ru = _find(parent, u)
+            if ru == u:
+                labels[u] = count
+                count += 1
+            else:
+                labels[u] = labels[ru]
+
+    return count
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline np.int64_t _find(np.int64_t[::1] parent, np.int64_t u) nogil:
+    while parent[u] != u:
+        parent[u] = parent[parent[u]] # path halving
+        u = parent[u]
+    return u
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def _strong_components(ITYPE_f[::1] indptr,
+                       ITYPE_f[::1] indices,
+                       np.int64_t[::1] labels,
+                       np.int64_t[::1] index,
+                       np.int64_t[::1] lowlink,
+                       np.int64_t[::1] path,
+                       np.int64_t[::1] cursor,
+                       np.int64_t[::1] stack):
+    """ Tarjan's algorithm with an explicit call stack (path). A node is on
+        the component stack while it has an index but no label. Returns the
+        number of components """
+    cdef np.int64_t n = indptr.shape[0] - 1
+    cdef np.int64_t counter = 0, count = 0, top, stack_top = -1
+    cdef np.int64_t s, u, v, w
+
+    with nogil:
+        for u in range(n):
+            index[u] = -1
+            labels[u] = -1
+
+        for s in range(n):
+            if index[s] != -1:
+                continue
+
+            top = 0
+            path[0] = s
+            index[s] = lowlink[s] = counter
+            counter += 1
+            cursor[s] = indptr[s]
+            stack_top += 1
+            stack[stack_top] = s
+
+            while top >= 0:
+                u = path[top]
+                if cursor[u] < indptr[u + 1]:
+                    v = indices[cursor[u]]
+                    cursor[u] += 1
+                    if index[v] == -1:
+                        index[v] = lowlink[v] = counter
+                        counter += 1
+                        cursor[v] = indptr[v]
+                        stack_top += 1
+                        stack[stack_top] = v
+                        top += 1
+                        path[top] = v
+                    elif labels[v] == -1 and index[v] < lowlink[u]:
+                        lowlink[u] = index[v]
+                    continue
+
+                if lowlink[u] == index[u]:
+                    while True:
+                        w = stack[stack_top]
+                        stack_top -= 1
+                        labels[w] = count
+                        if w == u:
+                            break
+                    count += 1
+
+                top -= 1
+                if top >= 0 and lowlink[u] < lowlink[path[top]]:
+                    lowlink[path[top]] = lowlink[u]
+
+    return count
@@ -19,3 +19,154 @@ def edge_id(a, b, sep=':'):
 
     """
     return np.where(a<b, a + sep + b, b + sep + a)
+
+COALESCE_METHODS = ('sum', 'mean', 'max', 'min', 'first', 'last')
+
+def coalesce(rows, cols, data, how='sum'):
+    """ Sort (row, col, data) triplets by (row, col) and combine duplicates.
+
+    Parameters
+    ----------
+    rows, cols: non-negative integer arrays
+    data:       the values
+    how:        how to combine duplicate entries: 'sum', 'mean', 'max', 'min',
+                'first' or 'last' (in the order of the input)
+
+    Returns the (rows, cols, data) of the unique entries, ordered by row and
+    then by column.
+
+    >>> r, c, d = coalesce(np.array([1, 0, 1]), np.array([0, 2, 0]), np.array([1., 2., 3.]))
+    >>> r, c, d
+    (array([0, 1]), array([2, 0]), array([ 2.,  4.]))
+    >>> coalesce(np.array([1, 0, 1]), np.array([0, 2, 0]), np.array([1., 2., 3.]), how='first')[2]
+    array([ 2.,  1.])
+    >>> coalesce(np.array([1, 0, 1]), np.array([0, 2, 0]), np.array([1., 2., 3.]), how='mean')[2]
+    array([ 2.,  2.])
+    """
+    if how not in COALESCE_METHODS:
+        raise ValueError("Unknown method for combining duplicates: %r" % (how,))
+
+    keys = (np.asarray(rows, dtype=np.int64) << 32) | np.asarray(cols, dtype=np.int64)
+    order = np.argsort(keys, kind='mergesort') # stable, for first/last
+    keys = keys[order]
+    data = np.asarray(data)[order]
+
+    starts = np.empty(len(keys), dtype=bool)
+    starts[:1] = True
+    np.not_equal(keys[1:], keys[:-1], out=starts[1:])
+    first = np.flatnonzero(starts)
+
+    if len(first) < len(keys):
+        if how == 'sum':
+            data = np.add.reduceat(data, first)
+        elif how == 'mean':
+            data = np.add.reduceat(data, first) / np.diff(np.append(first, len(keys))).astype(np.double)
+        elif how == 'max':
+            data = np.maximum.reduceat(data, first)
+        elif how == 'min':
+            data = np.minimum.reduceat(data, first)
+        elif how == 'first':
+            data = data[first]
+        else:
+            data = data[np.append(first[1:], len(keys)) - 1]
+        keys = keys[first]
+
+    idx_dtype = np.asarray(rows).dtype
+    return (keys >> 32).astype(idx_dtype), (keys & 0xffffffff).astype(idx_dtype), data
+
+def index_dtype(*sizes):
+    """ The compact index dtype for a matrix of the given sizes (e.g., number
+        of rows and nnz): int32 when all fit, int64 otherwise
+
+    >>> index_dtype(10, 100), index_dtype(10, 2**31)
+    (<type 'numpy.int32'>, <type 'numpy.int64'>)
+    """
+    return np.int32 if max(sizes) < np.iinfo(np.int32).max else np.int64
+
+def as_index_dtype(m):
+    """ Convert (in-place) the index arrays of a csr_matrix to index_dtype """
+    dtype = index_dtype(m.shape[0], m.shape[1], m.nnz)
+    if m.indices.dtype != dtype or m.indptr.dtype != dtype:
+        m.indices = m.indices.astype(dtype)
+        m.indptr = m.indptr.astype(dtype)
+    return m
+
+def csr_from_sorted(rows, cols, data, n):
+    """ Build an n X n csr_matrix from entries sorted by (row, col) """
+    from scipy.sparse import csr_matrix
+
+    idx_dtype = index_dtype(n, len(cols))
+    indptr = np.zeros(n + 1, dtype=idx_dtype)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    m = csr_matrix((data, np.asarray(cols, dtype=idx_dtype), indptr), shape=(n, n), copy=False)
+    m.has_sorted_indices = True
+    return m
+
+def row_blocks(m, chunk_size):
+    """ The entries of a csr_matrix in blocks of whole rows, each with about
+        chunk_size entries (or a single row). Yields (rows, cols, data)
+
+    >>> from scipy.sparse import csr_matrix
+    >>> m = csr_matrix(np.arange(1., 7.).reshape(3, 2))
+    >>> [rows.tolist() for rows, cols, data in row_blocks(m, 3)]
+    [[0, 0], [1, 1], [2, 2]]
+    """
+    n = m.shape[0]
+    row = 0
+    while row < n:
+        end = np.searchsorted(m.indptr, m.indptr[row] + chunk_size, side='right') - 1
+        end = min(max(end, row + 1), n)
+
+        lo, hi = m.indptr[row], m.indptr[end]
+        rows = np.repeat(np.arange(row, end), np.diff(m.indptr[row:end + 1]))
+        yield rows, m.indices[lo:hi], m.data[lo:hi]
+        row = end
+
+def induced_subgraph(m, ids):
+    """ m[ids, :][:, ids] for a square csr_matrix, in a single pass over the
+        rows of ids (which must be unique)
+
+    >>> from scipy.sparse import csr_matrix
+    >>> m = csr_matrix(np.arange(16.).reshape(4, 4))
+    >>> induced_subgraph(m, [3, 1]).toarray()
+    array([[ 15.,  13.],
+           [  7.,   5.]])
+    """
+    from scipy.sparse import csr_matrix
+
+    ids = np.asarray(ids, dtype=np.int64)
+    starts = m.indptr[ids].astype(np.int64)
+    lengths = m.indptr[ids + 1] - starts
+    total = lengths.sum()
+
+    # the positions (in indices/data) of all the entries of the rows
+    offsets = np.zeros(len(ids), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    positions = np.repeat(starts - offsets, lengths) + np.arange(total)
+
+    idx_dtype = index_dtype(len(ids), total)
+    cols = m.indices[positions]
+    if total > m.shape[0] // 8:
+        # a dense map from the columns of m is cheaper than searching
+        relabel = np.empty(m.shape[0], dtype=idx_dtype)
+        relabel.fill(-1)
+        relabel[ids] = np.arange(len(ids), dtype=idx_dtype)
+        cols = relabel[cols]
+        keep = cols >= 0
+        cols = cols[keep]
+    else:
+        order = np.argsort(ids)
+        sorted_ids = ids[order]
+        k = np.minimum(np.searchsorted(sorted_ids, cols), max(len(ids) - 1, 0))
+        keep = sorted_ids[k] == cols if len(ids) else np.zeros(0, dtype=bool)
+        cols = order[k[keep]].astype(idx_dtype)
+
+    kept = np.zeros(total + 1, dtype=idx_dtype)
+    np.cumsum(keep, out=kept[1:])
+    indptr = np.zeros(len(ids) + 1, dtype=idx_dtype)
+    indptr[1:] = kept[offsets + lengths]
+
+    result = csr_matrix((m.data[positions[keep]], cols, indptr), shape=(len(ids), len(ids)), copy=False)
+    if m.has_sorted_indices and np.all(np.diff(ids) > 0):
+        result.has_sorted_indices = True
+    return result
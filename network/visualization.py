@@ -1,37 +1,79 @@
 import subprocess
+import threading
 import sparse_graph
 from cStringIO import StringIO
 
-def _as_dot_file(m, node_attributes=None, directed=False):
-    s = StringIO()
-    s.write('digraph G {' if directed else 'graph G {')
-    s.write(' graph[bgcolor="transparent"]; ')
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from util import row_blocks
+
+def write_dot(f, m, node_attributes=None, directed=False, chunk_size=100000):
+    """ Write m in the DOT language to the file object f. Edges are
+        formatted from the csr arrays in chunks of about chunk_size.
+
+    Examples:
+    ---------
+    >>> m = csr_matrix(([1., 2.5], ([0, 1], [1, 0])), shape=(3, 3))
+    >>> f = StringIO()
+    >>> write_dot(f, m, [{'label': 'a'}, {'label': 'b'}, {'label': 'c'}])
+    >>> print f.getvalue()
+    graph G { graph[bgcolor="transparent"]; 0[label=a];1[label=b];2[label=c];0 -- 1[penwidth=1.00,color="#0000FF88"];}
+    """
+    if isinstance(m, sparse_graph.SparseGraph):
+        m = m.data
+    m = csr_matrix(m)
+    if not m.has_canonical_format: # m[u, v] used to sum duplicates
+        m = m.copy()
+        m.sum_duplicates()
+
+    f.write('digraph G {' if directed else 'graph G {')
+    f.write(' graph[bgcolor="transparent"]; ')
 
     if node_attributes is not None:
-        for k, v in enumerate(node_attributes):
-            s.write('%d[%s];' % (k, ','.join(['%s=%s' % (x,y) for x,y in v.iteritems()])))
+        f.write(''.join('%d[%s];' % (k, ','.join(['%s=%s' % (x,y) for x,y in v.iteritems()]))
+                        for k, v in enumerate(node_attributes)))
 
-    i, j = m.nonzero()
-    if not directed:
-        mask = i < j
-        i, j = i[mask], j[mask]
-        edge = '--'
-    else:
-        edge = '->'
+    edge = ' -> ' if directed else ' -- '
+    for i, j, data in row_blocks(m, chunk_size):
+        mask = data != 0 # as nonzero()
+        if not directed:
+            mask &= i < j
+        i, j, data = i[mask], j[mask], data[mask]
 
-    for u,v in zip(i, j):
-        s.write('%d %s %d[penwidth=%.2f,color="#0000FF88"];' % (u, edge, v, m[u, v]))
+        if len(i):
+            text = (i.astype(str).astype(object) + edge + j.astype(str).astype(object) +
+                    '[penwidth=' + np.char.mod('%.2f', data).astype(object) + ',color="#0000FF88"];')
+            f.write(''.join(text))
 
-    s.write('}')
+    f.write('}')
 
+def _as_dot_file(m, node_attributes=None, directed=False):
+    s = StringIO()
+    write_dot(s, m, node_attributes, directed)
     return s.getvalue()
 
 def render(csr, node_attributes=None, directed=False, prog='dot', **kwargs):
+    """ Render with graphviz. The DOT text is streamed into the stdin of
+        `prog` while a thread collects its output """
     commandline = sum([['-' + x,y] for x,y in kwargs.iteritems()], [])
 
     pipe = subprocess.Popen([prog] + commandline, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
 
     if isinstance(csr, sparse_graph.SparseGraph) and node_attributes is None:
-        node_attributes = [{'label': x} for x in csr.names.index] 
+        node_attributes = [{'label': x} for x in csr.names.index]
+
+    output = []
+    reader = threading.Thread(target=lambda: output.append(pipe.stdout.read()))
+    reader.daemon = True
+    reader.start()
+
+    try:
+        write_dot(pipe.stdin, csr, node_attributes, directed)
+    finally:
+        pipe.stdin.close()
+        reader.join()
+        pipe.stdout.close()
+        pipe.wait()
 
-    return pipe.communicate(_as_dot_file(csr, node_attributes, directed))[0]
+    return output[0]